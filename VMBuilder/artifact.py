@@ -0,0 +1,181 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Moving finished images from the work directory to the destination
+#    directory as cheaply as the filesystems involved allow
+
+import ctypes
+import errno
+import fcntl
+import logging
+import os
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# From linux/fs.h (not in os until Python 3.3)
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# How much to copy per copy_file_range/read call
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Errors meaning "can't do that here", rather than "something broke"
+UNSUPPORTED = [errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF]
+
+_copy_file_range = None
+
+def _libc_copy_file_range():
+    global _copy_file_range
+    if _copy_file_range is None:
+        try:
+            func = ctypes.CDLL(None, use_errno=True).copy_file_range
+        except AttributeError:
+            # glibc older than 2.27
+            func = False
+        else:
+            loff_p = ctypes.POINTER(ctypes.c_longlong)
+            func.argtypes = [ctypes.c_int, loff_p, ctypes.c_int, loff_p, ctypes.c_size_t, ctypes.c_uint]
+            func.restype = ctypes.c_ssize_t
+        _copy_file_range = func
+    return _copy_file_range
+
+def place_artifact(src, dest):
+    """
+    Move src to dest: by renaming it if they're on the same filesystem,
+    else by reflinking it if the filesystem can (btrfs, XFS), else by
+    copying just the parts of it that have data in them.
+
+    @rtype:  string
+    @return: How it was moved: 'rename', 'reflink' or 'copy'
+    """
+    logging.info('Moving %s to %s' % (src, dest))
+    try:
+        os.rename(src, dest)
+        return 'rename'
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    srcfp = open(src, 'rb')
+    try:
+        destfp = open(dest, 'wb')
+        try:
+            if reflink(srcfp.fileno(), destfp.fileno()):
+                how = 'reflink'
+            else:
+                sparse_copy(srcfp.fileno(), destfp.fileno())
+                how = 'copy'
+        finally:
+            destfp.close()
+    finally:
+        srcfp.close()
+    os.unlink(src)
+    logging.debug('Moved %s to %s by %s' % (src, dest, how))
+    return how
+
+def reflink(srcfd, destfd):
+    """
+    Make destfd share srcfd's blocks.
+
+    @rtype:  boolean
+    @return: Whether it could
+    """
+    try:
+        fcntl.ioctl(destfd, FICLONE, srcfd)
+        return True
+    except IOError, e:
+        if e.errno not in UNSUPPORTED:
+            raise
+        return False
+
+def data_extents(fd):
+    """
+    Find the parts of fd that aren't holes.
+
+    @rtype:  generator
+    @return: (start, end) byte offsets of each stretch of data. Without
+             SEEK_DATA support, that's the whole file.
+    """
+    size = os.fstat(fd).st_size
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                # Nothing but a hole left
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            # No SEEK_DATA here, so it's all data as far as we can tell
+            data = offset
+            hole = size
+        else:
+            hole = os.lseek(fd, data, SEEK_HOLE)
+        yield (data, hole)
+        offset = hole
+
+def sparse_copy(srcfd, destfd):
+    """
+    Copy srcfd to (empty) destfd, skipping its holes so that they stay
+    holes.
+    """
+    for (start, end) in data_extents(srcfd):
+        copy_range(srcfd, destfd, start, end - start)
+    os.ftruncate(destfd, os.fstat(srcfd).st_size)
+
+def copy_range(srcfd, destfd, offset, length):
+    """Copy length bytes at offset of srcfd to the same offset of destfd"""
+    copied = _kernel_copy(srcfd, destfd, offset, length)
+    offset += copied
+    length -= copied
+    while length > 0:
+        os.lseek(srcfd, offset, os.SEEK_SET)
+        buf = os.read(srcfd, min(length, CHUNK_SIZE))
+        if not buf:
+            break
+        os.lseek(destfd, offset, os.SEEK_SET)
+        os.write(destfd, buf)
+        offset += len(buf)
+        length -= len(buf)
+
+def _kernel_copy(srcfd, destfd, offset, length):
+    """
+    copy_file_range as much of the range as the kernel will.
+
+    @rtype:  number
+    @return: Bytes copied, 0 if copy_file_range isn't available
+    """
+    func = _libc_copy_file_range()
+    if not func:
+        return 0
+    off_in = ctypes.c_longlong(offset)
+    off_out = ctypes.c_longlong(offset)
+    copied = 0
+    while copied < length:
+        ret = func(srcfd, ctypes.byref(off_in), destfd, ctypes.byref(off_out), min(length - copied, CHUNK_SIZE), 0)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err in UNSUPPORTED:
+                break
+            raise OSError(err, os.strerror(err))
+        if ret == 0:
+            break
+        copied += ret
+    return copied
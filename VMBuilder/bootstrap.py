@@ -0,0 +1,146 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Bootstrap backends: the tools that create the initial chroot
+
+import logging
+import os.path
+import pipes
+from   VMBuilder.exception import VMBuilderUserError
+from   VMBuilder.util      import run_cmd, tmpdir
+
+class Bootstrapper(object):
+    """
+    Base class for bootstrap backends.
+
+    @type  arch: string
+    @param arch: Architecture to bootstrap
+    @type  variant: string
+    @param variant: debootstrap style variant (minbase, buildd, fakechroot)
+    @type  debootstrap_tarball: string
+    @param debootstrap_tarball: Tarball of packages made by
+                                C{debootstrap --make-tarball}
+    @type  proxy: string
+    @param proxy: HTTP proxy to download packages through
+    @type  archives: string
+    @param archives: Directory holding previously downloaded packages.
+                     Packages downloaded during bootstrap are left there
+                     too.
+    @type  tarball: string
+    @param tarball: Tarball of a complete root filesystem
+    """
+    # Whether make_tarball() is available
+    makes_tarballs = False
+
+    def __init__(self, arch, variant=None, debootstrap_tarball=None, proxy=None, archives=None, tarball=None):
+        self.arch = arch
+        self.variant = variant
+        self.debootstrap_tarball = debootstrap_tarball
+        self.proxy = proxy
+        self.archives = archives
+        self.tarball = tarball
+
+    def env(self):
+        env = { 'DEBIAN_FRONTEND' : 'noninteractive' }
+        if self.proxy:
+            env['http_proxy'] = self.proxy
+        return env
+
+    def bootstrap(self, suite, target, mirror):
+        """Bootstrap suite from mirror into target"""
+        raise NotImplementedError('Bootstrapper subclasses need to implement the bootstrap method')
+
+    def make_tarball(self, suite, tarball, mirror):
+        """Download the packages needed to bootstrap suite into tarball"""
+        raise NotImplementedError('%s can not make tarballs' % self.__class__.__name__)
+
+class Debootstrap(Bootstrapper):
+    """Bootstrap with debootstrap"""
+    makes_tarballs = True
+
+    def base_cmd(self):
+        cmd = ['/usr/sbin/debootstrap', '--arch=%s' % self.arch]
+        if self.variant:
+            cmd += ['--variant=%s' % self.variant]
+        if self.archives:
+            cmd += ['--cache-dir=%s' % self.archives]
+        return cmd
+
+    def bootstrap(self, suite, target, mirror):
+        cmd = self.base_cmd()
+        if self.debootstrap_tarball:
+            cmd += ['--unpack-tarball=%s' % self.debootstrap_tarball]
+        cmd += [suite, target, mirror]
+        run_cmd(env=self.env(), *cmd)
+
+    def make_tarball(self, suite, tarball, mirror):
+        # debootstrap wants a target dir even though it only downloads
+        workdir = tmpdir()
+        try:
+            cmd = self.base_cmd() + ['--make-tarball=%s' % tarball, suite, workdir, mirror]
+            run_cmd(env=self.env(), *cmd)
+        finally:
+            run_cmd('rm', '-rf', '--one-file-system', workdir)
+
+class Mmdebstrap(Bootstrapper):
+    """
+    Bootstrap with mmdebstrap, which resolves dependencies with apt and
+    downloads packages in parallel.
+    """
+    def bootstrap(self, suite, target, mirror):
+        cmd = ['mmdebstrap', '--architectures=%s' % self.arch]
+        if self.variant == 'fakechroot':
+            cmd += ['--mode=fakechroot']
+        elif self.variant:
+            cmd += ['--variant=%s' % self.variant]
+        if self.proxy:
+            cmd += ['--aptopt=Acquire::http::Proxy "%s"' % self.proxy]
+
+        archives = '"$1"/var/cache/apt/archives'
+        if self.debootstrap_tarball:
+            # The tarball holds the packages in var/cache/apt/archives,
+            # right where apt will look for them.
+            cmd += ['--setup-hook=tar -C "$1" -xf %s --wildcards "var/cache/apt/archives/*.deb"'
+                    % pipes.quote(os.path.abspath(self.debootstrap_tarball))]
+        if self.archives:
+            cmd += ['--skip=download/empty',
+                    '--setup-hook=mkdir -p %s && find %s -maxdepth 1 -name "*.deb" -exec cp {} %s/ \\;'
+                        % (archives, pipes.quote(self.archives), archives),
+                    '--customize-hook=find %s -maxdepth 1 -name "*.deb" -exec cp -n {} %s/ \\;'
+                        % (archives, pipes.quote(self.archives)),
+                    '--customize-hook=rm -f %s/*.deb' % archives]
+        cmd += [suite, target, mirror]
+        run_cmd(env=self.env(), *cmd)
+
+class Tarball(Bootstrapper):
+    """Unpack a pre-made root filesystem tarball"""
+    def bootstrap(self, suite, target, mirror):
+        if not self.tarball:
+            raise VMBuilderUserError('The tarball bootstrap backend needs --bootstrap-tarball')
+        logging.info('Unpacking %s into %s' % (self.tarball, target))
+        run_cmd('tar', '-C', target, '--numeric-owner', '--xattrs', '-xpf', self.tarball)
+
+backends = { 'debootstrap' : Debootstrap,
+             'mmdebstrap'  : Mmdebstrap,
+             'tarball'     : Tarball }
+
+def get_bootstrapper(backend, *args, **kwargs):
+    """Instantiate the bootstrap backend named backend"""
+    if backend not in backends:
+        raise VMBuilderUserError('Unknown bootstrap backend: %s' % backend)
+    return backends[backend](*args, **kwargs)
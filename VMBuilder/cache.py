@@ -0,0 +1,495 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Build caches
+
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import os.path
+import time
+from   VMBuilder.exception import VMBuilderUserError
+from   VMBuilder.util      import run_cmd, tmpdir, tmp_filename, unmount
+
+def fingerprint(inputs):
+    """
+    Compute a stable fingerprint of a set of build inputs.
+
+    @type  inputs: dict
+    @param inputs: Maps input names to their values. The order in which
+                   the keys were added does not matter.
+    @rtype:  string
+    @return: hex digest identifying the inputs
+    """
+    digest = hashlib.sha1()
+    for key in sorted(inputs.keys()):
+        digest.update('%s=%r\n' % (key, inputs[key]))
+    return digest.hexdigest()
+
+def file_fingerprint(filename):
+    """
+    Fingerprint the contents of a file that goes into a build, so that
+    the cache notices when it changes.
+
+    @rtype:  string
+    @return: hex digest of the file's contents, or None if filename is None
+    """
+    if filename is None:
+        return None
+    digest = hashlib.sha1()
+    fp = open(filename, 'rb')
+    try:
+        for block in iter(lambda: fp.read(65536), ''):
+            digest.update(block)
+    finally:
+        fp.close()
+    return digest.hexdigest()
+
+class Lock(object):
+    """
+    Exclusive advisory lock on a file, so that concurrent builds sharing
+    a cache directory don't step on each other's toes.
+
+    Use it as a context manager::
+
+        with Lock('/var/cache/vmbuilder/foo.lock'):
+            ...
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = None
+
+    def __enter__(self):
+        self.fp = open(self.filename, 'a')
+        logging.debug('Waiting for lock on %s' % self.filename)
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+        self.fp.close()
+        self.fp = None
+        return False
+
+class ChrootCache(object):
+    """
+    Content addressed cache of chroot layers.
+
+    A chroot is built up in layers (bootstrap, package installation, per-VM
+    configuration). Each layer is keyed on the L{fingerprint} of the inputs
+    that went into it, including the key of the layer below it, so a build
+    that only differs in its top layer can start from the shared layers
+    underneath.
+
+    This class keeps every layer as a complete copy of the chroot. See
+    L{OverlayChrootCache} and L{BtrfsChrootCache} for backends that share
+    the data between layers and between builds instead.
+
+    @type  cachedir: string
+    @param cachedir: Top level cache directory. Chroots are kept in its
+                     C{chroots} subdirectory.
+    """
+    def __init__(self, cachedir):
+        self.cachedir = os.path.join(os.path.abspath(cachedir), 'chroots')
+        # Maps chroot dirs to the key of the layer they currently hold
+        self.layers = {}
+
+    def entry_path(self, key):
+        return os.path.join(self.cachedir, key)
+
+    def has_entry(self, key):
+        return os.path.isdir(self.entry_path(key))
+
+    def populate(self, chroot_dir, inputs, build):
+        """
+        Bring chroot_dir to the layer matching inputs, using the cache if
+        possible. If there is no such layer, call build() to create it in
+        chroot_dir on top of what is there now and add the result to the
+        cache.
+
+        Builds with identical inputs are serialised, so that only one of
+        them ends up doing the actual work.
+
+        @type  inputs: dict
+        @param inputs: Inputs of the layer. The C{parent} item, if any,
+                       holds the key of the layer it goes on top of.
+        @rtype:  string
+        @return: key of the layer now in chroot_dir
+        """
+        key = fingerprint(inputs)
+        parent = inputs.get('parent')
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        with Lock('%s.lock' % self.entry_path(key)):
+            if self.has_entry(key):
+                logging.info('Using cached chroot layer %s' % key)
+                self.checkout(key, chroot_dir)
+                return key
+            logging.info('No cached chroot layer for %s, building one' % key)
+            if chroot_dir not in self.layers or self.layers[chroot_dir] != parent:
+                self.checkout(parent, chroot_dir)
+            build()
+            self.commit(key, chroot_dir)
+            return key
+
+    def checkout(self, key, chroot_dir):
+        """Make chroot_dir hold layer key (or nothing at all if key is None)"""
+        if key:
+            # With --in-place, chroot_dir is the guest's root filesystem,
+            # with the others mounted below it, and their lost+found dirs
+            # have to survive --delete
+            run_cmd('rsync', '-aHA', '--delete', '--filter=P lost+found/',
+                    '%s/' % self.entry_path(key), chroot_dir)
+        self.layers[chroot_dir] = key
+
+    def commit(self, key, chroot_dir):
+        """Add the contents of chroot_dir to the cache as layer key"""
+        logging.info('Storing chroot layer in cache as %s' % key)
+        tmp = tmpdir(suffix='.partial', tmp_root=self.cachedir)
+        try:
+            run_cmd('rsync', '-aHA', '--exclude=lost+found/', '%s/' % chroot_dir, tmp)
+            # rename() is atomic, so other builds never see half a chroot
+            os.rename(tmp, self.entry_path(key))
+        except:
+            run_cmd('rm', '-rf', '--one-file-system', tmp, ignore_fail=True)
+            raise
+        self.layers[chroot_dir] = key
+
+    def release(self, chroot_dir):
+        """Let go of whatever ties chroot_dir to the cache"""
+        self.layers.pop(chroot_dir, None)
+
+class OverlayChrootCache(ChrootCache):
+    """
+    Chroot cache that stores each layer as an overlayfs upper dir.
+
+    The chroot dir is an overlay mount with the cached layers as its lower
+    dirs and a private upper dir on top, so builds share the data of the
+    layers they have in common and a new layer only costs what it changes.
+    """
+    def __init__(self, cachedir):
+        super(OverlayChrootCache, self).__init__(cachedir)
+        # Maps chroot dirs to the private dir holding their upper and work dirs
+        self.mounts = {}
+
+    def lower_dirs(self, key):
+        """List the trees making up layer key, topmost first"""
+        dirs = []
+        while key:
+            dirs.append(os.path.join(self.entry_path(key), 'tree'))
+            parent_file = os.path.join(self.entry_path(key), 'parent')
+            if os.path.exists(parent_file):
+                key = open(parent_file).read().strip()
+            else:
+                key = None
+        return dirs
+
+    def checkout(self, key, chroot_dir):
+        self.release(chroot_dir)
+        private = tmpdir(suffix='.upper', tmp_root=self.cachedir)
+        os.mkdir(os.path.join(private, 'upper'))
+        os.mkdir(os.path.join(private, 'work'))
+        lower = self.lower_dirs(key)
+        if not lower:
+            # overlayfs needs at least one lower dir
+            os.mkdir(os.path.join(private, 'empty'))
+            lower = [os.path.join(private, 'empty')]
+        run_cmd('mount', '-t', 'overlay', 'overlay',
+                '-o', 'lowerdir=%s,upperdir=%s/upper,workdir=%s/work' % (':'.join(lower), private, private),
+                chroot_dir)
+        self.mounts[chroot_dir] = private
+        self.layers[chroot_dir] = key
+
+    def commit(self, key, chroot_dir):
+        logging.info('Storing chroot layer in cache as %s' % key)
+        private = self.mounts.pop(chroot_dir)
+        parent = self.layers.pop(chroot_dir)
+        unmount(chroot_dir)
+        tmp = tmpdir(suffix='.partial', tmp_root=self.cachedir)
+        try:
+            # The upper dir is exactly what this layer changed, whiteouts
+            # and all. It lives in the cache dir already, so just move it.
+            os.rename(os.path.join(private, 'upper'), os.path.join(tmp, 'tree'))
+            if parent:
+                fp = open(os.path.join(tmp, 'parent'), 'w')
+                fp.write(parent)
+                fp.close()
+            os.rename(tmp, self.entry_path(key))
+        except:
+            run_cmd('rm', '-rf', '--one-file-system', tmp, ignore_fail=True)
+            raise
+        finally:
+            run_cmd('rm', '-rf', '--one-file-system', private, ignore_fail=True)
+        self.checkout(key, chroot_dir)
+
+    def release(self, chroot_dir):
+        private = self.mounts.pop(chroot_dir, None)
+        if private:
+            unmount(chroot_dir)
+            run_cmd('rm', '-rf', '--one-file-system', private)
+        super(OverlayChrootCache, self).release(chroot_dir)
+
+class BtrfsChrootCache(ChrootCache):
+    """
+    Chroot cache that stores each layer as a read-only btrfs snapshot.
+
+    The chroot dir becomes a writable snapshot of the layer it is based on,
+    so the cache dir and the chroot dir must be on the same btrfs
+    filesystem.
+    """
+    def checkout(self, key, chroot_dir):
+        if chroot_dir in self.layers:
+            run_cmd('btrfs', 'subvolume', 'delete', chroot_dir)
+        else:
+            try:
+                os.rmdir(chroot_dir)
+            except OSError, e:
+                raise VMBuilderUserError('%s must be empty to use it with the btrfs chroot cache: %s' % (chroot_dir, e))
+        if key:
+            run_cmd('btrfs', 'subvolume', 'snapshot', self.entry_path(key), chroot_dir)
+        else:
+            run_cmd('btrfs', 'subvolume', 'create', chroot_dir)
+        self.layers[chroot_dir] = key
+
+    def commit(self, key, chroot_dir):
+        logging.info('Storing chroot layer in cache as %s' % key)
+        tmp = tmp_filename(suffix='.partial', tmp_root=self.cachedir)
+        run_cmd('btrfs', 'subvolume', 'snapshot', '-r', chroot_dir, tmp)
+        try:
+            os.rename(tmp, self.entry_path(key))
+        except:
+            run_cmd('btrfs', 'subvolume', 'delete', tmp, ignore_fail=True)
+            raise
+        self.layers[chroot_dir] = key
+
+    def release(self, chroot_dir):
+        if chroot_dir in self.layers:
+            run_cmd('btrfs', 'subvolume', 'delete', chroot_dir)
+            # Leave an empty dir behind, like we found it
+            os.mkdir(chroot_dir)
+        super(BtrfsChrootCache, self).release(chroot_dir)
+
+backends = { 'copy'      : ChrootCache,
+             'overlayfs' : OverlayChrootCache,
+             'btrfs'     : BtrfsChrootCache }
+
+def get_chroot_cache(cachedir, backend='copy'):
+    """Instantiate the chroot cache backend named backend"""
+    if backend not in backends:
+        raise VMBuilderUserError('Unknown chroot cache backend: %s' % backend)
+    return backends[backend](cachedir)
+
+class AptArchiveCache(object):
+    """
+    Host side pool of downloaded .deb files, shared between builds.
+
+    Every user of the pool gets a private archives dir, seeded with hard
+    links to the pool, so that apt's own locking and C{apt-get clean}
+    in one build don't get in the way of another. Whatever new packages
+    end up in the private dir are moved into the pool when it's checked
+    back in, after which the least recently used packages are evicted
+    until the pool fits in max_size.
+
+    @type  cachedir: string
+    @param cachedir: Top level cache directory. Packages are kept in its
+                     C{archives} subdirectory.
+    @type  max_size: int
+    @param max_size: Size limit of the pool in MB, or None for no limit
+    """
+    def __init__(self, cachedir, max_size=None):
+        self.cachedir = os.path.abspath(cachedir)
+        self.pooldir = os.path.join(self.cachedir, 'archives')
+        self.lockfile = os.path.join(self.cachedir, 'archives.lock')
+        self.max_size = max_size
+        # Maps chroot dirs to the private archives dir mounted in them
+        self.mounts = {}
+
+    def checkout(self):
+        """
+        Create a private archives dir seeded with the pool's contents
+
+        @rtype:  string
+        @return: path of the private archives dir
+        """
+        if not os.path.isdir(self.pooldir):
+            os.makedirs(self.pooldir)
+        private = tmpdir(suffix='.archives', tmp_root=self.cachedir)
+        os.mkdir(os.path.join(private, 'partial'))
+        with Lock(self.lockfile):
+            for deb in glob.glob(os.path.join(self.pooldir, '*.deb')):
+                os.link(deb, os.path.join(private, os.path.basename(deb)))
+        return private
+
+    def checkin(self, private):
+        """Move new packages from private into the pool and dispose of it"""
+        with Lock(self.lockfile):
+            for deb in glob.glob(os.path.join(private, '*.deb')):
+                target = os.path.join(self.pooldir, os.path.basename(deb))
+                if not os.path.exists(target):
+                    os.rename(deb, target)
+                    # apt sets the mtime from the server, so mark it as
+                    # fresh for the sake of eviction
+                    os.utime(target, None)
+            self.evict()
+        run_cmd('rm', '-rf', '--one-file-system', private)
+
+    def evict(self):
+        """Drop least recently used packages until the pool fits in max_size"""
+        if self.max_size is None:
+            return
+        debs = []
+        total = 0
+        for deb in glob.glob(os.path.join(self.pooldir, '*.deb')):
+            st = os.stat(deb)
+            debs.append((max(st.st_atime, st.st_mtime), st.st_size, deb))
+            total += st.st_size
+        debs.sort()
+        limit = self.max_size * 1024 * 1024
+        while debs and total > limit:
+            (_, size, deb) = debs.pop(0)
+            logging.debug('Evicting %s from the package cache' % deb)
+            os.unlink(deb)
+            total -= size
+
+    def mount(self, chroot_dir):
+        """Bind mount a private archives dir over chroot_dir's apt archives"""
+        private = self.checkout()
+        archives = '%s/var/cache/apt/archives' % chroot_dir
+        if not os.path.isdir(archives):
+            os.makedirs(archives)
+        run_cmd('mount', '--bind', private, archives)
+        self.mounts[chroot_dir] = private
+
+    def umount(self, chroot_dir):
+        """Undo L{mount} and add any packages apt downloaded to the pool"""
+        private = self.mounts.pop(chroot_dir)
+        unmount('%s/var/cache/apt/archives' % chroot_dir)
+        self.checkin(private)
+
+class AptListsCache(object):
+    """
+    Host side cache of apt's package indexes (/var/lib/apt/lists).
+
+    Entries are keyed on the L{fingerprint} of the rendered sources.list
+    (and anything else that affects which indexes apt fetches). Starting
+    C{apt-get update} from warm lists lets apt revalidate them with
+    If-Modified-Since and by-hash requests instead of downloading every
+    index again.
+
+    @type  cachedir: string
+    @param cachedir: Top level cache directory. Lists are kept in its
+                     C{lists} subdirectory.
+    """
+    def __init__(self, cachedir):
+        self.cachedir = os.path.join(os.path.abspath(cachedir), 'lists')
+
+    def entry_path(self, key):
+        return os.path.join(self.cachedir, key)
+
+    def restore(self, chroot_dir, inputs):
+        """Fill chroot_dir's lists from the cache, if there is a matching entry"""
+        key = fingerprint(inputs)
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        with Lock('%s.lock' % self.entry_path(key)):
+            if not os.path.isdir(self.entry_path(key)):
+                logging.debug('No cached package lists for %s' % key)
+                return False
+            logging.info('Using cached package lists %s' % key)
+            run_cmd('rsync', '-a', '--delete', '--exclude=/lock', '--exclude=/partial/',
+                    '%s/' % self.entry_path(key), '%s/var/lib/apt/lists/' % chroot_dir)
+            return True
+
+    def store(self, chroot_dir, inputs):
+        """Replace the cache entry for inputs with chroot_dir's lists"""
+        key = fingerprint(inputs)
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        tmp = tmpdir(suffix='.partial', tmp_root=self.cachedir)
+        try:
+            run_cmd('rsync', '-a', '--exclude=/lock', '--exclude=/partial/',
+                    '%s/var/lib/apt/lists/' % chroot_dir, tmp)
+            with Lock('%s.lock' % self.entry_path(key)):
+                old = None
+                if os.path.isdir(self.entry_path(key)):
+                    old = tmp_filename(suffix='.old', tmp_root=self.cachedir)
+                    os.rename(self.entry_path(key), old)
+                os.rename(tmp, self.entry_path(key))
+        except:
+            run_cmd('rm', '-rf', '--one-file-system', tmp, ignore_fail=True)
+            raise
+        if old:
+            run_cmd('rm', '-rf', '--one-file-system', old)
+
+class TarballCache(object):
+    """
+    Cache of package tarballs made by C{debootstrap --make-tarball}.
+
+    Entries are keyed on the L{fingerprint} of whatever determines the
+    tarball's contents (suite, arch, variant, mirror...) and are
+    regenerated once they are older than ttl days, so that builds don't
+    keep bootstrapping from packages that have long been superseded.
+
+    @type  cachedir: string
+    @param cachedir: Top level cache directory. Tarballs are kept in its
+                     C{tarballs} subdirectory.
+    @type  ttl: int
+    @param ttl: Maximum age of a tarball in days
+    """
+    def __init__(self, cachedir, ttl):
+        self.cachedir = os.path.join(os.path.abspath(cachedir), 'tarballs')
+        self.ttl = ttl
+
+    def entry_path(self, key):
+        # debootstrap --unpack-tarball goes by the extension
+        return os.path.join(self.cachedir, '%s.tgz' % key)
+
+    def is_fresh(self, key):
+        try:
+            age = time.time() - os.stat(self.entry_path(key)).st_mtime
+        except OSError:
+            return False
+        return age < self.ttl * 24 * 60 * 60
+
+    def get(self, inputs, make):
+        """
+        Find a fresh tarball matching inputs. If there is none, call
+        make(filename) to create one at filename and add it to the cache.
+
+        @rtype:  string
+        @return: path of the tarball
+        """
+        key = fingerprint(inputs)
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        with Lock('%s.lock' % self.entry_path(key)):
+            if self.is_fresh(key):
+                logging.info('Using cached debootstrap tarball %s' % key)
+                return self.entry_path(key)
+            logging.info('No fresh debootstrap tarball for %s, making one' % key)
+            tmp = tmp_filename(suffix='.partial', tmp_root=self.cachedir)
+            try:
+                make(tmp)
+                os.rename(tmp, self.entry_path(key))
+            except:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+            return self.entry_path(key)
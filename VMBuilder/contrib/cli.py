@@ -26,6 +26,7 @@ import tempfile
 import VMBuilder
 import VMBuilder.util as util
 from   VMBuilder.disk import parse_size
+from   VMBuilder.layout import disk_size, parse_part_file
 import VMBuilder.hypervisor
 from   VMBuilder.exception import VMBuilderUserError, VMBuilderException
 
@@ -34,6 +35,8 @@ class CLI(object):
 
     def main(self):
         tmpfs_mount_point = None
+        distro = None
+        keep_chroot = False
         try:
             optparser = optparse.OptionParser()
 
@@ -82,6 +85,11 @@ class CLI(object):
                              help="Build the chroot in directory.")
             group.add_option('--existing-chroot',
                              help="Use existing chroot.")
+            group.add_option('--in-place',
+                             action='store_true',
+                             help=("Build the chroot directly on the disk "
+                                   "images instead of copying it there "
+                                   "afterwards."))
             group.add_option('--tmp',
                              '-t',
                              metavar='DIR',
@@ -132,7 +140,13 @@ class CLI(object):
                                    "virtual disks, a new disk starts on a "
                                    "line containing only '---'. ie: \n    root "
                                    "2000 \n    /boot 512 \n    swap 1000 \n    "
-                                   "--- \n    /var 8000 \n    /var/log 2000"))
+                                   "--- \n    /var 8000 \n    /var/log 2000\n"
+                                   "Alternatively, each disk starts on a line "
+                                   "'disk [size=SIZE] [file=PATH] "
+                                   "[table=msdos|gpt]', followed by a line "
+                                   "'part mount=MNT size=SIZE|rest [fs=FS] "
+                                   "[start=OFFSET]' per partition. Partitions "
+                                   "without a start are placed automatically."))
             optparser.add_option_group(group)
 
             optparser.disable_interspersed_args()
@@ -199,10 +213,29 @@ class CLI(object):
                           hypervisor.get_setting_default(option) != val):
                         hypervisor.set_setting_fuzzy(option, val)
 
+            if self.options.in_place:
+                if (self.options.only_chroot or self.options.chroot_dir or
+                    self.options.existing_chroot or self.options.tmpfs):
+                    raise VMBuilderUserError('--in-place can not be used together with --only-chroot, --chroot-dir, --existing-chroot or --tmpfs.')
+                if (distro.has_setting('cache-backend') and distro.get_setting('cache-dir') and
+                    distro.get_setting('cache-backend') != 'copy'):
+                    raise VMBuilderUserError('--in-place only works with the copy cache backend.')
+
             chroot_dir = None
-            if self.options.existing_chroot:
+            if self.options.in_place:
+                # The disk layout depends on the suite, which the distro
+                # only works out during its preflight check.
+                distro.run_preflight_check()
+                self.set_disk_layout(optparser, hypervisor)
+                hypervisor.prepare_in_place()
+                try:
+                    distro.build_chroot()
+                except:
+                    hypervisor.cleanup()
+                    raise
+            elif self.options.existing_chroot:
                 distro.set_chroot_dir(self.options.existing_chroot)
-                distro.call_hooks('preflight_check')
+                distro.run_preflight_check()
             else:
                 if self.options.tmpfs is not None:
                     if str(self.options.tmpfs) == '-':
@@ -221,10 +254,13 @@ class CLI(object):
                 distro.build_chroot()
 
             if self.options.only_chroot:
+                keep_chroot = True
+                distro.call_hooks('run_deferred_triggers')
                 print 'Chroot can be found in %s' % distro.chroot_dir
                 sys.exit(0)
 
-            self.set_disk_layout(optparser, hypervisor)
+            if not self.options.in_place:
+                self.set_disk_layout(optparser, hypervisor)
             hypervisor.install_os()
 
             os.mkdir(destdir)
@@ -234,12 +270,17 @@ class CLI(object):
             # and if we reach here, it means the user didn't pass
             # --only-chroot. Hence, we need to remove it to clean
             # up after ourselves.
+            distro.release_chroot()
             if chroot_dir is not None and tmpfs_mount_point is None:
                 util.run_cmd('rm', '-rf', '--one-file-system', chroot_dir)
         except VMBuilderException, e:
             logging.error(e)
             raise
         finally:
+            # A chroot backed by a cache snapshot (e.g. an overlayfs mount)
+            # has to be let go of before anything else can be cleaned up.
+            if distro is not None and not keep_chroot:
+                distro.release_chroot()
             if tmpfs_mount_point is not None:
                 util.clean_up_tmpfs(tmpfs_mount_point)
                 util.run_cmd('rmdir', tmpfs_mount_point)
@@ -336,103 +377,99 @@ class CLI(object):
                         hypervisor.add_disk(filename=raw_disk)
                     disk = hypervisor.disks[0]
                 else:
-                    size = rootsize + swapsize + optsize
+                    sizes = [size for size in [rootsize, swapsize, optsize] if size > 0]
+                    size = self.fitting_size(hypervisor, { 'parts' : [{ 'size' : size } for size in sizes] })
                     tmpfile = util.tmp_filename(tmp_root=self.options.tmp_root)
                     disk = hypervisor.add_disk(tmpfile, size='%dM' % size)
-                offset = 0
-                disk.add_part(offset, rootsize, default_filesystem, '/')
-                offset += rootsize
+                disk.add_part(None, rootsize, default_filesystem, '/')
                 if swapsize > 0:
-                    disk.add_part(offset, swapsize, 'swap', 'swap')
-                    offset += swapsize
+                    disk.add_part(None, swapsize, 'swap', 'swap')
                 if optsize > 0:
-                    disk.add_part(offset, optsize, default_filesystem, '/opt')
+                    disk.add_part(None, optsize, default_filesystem, '/opt')
         else:
             # We need to parse the file specified
+            try:
+                disks = parse_part_file(file(self.options.part))
+            except IOError, (errno, strerror):
+                optparser.error("%s parsing --part option: %s" %
+                                (errno, strerror))
+
             if hypervisor.preferred_storage == VMBuilder.hypervisor.STORAGE_FS_IMAGE:
-                try:
-                    for line in file(self.options.part):
-                        elements = line.strip().split(' ')
-                        if len(elements) < 4:
-                                tmpfile = util.tmp_filename(tmp_root=self.options.tmp_root)
-                        else:
-                                tmpfile = elements[3]
-
-                        if elements[0] == 'root':
-                            hypervisor.add_filesystem(elements[1],
-                                                       default_filesystem,
-                                                       filename=tmpfile,
-                                                       mntpnt='/')
-                        elif elements[0] == 'swap':
-                            hypervisor.add_filesystem(elements[1],
-                                                      type='swap',
-                                                      filename=tmpfile,
-                                                      mntpnt=None)
-                        elif elements[0] == '---':
-                            # We just ignore the user's attempt to specify multiple disks
-                            pass
-                        elif len(elements) == 3:
-                            hypervisor.add_filesystem(elements[1],
-                                                      type=default_filesystem,
-                                                      filename=tmpfile,
-                                                      mntpnt=elements[0],
-                                                      devletter='',
-                                                      device=elements[2],
-                                                      dummy=(int(elements[1]) == 0))
-                        else:
-                            hypervisor.add_filesystem(elements[1],
-                                                      type=default_filesystem,
-                                                      filename=tmpfile,
-                                                      mntpnt=elements[0])
-                except IOError, (errno, strerror):
-                    optparser.error("%s parsing --part option: %s" %
-                                    (errno, strerror))
+                # We just ignore the user's attempt to specify multiple disks
+                for spec in disks:
+                    for part in spec['parts']:
+                        self.do_filesystem(hypervisor, part)
             else:
-                try:
-                    curdisk = list()
-                    size = 0
-                    disk_idx = 0
-                    for line in file(self.options.part):
-                        pair = line.strip().split(' ',1)
-                        if pair[0] == '---':
-                            self.do_disk(hypervisor, curdisk, size, disk_idx)
-                            curdisk = list()
-                            size = 0
-                            disk_idx += 1
-                        elif pair[0] != '':
-                            logging.debug("part: %s, size: %d" % (pair[0],
-                                          int(pair[1])))
-                            curdisk.append((pair[0], pair[1]))
-                            size += int(pair[1])
-
-                    self.do_disk(hypervisor, curdisk, size, disk_idx)
-
-                except IOError, (errno, strerror):
-                    optparser.error("%s parsing --part option: %s" %
-                                    (errno, strerror))
-
-    def do_disk(self, hypervisor, curdisk, size, disk_idx):
+                for (disk_idx, spec) in enumerate(disks):
+                    self.do_disk(hypervisor, spec, disk_idx)
+
+    def do_filesystem(self, hypervisor, part):
+        default_filesystem = hypervisor.distro.preferred_filesystem()
+
+        if part['size'] is None:
+            raise VMBuilderUserError('Filesystem images need a size, %s has none' % part['mntpnt'])
+        tmpfile = part.get('file') or util.tmp_filename(tmp_root=self.options.tmp_root)
+        if part['mntpnt'] == 'swap':
+            hypervisor.add_filesystem(part['size'],
+                                      type='swap',
+                                      filename=tmpfile,
+                                      mntpnt=None)
+        elif 'device' in part:
+            hypervisor.add_filesystem(part['size'],
+                                      type=part.get('fs', default_filesystem),
+                                      filename=tmpfile,
+                                      mntpnt=part['mntpnt'],
+                                      devletter='',
+                                      device=part['device'],
+                                      dummy=(part['size'] == 0))
+        else:
+            hypervisor.add_filesystem(part['size'],
+                                      type=part.get('fs', default_filesystem),
+                                      filename=tmpfile,
+                                      mntpnt=part['mntpnt'])
+
+    def do_disk(self, hypervisor, spec, disk_idx):
         default_filesystem = hypervisor.distro.preferred_filesystem()
 
-        if self.options.raw:
-            disk = hypervisor.add_disk(filename=self.options.raw[disk_idx])
+        kwargs = {}
+        if 'table' in spec:
+            kwargs['table_type'] = spec['table']
+        if 'file' in spec:
+            filename = spec['file']
+        elif self.options.raw:
+            filename = self.options.raw[disk_idx]
         else:
-            disk = hypervisor.add_disk(
-                util.tmp_filename(tmp_root=self.options.tmp_root),
-                size+1)
-
-        logging.debug("do_disk #%i - size: %d" % (disk_idx, size))
-        offset = 0
-        for pair in curdisk:
-            logging.debug("do_disk #%i - part: %s, size: %s, offset: %d" %
-                                           (disk_idx, pair[0], pair[1], offset))
-            if pair[0] == 'root':
-                disk.add_part(offset, int(pair[1]), default_filesystem, '/')
-            elif pair[0] == 'swap':
-                disk.add_part(offset, int(pair[1]), pair[0], pair[0])
+            filename = util.tmp_filename(tmp_root=self.options.tmp_root)
+
+        if not os.path.exists(filename):
+            size = spec.get('size')
+            if not size:
+                size = self.fitting_size(hypervisor, spec)
+            kwargs['size'] = size
+        disk = hypervisor.add_disk(filename, **kwargs)
+
+        logging.debug("do_disk #%i - size: %d" % (disk_idx, disk.size))
+        for part in spec['parts']:
+            logging.debug("do_disk #%i - part: %s, size: %s, start: %s" %
+                          (disk_idx, part['mntpnt'], part['size'], part.get('start')))
+            if part['mntpnt'] == 'swap':
+                type = 'swap'
             else:
-                disk.add_part(offset, int(pair[1]), default_filesystem, pair[0])
-            offset += int(pair[1])
+                type = part.get('fs', default_filesystem)
+            disk.add_part(part.get('start'), part['size'], type, part['mntpnt'])
+
+    def fitting_size(self, hypervisor, spec):
+        """Size (in MB) of a disk just big enough for the partitions in spec"""
+        alignment = hypervisor.get_setting('partition-alignment') * 2
+        table = spec.get('table', hypervisor.get_setting('partition-table') == 'gpt' and 'gpt' or 'msdos')
+        sizes = [part['size'] for part in spec['parts']]
+        if None in sizes:
+            raise VMBuilderUserError('A partition takes the rest of a new disk, so the disk needs a size')
+        size = disk_size(sizes, alignment, table)
+        for part in spec['parts']:
+            if part.get('start') is not None:
+                size = max(size, disk_size([part['start'] + part['size']], alignment, table))
+        return size
 
 class UVB(CLI):
     arg = 'ubuntu-vm-builder'
@@ -18,17 +18,24 @@
 #
 #    Virtual disk management
 
-import fcntl
+import bisect
 import logging
 import os
 import os.path
 import re
 import stat
 import string
-import time
-from   VMBuilder.util      import run_cmd 
+import subprocess
+import uuid
+import VMBuilder.imageinfo as imageinfo
+import VMBuilder.imagewriter as imagewriter
+import VMBuilder.loop
+import VMBuilder.nbd
+import VMBuilder.partitiontable as partitiontable
+from   VMBuilder.artifact  import place_artifact
+from   VMBuilder.layout    import Layout
+from   VMBuilder.util      import run_cmd, tmpdir, wait_for, retry, has_holders, unmount
 from   VMBuilder.exception import VMBuilderUserError, VMBuilderException
-from   struct              import unpack
 
 TYPE_EXT2 = 0
 TYPE_EXT3 = 1
@@ -49,9 +56,16 @@ class Disk(object):
         L{parse_size}). If specified and filename already exists,
         L{VMBuilderUserError} will be raised. Otherwise, a disk image of
         this size will be created once L{create}() is called.
+    @type  alignment: number
+    @param alignment: Partitions start on multiples of this many sectors
+    @type  table_type: string
+    @param table_type: The type of partition table: 'msdos' or 'gpt'
+    @type  format: string
+    @param format: The format to create the disk image in. Anything but
+        raw gets built through qemu-nbd.
     """
     
-    def __init__(self, vm, filename, size=None):
+    def __init__(self, vm, filename, size=None, alignment=partitiontable.ALIGNMENT, table_type='msdos', format='raw'):
         self.vm = vm
         "The hypervisor to which the disk belongs."
 
@@ -80,6 +94,30 @@ class Disk(object):
         self.format_type = None
         "The format type of the disks. Only used for converted disks."
 
+        self.mapper = None
+        "How the partitions got mapped (see L{map_partitions})."
+
+        self.table_type = table_type
+        "The type of partition table on the disk."
+
+        self.layout = Layout(self.size * 2048, alignment, table_type)
+        "Where the partitions go on the disk."
+
+        self.format = format
+        "The format the disk image is created in."
+
+        self.device = None
+        "The nbd device the disk image is exposed through while it's built, unless it's raw."
+
+    def path(self):
+        """
+        @rtype:  string
+        @return: What to partition, map and install the bootloader on: the
+                 nbd device the image is exposed through, or else the
+                 image itself
+        """
+        return self.device or self.filename
+
     def devletters(self):
         """
         @rtype: string
@@ -89,34 +127,90 @@ class Disk(object):
 
         return index_to_devname(self.vm.disks.index(self))
 
-    def create(self):
+    def create(self, options=None):
         """
         Creates the disk image (if it doesn't already exist).
 
         Once this method returns succesfully, L{filename} can be
         expected to points to point to whatever holds the virtual disk
-        (be it a file, partition, logical volume, etc.).
+        (be it a file, partition, logical volume, etc.), and L{path}
+        to something that can be partitioned.
+
+        @type  options: dict
+        @param options: qemu-img options for images that aren't raw (see
+                        L{qemu_img_convert_args})
         """
         if not os.path.exists(self.filename):
-            logging.info('Creating disk image: "%s" of size: %dMB' % (self.filename, self.size))
-            run_cmd(qemu_img_path(), 'create', '-f', 'raw', self.filename, '%dM' % self.size)
-
-    def partition(self):
+            logging.info('Creating disk image: "%s" of size: %dMB, format %s' % (self.filename, self.size, self.format))
+            create_opts = qemu_img_create_opts(self.format, options or {})
+            if create_opts:
+                create_opts = ['-o', ','.join(create_opts)]
+            run_cmd(*([qemu_img_path(), 'create', '-f', self.format] + create_opts + [self.filename, '%dM' % self.size]))
+            if self.format != 'raw':
+                self.device = VMBuilder.nbd.connect(self.filename, self.format)
+                self.disconnect_cb = lambda: VMBuilder.nbd.disconnect(self.device, ignore_fail=True)
+                self.vm.add_clean_cb(self.disconnect_cb)
+
+    def disconnect(self):
+        """Flush the disk image and let go of its nbd device, if it has one"""
+        if not self.device:
+            return
+        VMBuilder.nbd.disconnect(self.device)
+        self.vm.cancel_cleanup(self.disconnect_cb)
+        self.device = None
+
+    def partition(self, table='parted'):
         """
         Partitions the disk image. First adds a partition table and then
         adds the individual partitions.
 
         Should only be called once and only after you've added all partitions.
+
+        @type  table: string
+        @param table: 'parted' to have parted make the partition table,
+                      anything else to write it directly. GPT tables are
+                      always written directly.
         """
 
         logging.info('Adding partition table to disk image: %s' % self.filename)
-        run_cmd('parted', '--script', self.filename, 'mklabel', 'msdos')
+        if table != 'parted' or self.table_type == 'gpt':
+            entries = self.table_entries()
+            bootcode = partitiontable.read_bootcode(self.path())
+            if self.table_type == 'gpt':
+                writes = partitiontable.gpt(self.size * 2048, entries, bootcode)
+            else:
+                writes = partitiontable.mbr(self.size * 2048, entries, bootcode, self.layout.alignment)
+            partitiontable.write(self.path(), writes)
+            return
+
+        run_cmd('parted', '--script', self.path(), 'mklabel', 'msdos')
 
         # Partition the disk 
         for part in self.partitions:
             part.create(self)
 
-    def map_partitions(self):
+    def table_entries(self):
+        """
+        The partitions as they go in the partition table. Logical
+        partitions give up their first aligned block to the EBR in front
+        of them.
+
+        @rtype:  list
+        @return: (type, start, sectors) tuples as taken by
+                 L{partitiontable.mbr} and L{partitiontable.gpt}
+        """
+        entries = []
+        for part in self.partitions:
+            (start, sectors) = (part.start_sector, part.sectors)
+            if part.is_logical():
+                start += self.layout.alignment
+                sectors -= self.layout.alignment
+                if sectors <= 0:
+                    raise VMBuilderUserError('Partition %s is too small to be a logical partition' % part.get_suffix())
+            entries.append((part.type == TYPE_SWAP and 'swap' or 'linux', start, sectors))
+        return entries
+
+    def map_partitions(self, mapper='kpartx'):
         """
         Create loop devices corresponding to the partitions.
 
@@ -124,10 +218,19 @@ class Disk(object):
         is set as its L{filename<Disk.Partition.filename>} attribute.
 
         Call this after L{partition}.
+
+        @type  mapper: string
+        @param mapper: 'kpartx' to go through device-mapper, 'loop' to
+                       set up a plain loop device per partition
         """
         logging.info('Creating loop devices corresponding to the created partitions')
+        self.mapper = mapper
         self.vm.add_clean_cb(lambda : self.unmap(ignore_fail=True))
-        kpartx_output = run_cmd('kpartx', '-asv', self.filename)
+        if mapper == 'loop':
+            for (part, (type, start, sectors)) in zip(self.partitions, self.table_entries()):
+                part.set_filename(VMBuilder.loop.attach(self.path(), start * 512, sectors * 512))
+            return
+        kpartx_output = run_cmd('kpartx', '-asv', self.path())
         parts = []
         for line in kpartx_output.split('\n'):
             if line == "" or line.startswith("gpt:") or line.startswith("dos:"):
@@ -136,19 +239,26 @@ class Disk(object):
                 parts.append(line)
                 continue
             logging.error('Skipping unknown line in kpartx output (%s)' % line)
-        mapdevs = []
+        # Map devices are named after the partition numbers, which skip
+        # the extended partition if there is one
+        mapdevs = {}
         for line in parts:
-            mapdevs.append(line.split(' ')[2])
-        for (part, mapdev) in zip(self.partitions, mapdevs):
-            part.set_filename('/dev/mapper/%s' % mapdev)
+            mapdev = line.split(' ')[2]
+            mapdevs[int(re.search('(\d+)$', mapdev).group(1))] = mapdev
+        for part in self.partitions:
+            part.set_filename('/dev/mapper/%s' % mapdevs[part.get_number()])
+            wait_for(lambda: os.path.exists(part.filename), 'device node %s' % part.filename)
 
-    def mkfs(self):
+    def mkfs(self, source=None):
         """
         Creates the partitions' filesystems
+
+        @type  source: string
+        @param source: Tree to fill the filesystems with (see L{Filesystem.mkfs})
         """
         logging.info("Creating file systems")
         for part in self.partitions:
-            part.mkfs()
+            part.mkfs(source)
 
     def get_grub_id(self):
         """
@@ -170,24 +280,26 @@ class Disk(object):
 
         Unsets L{Partition}s' and L{Filesystem}s' filename attribute
         """
-        # first sleep to give the loopback devices a chance to settle down
-        time.sleep(3)
-
-        tries = 0
-        max_tries = 3
-        while tries < max_tries:
-            try:
-                run_cmd('kpartx', '-d', self.filename, ignore_fail=False)
-                break
-            except:
-                pass
-            tries += 1
-            time.sleep(3)
-
-            if tries >= max_tries:
-                # try it one last time
-                logging.info("Could not unmap '%s' after '%d' attempts. Final attempt" % (self.filename, tries))
-        run_cmd('kpartx', '-d', self.filename, ignore_fail=ignore_fail)
+        if self.mapper == 'loop':
+            for part in self.partitions:
+                if part.filename:
+                    VMBuilder.loop.detach(part.filename, ignore_fail=ignore_fail)
+                    part.set_filename(None)
+            return
+
+        # The maps stay busy until everything on top of them is gone
+        for part in self.partitions:
+            if part.filename and os.path.exists(part.filename):
+                try:
+                    wait_for(lambda: not has_holders(part.filename), '%s to be released' % part.filename)
+                except VMBuilderException:
+                    if not ignore_fail:
+                        raise
+        try:
+            retry(lambda: run_cmd('kpartx', '-d', self.path()), 'Removing partition maps of %s' % self.filename)
+        except VMBuilderException:
+            if not ignore_fail:
+                raise
 
         for part in self.partitions:
             logging.debug("Removing partition %s" % part.filename)
@@ -204,30 +316,35 @@ class Disk(object):
         Add a partition to the disk
 
         @type  begin: number
-        @param begin: Start offset of the new partition (in megabytes)
+        @param begin: Start offset of the new partition (in megabytes),
+                      rounded up to the disk's alignment. If None, the
+                      partition goes in the first place it fits.
         @type  length: 
-        @param length: Size of the new partition (in megabytes)
+        @param length: Size of the new partition (in megabytes). If None,
+                       the partition takes the rest of the disk.
         @type  type: string
         @param type: Type of the new partition. Valid options are: ext2 ext3 xfs swap linux-swap
         @type  mntpnt: string
         @param mntpnt: Intended mountpoint inside the guest of the new partition
+        @rtype:  L{Partition}
+        @return: The new partition
         """
-        length = parse_size(length)
-        end = begin+length-1
-        logging.debug("add_part - begin %d, length %d, end %d, type %s, mntpnt %s" % (begin, length, end, type, mntpnt))
-        for part in self.partitions:
-            if (begin >= part.begin and begin <= part.end) or \
-                (end >= part.begin and end <= part.end):
-                raise VMBuilderUserError('Partitions are overlapping')
-        if begin < 0 or end > self.size:
-            raise VMBuilderUserError('Partition is out of bounds. start=%d, end=%d, disksize=%d' % (begin,end,self.size))
-        part = self.Partition(disk=self, begin=begin, end=end, type=str_to_type(type), mntpnt=mntpnt)
-        self.partitions.append(part)
+        if length is None:
+            sectors = self.layout.rest()
+        else:
+            sectors = parse_size(length) * 2048
+        if begin is not None:
+            begin = parse_size(begin) * 2048
+        start = self.layout.place(sectors, begin)
+        logging.debug("add_part - start %d, sectors %d, type %s, mntpnt %s" % (start, sectors, type, mntpnt))
+        part = self.Partition(disk=self, start_sector=start, sectors=sectors, type=str_to_type(type), mntpnt=mntpnt)
 
         # We always keep the partitions in order, so that the output from kpartx matches our understanding
-        self.partitions.sort(cmp=lambda x,y: x.begin - y.begin)
+        index = bisect.bisect([p.start_sector for p in self.partitions], start)
+        self.partitions.insert(index, part)
+        return part
 
-    def convert(self, destdir, format):
+    def convert(self, destdir, format, options=None):
         """
         Convert the disk image
 
@@ -235,6 +352,11 @@ class Disk(object):
         @param destdir: Target location of converted disk image
         @type  format: string
         @param format: The target format (as understood by qemu-img or vdi)
+        @type  options: dict
+        @param options: How qemu-img should go about it (see
+                        L{qemu_img_convert_args}). With 'native' set, raw
+                        images are written out as VDI and VMDK by
+                        L{VMBuilder.imagewriter} instead.
         @rtype:  string
         @return: the name of the converted image
         """
@@ -242,31 +364,49 @@ class Disk(object):
             # We don't convert preallocated disk images. That would be silly.
             return self.filename
 
+        self.disconnect()
         filename = os.path.basename(self.filename)
         if '.' in filename:
             filename = filename[:filename.rindex('.')]
         destfile = '%s/%s.%s' % (destdir, filename, format)
 
+        if format == self.format:
+            # Built in the right format already
+            place_artifact(self.filename, destfile)
+            self.filename = os.path.abspath(destfile)
+            self.format_type = format
+            return destfile
+
+        options = options or {}
         logging.info('Converting %s to %s, format %s' % (self.filename, format, destfile))
-        if format == 'vdi':
+        if self.format == 'raw' and format in imagewriter.FORMATS and options.get('native'):
+            imagewriter.write_image(self.filename, destfile, format, options)
+        elif format == 'vdi' and self.format == 'raw':
             run_cmd(vbox_manager_path(), 'convertfromraw', '-format', 'VDI', self.filename, destfile)
         else:
-            run_cmd(qemu_img_path(), 'convert', '-O', format, self.filename, destfile)
+            run_cmd(*([qemu_img_path(), 'convert'] + qemu_img_convert_args(format, options) +
+                      [self.filename, destfile]))
         os.unlink(self.filename)
         self.filename = os.path.abspath(destfile)
         self.format_type = format
         return destfile
 
     class Partition(object):
-        def __init__(self, disk, begin, end, type, mntpnt):
+        def __init__(self, disk, start_sector, sectors, type, mntpnt):
             self.disk = disk
             "The disk on which this Partition resides."
 
-            self.begin = begin
-            "The start of the partition"
+            self.start_sector = start_sector
+            "The first sector of the partition"
 
-            self.end = end
-            "The end of the partition"
+            self.sectors = sectors
+            "The size of the partition in sectors"
+
+            self.begin = start_sector / 2048
+            "The start of the partition (in megabytes)"
+
+            self.end = (start_sector + sectors) / 2048 - 1
+            "The end of the partition (in megabytes)"
 
             self.type = type
             "The partition type"
@@ -294,30 +434,36 @@ class Disk(object):
         def create(self, disk):
             """Adds partition to the disk image (does not mkfs or anything like that)"""
             logging.info('Adding type %d partition to disk image: %s' % (self.type, disk.filename))
-	    if self.begin == 0:
-		logging.info('Partition at beginning of disk - reserving first cylinder')
-		partition_start = "63s"
-	    else:
-	    	partition_start = self.begin
-            run_cmd('parted', '--script', '--', disk.filename, 'mkpart', 'primary', self.parted_fstype(), partition_start, self.end)
-
-        def mkfs(self):
+            run_cmd('parted', '--script', '--', disk.path(), 'mkpart', 'primary', self.parted_fstype(),
+                    '%ds' % self.start_sector, '%ds' % (self.start_sector + self.sectors - 1))
+
+        def mkfs(self, source=None):
             """Adds Filesystem object"""
-            self.fs.mkfs()
+            self.fs.mkfs(source)
 
         def get_grub_id(self):
             """The name of the partition as known by grub"""
-            return '(hd%d,%d)' % (self.disk.get_index(), self.get_index())
+            return '(hd%d,%d)' % (self.disk.get_index(), self.get_number() - 1)
 
         def get_suffix(self):
             """Returns 'a4' for a device that would be called /dev/sda4 in the guest. 
                This allows other parts of VMBuilder to set the prefix to something suitable."""
-            return '%s%d' % (self.disk.devletters(), self.get_index() + 1)
+            return '%s%d' % (self.disk.devletters(), self.get_number())
 
         def get_index(self):
             """Index of the disk (starting from 0)"""
             return self.disk.partitions.index(self)
 
+        def is_logical(self):
+            """Whether this is a logical partition (the fourth or later of more than four in an msdos table)"""
+            return self.disk.table_type == 'msdos' and len(self.disk.partitions) > 4 and self.get_index() >= 3
+
+        def get_number(self):
+            """The partition number (starting from 1, logical partitions from 5)"""
+            if self.is_logical():
+                return self.get_index() + 2
+            return self.get_index() + 1
+
         def set_type(self, type):
             try:
                 if int(type) == type:
@@ -343,7 +489,13 @@ class Filesystem(object):
         self.preallocated = False
         "Whether the file existed already (True if it did, False if we had to create it)."
 
-    def create(self):
+        self.uuid = None
+        "The UUID of the filesystem. L{mkfs} makes the filesystem with this UUID, and comes up with one if it's not set by then."
+
+        self.populated = False
+        "Whether L{mkfs} filled the filesystem with its part of the guest's tree."
+
+    def create(self, source=None):
         logging.info('Creating filesystem: %s, size: %d, dummy: %s' % (self.mntpnt, self.size, repr(self.dummy)))
         if not os.path.exists(self.filename):
             logging.info('Not preallocated, so we create it.')
@@ -364,20 +516,100 @@ class Filesystem(object):
                 self.filename += '.img'
                 logging.info('A name wasn\'t specified either, so we make one up: %s' % self.filename)
             run_cmd(qemu_img_path(), 'create', '-f', 'raw', self.filename, '%dM' % self.size)
-        self.mkfs()
+        self.mkfs(source)
 
-    def mkfs(self):
+    def mkfs(self, source=None):
+        """
+        Creates the filesystem.
+
+        @type  source: string
+        @param source: The guest's tree. If given, the filesystem is filled
+                       with the part of it below L{mntpnt} as it is made,
+                       instead of having it copied in once mounted.
+                       L{populated} tells whether that worked out; it
+                       only does for ext2/3/4, and not with mke2fs older
+                       than 1.43.
+        """
         if not self.filename:
             raise VMBuilderException('We can\'t mkfs if filename is not set. Did you forget to call .create()?')
         if not self.dummy:
-            cmd = self.mkfs_fstype() + [self.filename]
-            run_cmd(*cmd)
-            # Let udev have a chance to extract the UUID for us
-            run_cmd('udevadm', 'settle')
-            if os.path.exists("/sbin/vol_id"):
-                self.uuid = run_cmd('vol_id', '--uuid', self.filename).rstrip()
-            elif os.path.exists("/sbin/blkid"):
-                self.uuid = run_cmd('blkid', '-c', '/dev/null', '-sUUID', '-ovalue', self.filename).rstrip()
+            if not self.uuid:
+                self.uuid = str(uuid.uuid4())
+            self.populated = False
+            if source and self.type in [TYPE_EXT2, TYPE_EXT3, TYPE_EXT4]:
+                self.populated = self.mkfs_populated(source)
+            if not self.populated:
+                cmd = self.mkfs_fstype() + self.mkfs_uuid_args() + [self.filename]
+                run_cmd(*cmd)
+            # Cheap enough to make sure mkfs took the UUID fstab and grub
+            # refer to (with --populate-at-mkfs, fstab is already written)
+            info = imageinfo.filesystem_info(self.filename)
+            if info and info.uuid != self.uuid:
+                raise VMBuilderException('%s got UUID %s instead of %s' % (self.filename, info.uuid, self.uuid))
+
+    def mkfs_uuid_args(self):
+        if not self.uuid:
+            return []
+        if self.type == TYPE_XFS:
+            return ['-m', 'uuid=%s' % self.uuid]
+        return ['-U', self.uuid]
+
+    def nested_mntpnts(self):
+        """
+        @rtype:  list
+        @return: mountpoints of the other filesystems that get mounted
+                 below this one, relative to this one's mountpoint
+        """
+        prefix = self.mntpnt.rstrip('/') + '/'
+        return [fs.mntpnt[len(prefix):] for fs in get_ordered_filesystems(self.vm)
+                if fs is not self and fs.mntpnt and fs.mntpnt.startswith(prefix)]
+
+    def mkfs_populated(self, source):
+        """
+        Make the filesystem straight from source (see L{mkfs}).
+
+        @rtype:  boolean
+        @return: whether the filesystem got made
+        """
+        subtree = os.path.join(source, self.mntpnt.lstrip('/'))
+        if not os.path.isdir(subtree):
+            logging.debug('%s is not in the tree, nothing to fill %s with' % (self.mntpnt, self.filename))
+            run_cmd(*(self.mkfs_fstype() + self.mkfs_uuid_args() + [self.filename]))
+            return True
+        nested = self.nested_mntpnts()
+
+        if not mke2fs_can_populate():
+            logging.info('mke2fs is too old to fill filesystems, %s will be copied onto the filesystem instead' % self.mntpnt)
+            return False
+        cmd = self.mkfs_fstype() + self.mkfs_uuid_args()
+        logging.info('Creating %s filled from %s' % (self.filename, subtree))
+        if not nested:
+            run_cmd(*(cmd + ['-d', subtree, self.filename]))
+            return True
+
+        # mke2fs can't leave anything out, so give it a view of the subtree
+        # with empty directories over the other filesystems' mountpoints.
+        # A non-recursive bind mount doesn't carry anything mounted in the
+        # tree along either.
+        view = tmpdir()
+        empty = tmpdir()
+        os.chmod(empty, 0755)
+        mounts = []
+        try:
+            run_cmd('mount', '--bind', subtree, view)
+            mounts.append(view)
+            for mntpnt in nested:
+                path = os.path.join(view, mntpnt)
+                if os.path.isdir(path):
+                    run_cmd('mount', '--bind', empty, path)
+                    mounts.append(path)
+            run_cmd(*(cmd + ['-d', view, self.filename]))
+        finally:
+            for path in reversed(mounts):
+                unmount(path)
+            os.rmdir(view)
+            os.rmdir(empty)
+        return True
 
     def mkfs_fstype(self):
         map = { TYPE_EXT2: ['mkfs.ext2', '-F'], TYPE_EXT3: ['mkfs.ext3', '-F'], TYPE_EXT4: ['mkfs.ext4', '-F'], TYPE_XFS: ['mkfs.xfs'], TYPE_SWAP: ['mkswap'] }
@@ -406,7 +638,7 @@ class Filesystem(object):
         self.vm.cancel_cleanup(self.umount)
         if (self.type != TYPE_SWAP) and not self.dummy:
             logging.debug('Unmounting %s', self.mntpath) 
-            run_cmd('umount', self.mntpath)
+            unmount(self.mntpath)
 
     def get_suffix(self):
         """Returns 'a4' for a device that would be called /dev/sda4 in the guest..
@@ -437,6 +669,15 @@ class Filesystem(object):
         except ValueError:
             self.type = str_to_type(type)
 
+def mke2fs_can_populate():
+    """Whether mke2fs is new enough (1.43) to fill filesystems with -d"""
+    try:
+        proc = subprocess.Popen(['mke2fs', '-V'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError:
+        return False
+    match = re.search('mke2fs (\d+)\.(\d+)', proc.communicate()[0])
+    return bool(match) and (int(match.group(1)), int(match.group(2))) >= (1, 43)
+
 def parse_size(size_str):
     """Takes a size like qemu-img would accept it and returns the size in MB"""
     try:
@@ -524,18 +765,79 @@ def index_to_devname(index, suffix=''):
     return index_to_devname(index / 26 -1, string.ascii_lowercase[index % 26]) + suffix
 
 def detect_size(filename):
-    st = os.stat(filename)
-    if stat.S_ISREG(st.st_mode):
-        return st.st_size / 1024*1024
-    elif stat.S_ISBLK(st.st_mode): 
-        # I really wish someone would make these available in Python
-        BLKGETSIZE64 = 2148012658
-        fp = open(filename, 'r')
-        fd = fp.fileno()
-        s = fcntl.ioctl(fd, BLKGETSIZE64, ' '*8)
-        return unpack('L', s)[0] / 1024*1024
-
-    raise VMBuilderException('No idea how to find the size of %s' % filename)
+    """Size (in MB) of a disk image or block device"""
+    return imageinfo.image_size(filename) / 1024 / 1024
+
+# qemu-img convert won't run more coroutines than this
+QEMU_IMG_MAX_COROUTINES = 16
+
+_qemu_img_version = None
+
+def qemu_img_version():
+    """(major, minor) version of qemu-img, or (0, 0) if it doesn't say"""
+    global _qemu_img_version
+    if _qemu_img_version is None:
+        output = run_cmd(qemu_img_path(), '--version', ignore_fail=True)
+        match = re.search('version (\d+)\.(\d+)', output)
+        _qemu_img_version = match and (int(match.group(1)), int(match.group(2))) or (0, 0)
+    return _qemu_img_version
+
+def qemu_img_convert_args(format, options):
+    """
+    Work out the qemu-img convert arguments for converting to format.
+
+    @type  options: dict
+    @param options: Any of 'coroutines' (number of parallel coroutines),
+                    'out-of-order' (allow out of order writes),
+                    'compression' ('none', 'zlib' or 'zstd'),
+                    'cluster-size', 'preallocation' ('off' or 'metadata')
+                    and 'lazy-refcounts'. Those that don't apply to
+                    format, or that qemu-img is too old for, are left out.
+    @rtype:  list
+    """
+    args = ['-O', format]
+    version = qemu_img_version()
+    compression = options.get('compression') or 'none'
+    create_opts = qemu_img_create_opts(format, options)
+    if options.get('coroutines') and version >= (2, 9):
+        args += ['-m', str(min(options['coroutines'], QEMU_IMG_MAX_COROUTINES))]
+    # qemu-img can only compress when writing in order
+    if options.get('out-of-order') and compression == 'none' and version >= (2, 9):
+        args += ['-W']
+
+    if compression != 'none':
+        if format == 'qcow2':
+            args += ['-c']
+            if compression != 'zlib' or version >= (5, 1):
+                create_opts += ['compression_type=%s' % compression]
+        elif format == 'vmdk':
+            if compression != 'zlib':
+                raise VMBuilderUserError('VMDK images can only be compressed with zlib')
+            args += ['-c']
+            create_opts += ['subformat=streamOptimized']
+        else:
+            raise VMBuilderUserError('%s images can not be compressed' % format)
+    if create_opts:
+        args += ['-o', ','.join(create_opts)]
+    return args
+
+def qemu_img_create_opts(format, options):
+    """
+    The -o options (without the -o) that options (as taken by
+    L{qemu_img_convert_args}) translate to when creating an image
+    in format. Compression only happens when converting, so it's left
+    out, apart from ruling out preallocation.
+    """
+    create_opts = []
+    if format == 'qcow2':
+        if options.get('cluster-size'):
+            create_opts += ['cluster_size=%s' % options['cluster-size']]
+        # Compressed clusters can't go where preallocation put them
+        if options.get('preallocation') and (options.get('compression') or 'none') == 'none':
+            create_opts += ['preallocation=%s' % options['preallocation']]
+        if options.get('lazy-refcounts'):
+            create_opts += ['lazy_refcounts=on']
+    return create_opts
 
 def qemu_img_path():
     exes = ['kvm-img', 'qemu-img']
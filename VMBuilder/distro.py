@@ -20,6 +20,7 @@
 
 import logging
 import os
+import threading
 
 from   VMBuilder.util    import run_cmd, call_hooks
 import VMBuilder.plugins
@@ -31,20 +32,29 @@ class Context(VMBuilder.plugins.Plugin):
         self.plugins = [plugin_class(self) for plugin_class in self.plugin_classes]
         self.plugins.sort(key=lambda x:x.priority)
         self._cleanup_cbs = []
+        self._cleanup_lock = threading.Lock()
         self.hooks = {}
         self.template_dirs = [os.path.expanduser('~/.vmbuilder/%s'),
                               os.path.dirname(__file__) + '/plugins/%s/templates',
                               '/etc/vmbuilder/%s']
         self.overwrite = False
+        # Command (e.g. eatmydata) to run commands in the target through
+        self.target_wrapper = []
 
     # Cleanup 
     def cleanup(self):
         logging.info("Cleaning up")
-        while len(self._cleanup_cbs) > 0:
-            self._cleanup_cbs.pop(0)()
+        while True:
+            with self._cleanup_lock:
+                if not self._cleanup_cbs:
+                    break
+                cb = self._cleanup_cbs.pop(0)
+            cb()
 
     def add_clean_cb(self, cb):
-        self._cleanup_cbs.insert(0, cb)
+        # Disks and filesystems get set up from several threads at once
+        with self._cleanup_lock:
+            self._cleanup_cbs.insert(0, cb)
 
     def add_clean_cmd(self, *argv, **kwargs):
         cb = lambda : run_cmd(*argv, **kwargs)
@@ -52,11 +62,12 @@ class Context(VMBuilder.plugins.Plugin):
         return cb
 
     def cancel_cleanup(self, cb):
-        try:
-            self._cleanup_cbs.remove(cb)
-        except ValueError:
-            # Wasn't in there. No worries.
-            pass
+        with self._cleanup_lock:
+            try:
+                self._cleanup_cbs.remove(cb)
+            except ValueError:
+                # Wasn't in there. No worries.
+                pass
 
     # Hooks
     def register_hook(self, hook_name, func):
@@ -73,17 +84,55 @@ class Distro(Context):
     def __init__(self):
         self.plugin_classes = VMBuilder._distro_plugins
         super(Distro, self).__init__()
+        self.chroot_cache = None
+        self.chroot_layer = None
+        self.preflight_checked = False
 
     def set_chroot_dir(self, chroot_dir):
         self.chroot_dir = chroot_dir 
 
-    def build_chroot(self):
+    def run_preflight_check(self):
+        """Run the preflight_check hooks, unless they've run already"""
+        if self.preflight_checked:
+            return
         self.call_hooks('preflight_check')
+        self.preflight_checked = True
+
+    def build_chroot(self):
+        self.run_preflight_check()
         self.call_hooks('set_defaults')
         self.call_hooks('bootstrap')
         self.call_hooks('configure_os')
 	self.cleanup()
         
+    def build_layer(self, inputs, build):
+        """
+        Run build() to take the chroot one step further, or reuse a cached
+        result of having done so with the same inputs before.
+
+        Layers stack: each one is keyed on its own inputs and the layer it
+        was built on top of, so changing an input invalidates that layer and
+        everything above it, but nothing below.
+        """
+        if not self.chroot_cache:
+            build()
+            return
+        inputs = dict(inputs, parent=self.chroot_layer)
+        self.chroot_layer = self.chroot_cache.populate(self.chroot_dir, inputs, build)
+
+    def release_chroot(self):
+        """Let go of any cache snapshot backing the chroot dir"""
+        if self.chroot_cache:
+            self.chroot_cache.release(self.chroot_dir)
+
+    def bootloader_packages(self):
+        """Packages providing the bootloader, for hypervisors that need one"""
+        return []
+
+    def build_inputs(self):
+        """The settings that determine what the guest's tree ends up like"""
+        return {}
+
     def has_xen_support(self):
         """Install the distro into destdir"""
         raise NotImplemented('Distro subclasses need to implement the has_xen_support method')
@@ -20,24 +20,42 @@
 
 import logging
 import os
+import time
+import uuid
 import VMBuilder.distro
 import VMBuilder.disk
-from   VMBuilder.util    import run_cmd, tmpdir
+import VMBuilder.nbd
+from   VMBuilder.cache    import fingerprint
+from   VMBuilder.treecopy import copy_tree
+from   VMBuilder.util    import run_cmd, tmpdir, JobPool, parallel_map
 
 STORAGE_DISK_IMAGE = 0
 STORAGE_FS_IMAGE = 1
 
+# Options for qemu-img convert (see VMBuilder.disk.qemu_img_convert_args)
+# that each have a --convert-<option> setting
+CONVERT_OPTIONS = ['coroutines', 'out-of-order', 'compression', 'cluster-size', 'preallocation', 'lazy-refcounts', 'native']
+
 class Hypervisor(VMBuilder.distro.Context):
     preferred_storage = STORAGE_DISK_IMAGE
+    # What to convert disks with, unless the --convert-* settings say
+    # otherwise. qemu-img's out of order writes (-W) fragment image
+    # formats, so they're left to --convert-out-of-order. VMBuilder's own
+    # writers are left to --convert-native until qemu-img has checked
+    # their output.
+    convert_defaults = { 'coroutines' : 8 }
 
     def __init__(self, distro):
         self.plugin_classes = VMBuilder._hypervisor_plugins
         super(Hypervisor, self).__init__()
         self.plugins += [distro]
         self.distro = distro
+        self.distro.register_hook('plan_packages', self.plan_packages)
         self.filesystems = []
         self.disks = []
         self.nics = []
+        self.in_place = False
+        self.populate_from = None
 
     def add_filesystem(self, *args, **kwargs):
         """Adds a filesystem to the virtual machine"""
@@ -51,44 +69,192 @@ class Hypervisor(VMBuilder.distro.Context):
         """Adds a disk image to the virtual machine"""
         from VMBuilder.disk import Disk
 
+        kwargs.setdefault('alignment', self.get_setting('partition-alignment') * 2)
+        kwargs.setdefault('table_type', self.get_setting('partition-table') == 'gpt' and 'gpt' or 'msdos')
+        if self.get_setting('disk-backend') == 'nbd':
+            kwargs.setdefault('format', self.nbd_disk_format())
         disk = Disk(self, *args, **kwargs)
         self.disks.append(disk)
         return disk
 
-    def install_os(self):
+    def disk_format(self):
+        """The format the finished disk images are in"""
+        return getattr(self, 'filetype', 'raw')
+
+    def nbd_disk_format(self):
+        """
+        The format to build disks in with --disk-backend=nbd: the one
+        they're finished in, unless that's raw anyway or can't be built
+        into directly, in which case they're built raw (and converted)
+        as usual.
+        """
+        format = self.disk_format()
+        if format == 'raw':
+            return 'raw'
+        if (self.convert_options().get('compression') or 'none') != 'none':
+            logging.warning('Compressed disk images can only be made by converting, building them raw')
+            return 'raw'
+        if not VMBuilder.nbd.available():
+            logging.warning('qemu-nbd or the nbd module is not available, building disk images raw')
+            return 'raw'
+        return format
+
+    def prepare_in_place(self):
+        """
+        Create and mount the guest's disks and point the distro at them, so
+        that the chroot gets built straight onto them rather than copied
+        there by L{install_os}.
+        """
+        self.in_place = True
         self.nics = [self.NIC()]
         self.call_hooks('preflight_check')
-        self.call_hooks('configure_networking', self.nics)
+        self.assign_uuids()
         self.call_hooks('create_partitions')
-        self.call_hooks('configure_mounting', self.disks, self.filesystems)
-
         self.chroot_dir = tmpdir()
         self.call_hooks('mount_partitions', self.chroot_dir)
-        run_cmd('rsync', '-aHA', '%s/' % self.distro.chroot_dir, self.chroot_dir)
         self.distro.set_chroot_dir(self.chroot_dir)
+
+    def install_os(self):
+        if self.in_place:
+            # Networking and mounting get configured in the distro's
+            # tree, which only exists now.
+            self.call_hooks('configure_networking', self.nics)
+            self.call_hooks('configure_mounting', self.disks, self.filesystems)
+        else:
+            self.nics = [self.NIC()]
+            self.call_hooks('preflight_check')
+            self.call_hooks('configure_networking', self.nics)
+            self.assign_uuids()
+            if self.get_setting('populate-at-mkfs'):
+                # The filesystems get filled as they are made, so fstab
+                # has to be in the tree by then
+                self.populate_from = self.distro.chroot_dir
+                self.call_hooks('configure_mounting', self.disks, self.filesystems)
+                self.call_hooks('create_partitions')
+            else:
+                self.call_hooks('create_partitions')
+                self.call_hooks('configure_mounting', self.disks, self.filesystems)
+
+            self.chroot_dir = tmpdir()
+            self.call_hooks('mount_partitions', self.chroot_dir)
+            filesystems = [fs for fs in VMBuilder.disk.get_ordered_filesystems(self)
+                              if fs.type != VMBuilder.disk.TYPE_SWAP and not fs.dummy]
+            if [fs for fs in filesystems if not fs.populated]:
+                self.copy_chroot([fs.mntpnt for fs in filesystems if fs.populated])
+            self.distro.set_chroot_dir(self.chroot_dir)
         if self.needs_bootloader:
             self.call_hooks('install_bootloader', self.chroot_dir, self.disks)
         self.call_hooks('install_kernel', self.chroot_dir)
+        self.call_hooks('run_deferred_triggers')
         self.distro.call_hooks('post_install')
         self.call_hooks('unmount_partitions')
         os.rmdir(self.chroot_dir)
 
+    def assign_uuids(self):
+        """
+        Decide on the filesystems' UUIDs before they get made, so that
+        mkfs can be told which one to use instead of being asked
+        afterwards. With --reproducible-uuids, they're derived from
+        L{build_fingerprint}, so that the same build gets the same UUIDs.
+        """
+        namespace = None
+        if self.get_setting('reproducible-uuids'):
+            namespace = uuid.UUID(self.build_fingerprint()[:32])
+        for (i, fs) in enumerate(VMBuilder.disk.get_ordered_filesystems(self)):
+            if fs.uuid or fs.dummy:
+                continue
+            if namespace:
+                fs.uuid = str(uuid.uuid5(namespace, '%d %s' % (i, fs.mntpnt)))
+            else:
+                fs.uuid = str(uuid.uuid4())
+
+    def build_fingerprint(self):
+        """Fingerprint of what goes into the build: the distro's settings and the disk layout"""
+        disks = [(disk.size, [(part.start_sector, part.sectors, part.type, part.mntpnt) for part in disk.partitions])
+                 for disk in self.disks]
+        filesystems = [(fs.size, fs.type, fs.mntpnt) for fs in self.filesystems]
+        inputs = { 'disks' : disks, 'filesystems' : filesystems }
+        for (name, layer) in self.distro.build_inputs().items():
+            inputs['distro-%s' % name] = fingerprint(layer)
+        return fingerprint(inputs)
+
+    def copy_chroot(self, filled=[]):
+        """
+        Copies the distro's chroot onto the mounted filesystems.
+
+        @type  filled: list
+        @param filled: Mountpoints of filesystems that were filled as they
+                       were made, which are left alone
+        """
+        mountpoints = [fs.mntpnt for fs in VMBuilder.disk.get_ordered_filesystems(self)
+                                 if fs.mntpnt and fs.mntpnt.startswith('/')]
+        copy_tree(self.distro.chroot_dir, self.chroot_dir, mountpoints,
+                  workers=self.get_setting('copy-workers'), filled=filled)
+
+    def plan_packages(self, plan):
+        """Add the packages this hypervisor needs in the guest to the distro's plan"""
+        if self.needs_bootloader:
+            plan.install(self.distro.bootloader_packages())
+
     def finalise(self, destdir):
+        start = time.time()
         self.call_hooks('convert', 
                         self.preferred_storage == STORAGE_DISK_IMAGE and self.disks or self.filesystems,
                         destdir)
+        logging.info('Converted the disk images in %.1fs' % (time.time() - start))
         self.call_hooks('deploy', destdir)
 
+    def convert_each(self, func, items):
+        """
+        Call func on each of items (disks or filesystems), up to
+        --convert-workers of them at a time. The conversions are separate
+        qemu-img (or VBoxManage, or cp) processes, so they really do run
+        side by side.
+
+        @rtype:  list
+        @return: What func returned for each of items, in the same order
+        """
+        def _convert(item):
+            item_start = time.time()
+            result = func(item)
+            logging.info('Converted %s in %.1fs' % (getattr(item, 'filename', item), time.time() - item_start))
+            return result
+        return parallel_map(_convert, items, self.get_setting('convert-workers'))
+
+    def convert_options(self):
+        """How to convert disks: L{convert_defaults}, overridden by the --convert-* settings"""
+        options = dict(self.convert_defaults)
+        for name in CONVERT_OPTIONS:
+            value = self.get_setting('convert-%s' % name)
+            if value is not None:
+                options[name] = value
+        return options
+
     def create_partitions(self):
-        """Creates all the vms partitions and formats them """
+        """
+        Creates all the vms partitions and formats them. Disks and
+        filesystems are independent of each other, so they're set up at
+        the same time, and each partition gets its mkfs as soon as its
+        disk is mapped.
+        """
+        jobs = JobPool(self.get_setting('create-workers'))
         for fs in self.filesystems:
-            fs.create()
-            fs.mkfs()
+            jobs.add('Filesystem %s' % (fs.mntpnt or fs.filename), fs.create, self.populate_from)
         for disk in self.disks:
-            disk.create()
-            disk.partition()
-            disk.map_partitions()
-            disk.mkfs()
+            jobs.add('Disk %s' % disk.filename, self.create_disk, disk, jobs)
+        try:
+            jobs.wait()
+        finally:
+            for (description, seconds) in jobs.timings:
+                logging.info('%s: %.1fs' % (description, seconds))
+
+    def create_disk(self, disk, jobs):
+        """Creates, partitions and maps disk, then queues up the mkfs of its partitions on jobs"""
+        disk.create(self.convert_options())
+        disk.partition(self.get_setting('partition-table'))
+        disk.map_partitions(self.get_setting('partition-mapper'))
+        for part in disk.partitions:
+            jobs.add('Partition %s (%s)' % (part.filename, part.mntpnt), part.mkfs, self.populate_from)
 
     def mount_partitions(self, mntdir):
         """Mounts all the vm's partitions and filesystems below .rootmnt"""
@@ -96,13 +262,21 @@ class Hypervisor(VMBuilder.distro.Context):
         fss = VMBuilder.disk.get_ordered_filesystems(self)
         for fs in fss:
             fs.mount(mntdir)
-            self.distro.post_mount(fs)
+            # When building in place, there's nothing to add things to yet
+            if not self.in_place:
+                self.distro.post_mount(fs)
 
     def unmount_partitions(self):
         """Unmounts all the vm's partitions and filesystems"""
         logging.info('Unmounting target filesystem')
         fss = VMBuilder.disk.get_ordered_filesystems(self)
         fss.reverse()
+        if self.distro.has_setting('unsafe-io') and self.distro.get_setting('unsafe-io'):
+            # Nothing got synced along the way. syncfs just the guest's
+            # filesystems rather than everything on the build host.
+            for fs in fss:
+                if getattr(fs, 'mntpath', None):
+                    run_cmd('sync', '-f', fs.mntpath)
         for fs in fss:
             fs.umount()
         for disk in self.disks:
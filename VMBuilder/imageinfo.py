@@ -0,0 +1,231 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Reading partition tables and filesystem superblocks straight from
+#    disk images and block devices
+
+import os
+import stat
+import struct
+import uuid
+from   VMBuilder.exception import VMBuilderException
+
+SECTOR_SIZE = 512
+
+MBR_EXTENDED_TYPES = [0x05, 0x0f, 0x85]
+MBR_GPT_TYPE = 0xee
+
+# Feature flags that only ext4 sets
+EXT4_INCOMPAT = 0x0040 | 0x0080 | 0x0200  # extents, 64bit, flex_bg
+EXT4_RO_COMPAT = 0x0008 | 0x0400          # huge_file, metadata_csum
+EXT_COMPAT_HAS_JOURNAL = 0x0004
+EXT_INCOMPAT_64BIT = 0x0080
+
+# Swap headers fill the first page, whatever size that had on the host
+# that made them
+SWAP_PAGE_SIZES = [4096, 8192, 16384, 65536]
+
+def read_at(fp, offset, length):
+    """Read length bytes at offset of fp, or fewer if it ends before that"""
+    fp.seek(offset)
+    return fp.read(length)
+
+def image_size(filename):
+    """
+    @rtype:  number
+    @return: Size of a disk image or block device, in bytes
+    """
+    st = os.stat(filename)
+    if not (stat.S_ISREG(st.st_mode) or stat.S_ISBLK(st.st_mode)):
+        raise VMBuilderException('No idea how to find the size of %s' % filename)
+    fp = open(filename, 'rb')
+    try:
+        # For block devices, st_size is 0, but seeking to the end works
+        fp.seek(0, os.SEEK_END)
+        return fp.tell()
+    finally:
+        fp.close()
+
+class PartitionInfo(object):
+    """
+    A partition, as found in a partition table.
+
+    @type  type: number or string
+    @param type: MBR type byte, or GPT type GUID
+    @type  start: number
+    @param start: First sector of the partition
+    @type  sectors: number
+    @param sectors: Size of the partition, in sectors
+    """
+    def __init__(self, number, type, start, sectors):
+        self.number = number
+        self.type = type
+        self.start = start
+        self.sectors = sectors
+
+    def __repr__(self):
+        return '<PartitionInfo %d: type %s, start %d, %d sectors>' % (self.number, self.type, self.start, self.sectors)
+
+def mbr_entries(sector):
+    """
+    @type  sector: string
+    @param sector: An MBR or EBR
+    @rtype:  list
+    @return: (type, start, sectors) tuples of the entries in use, in table
+             order, or None if sector isn't an MBR
+    """
+    if len(sector) < SECTOR_SIZE or sector[510:512] != '\x55\xaa':
+        return None
+    entries = []
+    for i in range(4):
+        (type, start, sectors) = struct.unpack('<4xB3xII', sector[446+i*16:446+(i+1)*16])
+        if type:
+            entries.append((type, start, sectors))
+    return entries
+
+def partitions(filename):
+    """
+    Read the partition table of a disk image or block device. MBR
+    tables are read with their logical partitions, and GPT tables are
+    read instead of their protective MBR.
+
+    @rtype:  list
+    @return: L{PartitionInfo}s, in partition number order. Extended
+             partitions are left out, their logical partitions aren't.
+    """
+    fp = open(filename, 'rb')
+    try:
+        entries = mbr_entries(read_at(fp, 0, SECTOR_SIZE))
+        if entries is None:
+            raise VMBuilderException('%s has no partition table' % filename)
+        if [type for (type, start, sectors) in entries] == [MBR_GPT_TYPE]:
+            return gpt_partitions(fp)
+
+        parts = []
+        logical = 5
+        for (i, (type, start, sectors)) in enumerate(entries):
+            if type not in MBR_EXTENDED_TYPES:
+                parts.append(PartitionInfo(i + 1, type, start, sectors))
+                continue
+            # Walk the chain of EBRs. Each has the logical partition
+            # (relative to itself) and a link to the next EBR (relative to
+            # the start of the extended partition).
+            ebr = start
+            while logical < 256:
+                chain = mbr_entries(read_at(fp, ebr * SECTOR_SIZE, SECTOR_SIZE))
+                if not chain:
+                    break
+                (ltype, lstart, lsectors) = chain[0]
+                parts.append(PartitionInfo(logical, ltype, ebr + lstart, lsectors))
+                logical += 1
+                links = [entry for entry in chain[1:] if entry[0] in MBR_EXTENDED_TYPES]
+                if not links:
+                    break
+                ebr = start + links[0][1]
+        return parts
+    finally:
+        fp.close()
+
+def gpt_partitions(fp):
+    header = read_at(fp, SECTOR_SIZE, 92)
+    if header[:8] != 'EFI PART':
+        raise VMBuilderException('Protective MBR, but no GPT header')
+    (entries_lba, count, entry_size) = struct.unpack('<QII', header[72:88])
+    table = read_at(fp, entries_lba * SECTOR_SIZE, count * entry_size)
+    parts = []
+    for i in range(count):
+        entry = table[i*entry_size:(i+1)*entry_size]
+        if len(entry) < 48 or entry[:16] == '\0' * 16:
+            continue
+        (first, last) = struct.unpack('<QQ', entry[32:48])
+        parts.append(PartitionInfo(i + 1, str(uuid.UUID(bytes_le=entry[:16])), first, last - first + 1))
+    return parts
+
+class FilesystemInfo(object):
+    """
+    What a filesystem's superblock says about it.
+
+    @type  type: string
+    @param type: 'ext2', 'ext3', 'ext4', 'xfs' or 'swap'
+    @type  size: number
+    @param size: Size of the filesystem, in bytes
+    """
+    def __init__(self, type, uuid, label, size):
+        self.type = type
+        self.uuid = uuid
+        self.label = label
+        self.size = size
+
+    def __repr__(self):
+        return '<FilesystemInfo %s: uuid %s, label %r, %d bytes>' % (self.type, self.uuid, self.label, self.size)
+
+def filesystem_info(filename, offset=0):
+    """
+    Identify the filesystem at offset (in bytes) of filename.
+
+    @rtype:  L{FilesystemInfo}
+    @return: What the superblock says, or None for anything but ext2/3/4,
+             XFS and swap
+    """
+    fp = open(filename, 'rb')
+    try:
+        for probe in [ext_info, xfs_info, swap_info]:
+            info = probe(fp, offset)
+            if info:
+                return info
+        return None
+    finally:
+        fp.close()
+
+def _label(raw):
+    return raw.split('\0', 1)[0]
+
+def ext_info(fp, offset):
+    sb = read_at(fp, offset + 1024, 1024)
+    if len(sb) < 1024 or sb[56:58] != '\x53\xef':
+        return None
+    (blocks, ) = struct.unpack('<I', sb[4:8])
+    (log_block_size, ) = struct.unpack('<I', sb[24:28])
+    (compat, incompat, ro_compat) = struct.unpack('<III', sb[92:104])
+    if incompat & EXT_INCOMPAT_64BIT:
+        blocks |= struct.unpack('<I', sb[336:340])[0] << 32
+    if incompat & EXT4_INCOMPAT or ro_compat & EXT4_RO_COMPAT:
+        type = 'ext4'
+    elif compat & EXT_COMPAT_HAS_JOURNAL:
+        type = 'ext3'
+    else:
+        type = 'ext2'
+    return FilesystemInfo(type, str(uuid.UUID(bytes=sb[104:120])), _label(sb[120:136]),
+                          blocks * (1024 << log_block_size))
+
+def xfs_info(fp, offset):
+    sb = read_at(fp, offset, 120)
+    if len(sb) < 120 or sb[:4] != 'XFSB':
+        return None
+    (block_size, blocks) = struct.unpack('>IQ', sb[4:16])
+    return FilesystemInfo('xfs', str(uuid.UUID(bytes=sb[32:48])), _label(sb[108:120]), blocks * block_size)
+
+def swap_info(fp, offset):
+    for page_size in SWAP_PAGE_SIZES:
+        if read_at(fp, offset + page_size - 10, 10) != 'SWAPSPACE2':
+            continue
+        header = read_at(fp, offset + 1024, 44)
+        (last_page, ) = struct.unpack('<I', header[4:8])
+        return FilesystemInfo('swap', str(uuid.UUID(bytes=header[12:28])), _label(header[28:44]),
+                              (last_page + 1) * page_size)
+    return None
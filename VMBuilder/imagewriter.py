@@ -0,0 +1,496 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Writing raw disk images out as sparse VDI, VMDK and qcow2 images,
+#    without qemu-img or VBoxManage
+
+import collections
+import logging
+import mmap
+import multiprocessing
+import os
+import random
+import re
+import struct
+import uuid
+import zlib
+from   multiprocessing.pool import ThreadPool
+from   VMBuilder.artifact   import data_extents
+from   VMBuilder.exception  import VMBuilderUserError, VMBuilderException
+
+SECTOR_SIZE = 512
+
+# How much of the raw image to read at a time
+READ_SIZE = 16 * 1024 * 1024
+
+# The formats write_image can write
+FORMATS = ['vdi', 'vmdk', 'qcow2']
+
+VDI_TEXT = '<<< Oracle VM VirtualBox Disk Image >>>\n'
+VDI_SIGNATURE = 0xbeda107f
+VDI_VERSION = 0x00010001
+VDI_HEADER_SIZE = 0x180
+VDI_DYNAMIC = 1
+VDI_BLOCK_SIZE = 1024 * 1024
+VDI_UNALLOCATED = 0xffffffff
+# Pre-header (text, signature, version), then the version 1.1 header
+VDI_HEADER = struct.Struct('<64sIIIII256sIIIIIIIQIIII16s16s16s16s56x')
+
+VMDK_MAGIC = 0x564d444b  # 'KDMV'
+VMDK_HEADER = struct.Struct('<IIIQQQQIQQQB4sH433x')
+VMDK_GRAIN_SECTORS = 128
+VMDK_GTES_PER_GT = 512
+VMDK_GT_SECTORS = VMDK_GTES_PER_GT * 4 / SECTOR_SIZE
+VMDK_DESCRIPTOR_SECTORS = 20
+VMDK_FLAG_NL_DETECT = 1 << 0
+VMDK_FLAG_RGD = 1 << 1
+VMDK_FLAG_COMPRESSED = 1 << 16
+VMDK_FLAG_MARKERS = 1 << 17
+VMDK_COMPRESSION_DEFLATE = 1
+VMDK_GD_AT_END = 0xffffffffffffffff
+VMDK_GRAIN_MARKER = struct.Struct('<QI')
+VMDK_METADATA_MARKER = struct.Struct('<QII496x')
+VMDK_MARKER_EOS = 0
+VMDK_MARKER_GT = 1
+VMDK_MARKER_GD = 2
+VMDK_MARKER_FOOTER = 3
+
+QCOW2_MAGIC = 0x514649fb  # 'QFI\xfb'
+QCOW2_VERSION = 3
+# Version 2 header, then the version 3 additions (up to and including
+# the compression type, which only counts if header_length says so)
+QCOW2_HEADER = struct.Struct('>IIQIIQIIQQIIQQQQIIB7x')
+QCOW2_HEADER_LENGTH = 104
+QCOW2_HEADER_LENGTH_COMPRESSION_TYPE = 112
+QCOW2_INCOMPAT_COMPRESSION_TYPE = 1 << 3
+QCOW2_COMPRESSION_TYPES = { 'zlib' : 0, 'zstd' : 1 }
+QCOW2_REFCOUNT_ORDER = 4  # 16 bit refcounts
+QCOW2_OFLAG_COPIED = 1 << 63
+QCOW2_OFLAG_COMPRESSED = 1 << 62
+QCOW2_CLUSTER_SIZE = 64 * 1024
+
+def sectors(length):
+    return (length + SECTOR_SIZE - 1) / SECTOR_SIZE
+
+def pad(data, size=SECTOR_SIZE):
+    """data, with zeros added up to the next multiple of size"""
+    return data + '\0' * (-len(data) % size)
+
+def pack_table(entries):
+    return struct.pack('<%dI' % len(entries), *entries)
+
+def allocated_blocks(fp, block_size):
+    """
+    Go through fp mapped into memory, skipping its holes, and pick out
+    the blocks with something in them.
+
+    @rtype:  generator
+    @return: (index, data) of every block_size block of fp that isn't all
+             zeros, in order. The last block is padded with zeros.
+    """
+    size = os.fstat(fp.fileno()).st_size
+    if not size:
+        return
+    zero = '\0' * block_size
+    view = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        done = 0
+        for (start, end) in data_extents(fp.fileno()):
+            # Extents needn't be block aligned, so a block may straddle two
+            index = max(start / block_size, done)
+            last = (end + block_size - 1) / block_size
+            for index in xrange(index, last):
+                offset = index * block_size
+                length = min(block_size, size - offset)
+                # Comparing buffers is a memcmp straight on the mapped
+                # pages, so zero blocks are never even copied
+                if buffer(view, offset, length) == buffer(zero, 0, length):
+                    continue
+                yield (index, view[offset:offset + length] + zero[length:])
+            done = last
+    finally:
+        view.close()
+
+def write_vdi(src, dest):
+    """
+    Write raw image src out as dynamic VDI image dest, with only its
+    non-zero blocks allocated.
+    """
+    srcfp = open(src, 'rb')
+    destfp = open(dest, 'wb')
+    try:
+        size = os.fstat(srcfp.fileno()).st_size
+        blocks = (size + VDI_BLOCK_SIZE - 1) / VDI_BLOCK_SIZE
+        bmap_offset = SECTOR_SIZE
+        data_offset = bmap_offset + sectors(blocks * 4) * SECTOR_SIZE
+        bmap = [VDI_UNALLOCATED] * blocks
+
+        destfp.seek(data_offset)
+        allocated = 0
+        for (index, data) in allocated_blocks(srcfp, VDI_BLOCK_SIZE):
+            bmap[index] = allocated
+            destfp.write(data)
+            allocated += 1
+
+        destfp.seek(0)
+        destfp.write(VDI_HEADER.pack(VDI_TEXT, VDI_SIGNATURE, VDI_VERSION, VDI_HEADER_SIZE, VDI_DYNAMIC, 0, '',
+                                     bmap_offset, data_offset, 0, 0, 0, SECTOR_SIZE, 0,
+                                     size, VDI_BLOCK_SIZE, 0, blocks, allocated,
+                                     uuid.uuid4().bytes_le, '', '', ''))
+        destfp.seek(bmap_offset)
+        destfp.write(pad(pack_table(bmap)))
+        # An image with nothing in it must still be as long as its header says
+        destfp.truncate(data_offset + allocated * VDI_BLOCK_SIZE)
+    finally:
+        destfp.close()
+        srcfp.close()
+    logging.debug('Wrote %s: %d of %d blocks allocated' % (dest, allocated, blocks))
+
+def vmdk_descriptor(capacity, create_type, extent):
+    """
+    @type  capacity: number
+    @param capacity: Size of the disk, in sectors
+    @rtype:  string
+    @return: The descriptor of a single extent sparse VMDK, padded to the
+             space set aside for it
+    """
+    cylinders = min(capacity / (16 * 63), 16383)
+    descriptor = '\n'.join(['# Disk DescriptorFile',
+                            'version=1',
+                            'CID=%08x' % random.getrandbits(32),
+                            'parentCID=ffffffff',
+                            'createType="%s"' % create_type,
+                            '',
+                            '# Extent description',
+                            'RW %d SPARSE "%s"' % (capacity, extent),
+                            '',
+                            '# The Disk Data Base',
+                            '#DDB',
+                            '',
+                            'ddb.virtualHWVersion = "4"',
+                            'ddb.geometry.cylinders = "%d"' % cylinders,
+                            'ddb.geometry.heads = "16"',
+                            'ddb.geometry.sectors = "63"',
+                            'ddb.adapterType = "ide"',
+                            ''])
+    return descriptor.ljust(VMDK_DESCRIPTOR_SECTORS * SECTOR_SIZE, '\0')
+
+def vmdk_header(version, flags, capacity, rgd_offset, gd_offset, overhead, compression=0):
+    return VMDK_HEADER.pack(VMDK_MAGIC, version, flags, capacity, VMDK_GRAIN_SECTORS,
+                            1, VMDK_DESCRIPTOR_SECTORS, VMDK_GTES_PER_GT,
+                            rgd_offset, gd_offset, overhead, 0, '\n \r\n', compression)
+
+def write_vmdk(src, dest, stream_optimized=False, workers=None):
+    """
+    Write raw image src out as monolithicSparse (or, if
+    stream_optimized, compressed streamOptimized) VMDK image dest, with
+    only its non-zero grains allocated.
+
+    @type  workers: number
+    @param workers: Number of grains to compress at a time [default:
+                    number of CPUs]
+    """
+    srcfp = open(src, 'rb')
+    destfp = open(dest, 'wb')
+    try:
+        capacity = sectors(os.fstat(srcfp.fileno()).st_size)
+        grains = (capacity + VMDK_GRAIN_SECTORS - 1) / VMDK_GRAIN_SECTORS
+        gts = (grains + VMDK_GTES_PER_GT - 1) / VMDK_GTES_PER_GT
+        grain_table = [0] * (gts * VMDK_GTES_PER_GT)
+        grain_size = VMDK_GRAIN_SECTORS * SECTOR_SIZE
+        blocks = allocated_blocks(srcfp, grain_size)
+        if stream_optimized:
+            allocated = write_vmdk_stream(destfp, capacity, blocks, grain_table, workers)
+        else:
+            allocated = write_vmdk_sparse(destfp, capacity, blocks, grain_table)
+    finally:
+        destfp.close()
+        srcfp.close()
+    logging.debug('Wrote %s: %d of %d grains allocated' % (dest, allocated, grains))
+
+def write_vmdk_sparse(destfp, capacity, blocks, grain_table):
+    """
+    Hosted sparse extent layout: header, descriptor, redundant grain
+    directory and tables, grain directory and tables, then the grains.
+    """
+    gts = len(grain_table) / VMDK_GTES_PER_GT
+    gd_sectors = sectors(gts * 4)
+    rgd_offset = 1 + VMDK_DESCRIPTOR_SECTORS
+    gd_offset = rgd_offset + gd_sectors + gts * VMDK_GT_SECTORS
+    overhead = gd_offset + gd_sectors + gts * VMDK_GT_SECTORS
+    overhead += -overhead % VMDK_GRAIN_SECTORS
+
+    offset = overhead
+    destfp.seek(offset * SECTOR_SIZE)
+    for (index, data) in blocks:
+        grain_table[index] = offset
+        destfp.write(data)
+        offset += VMDK_GRAIN_SECTORS
+
+    destfp.seek(0)
+    destfp.write(vmdk_header(1, VMDK_FLAG_NL_DETECT | VMDK_FLAG_RGD, capacity, rgd_offset, gd_offset, overhead))
+    destfp.write(vmdk_descriptor(capacity, 'monolithicSparse', os.path.basename(destfp.name)))
+    for directory in [rgd_offset, gd_offset]:
+        tables = directory + gd_sectors
+        destfp.seek(directory * SECTOR_SIZE)
+        destfp.write(pad(pack_table([tables + i * VMDK_GT_SECTORS for i in range(gts)])))
+        destfp.write(pack_table(grain_table))
+    destfp.truncate(offset * SECTOR_SIZE)
+    return (offset - overhead) / VMDK_GRAIN_SECTORS
+
+def compressed_blocks(blocks, workers=None, compress=zlib.compress):
+    """
+    Compress blocks on workers threads (zlib and zstd let go of the GIL
+    while they work), keeping them in order and only a few of them in
+    memory.
+
+    @rtype:  generator
+    @return: (index, data, compressed data) of each block
+    """
+    workers = workers or multiprocessing.cpu_count()
+    pool = ThreadPool(workers)
+    try:
+        pending = collections.deque()
+        for (index, data) in blocks:
+            pending.append((index, data, pool.apply_async(compress, (data, ))))
+            if len(pending) >= workers * 4:
+                (index, data, result) = pending.popleft()
+                yield (index, data, result.get())
+        while pending:
+            (index, data, result) = pending.popleft()
+            yield (index, data, result.get())
+    finally:
+        pool.close()
+        pool.join()
+
+def write_vmdk_stream(destfp, capacity, blocks, grain_table, workers=None):
+    """
+    Stream-optimized layout: header (with the grain directory "at the
+    end"), descriptor, compressed grains with markers, grain tables,
+    grain directory, footer and end-of-stream marker, all written in one
+    pass.
+    """
+    gts = len(grain_table) / VMDK_GTES_PER_GT
+    gd_sectors = sectors(gts * 4)
+    flags = VMDK_FLAG_NL_DETECT | VMDK_FLAG_COMPRESSED | VMDK_FLAG_MARKERS
+    overhead = 1 + VMDK_DESCRIPTOR_SECTORS
+    overhead += -overhead % VMDK_GRAIN_SECTORS
+
+    destfp.write(vmdk_header(3, flags, capacity, 0, VMDK_GD_AT_END, overhead, VMDK_COMPRESSION_DEFLATE))
+    destfp.write(vmdk_descriptor(capacity, 'streamOptimized', os.path.basename(destfp.name)))
+    destfp.seek(overhead * SECTOR_SIZE)
+
+    offset = overhead
+    allocated = 0
+    for (index, raw, data) in compressed_blocks(blocks, workers):
+        grain = pad(VMDK_GRAIN_MARKER.pack(index * VMDK_GRAIN_SECTORS, len(data)) + data)
+        destfp.write(grain)
+        grain_table[index] = offset
+        offset += len(grain) / SECTOR_SIZE
+        allocated += 1
+
+    directory = []
+    for i in range(gts):
+        destfp.write(VMDK_METADATA_MARKER.pack(VMDK_GT_SECTORS, 0, VMDK_MARKER_GT))
+        destfp.write(pack_table(grain_table[i * VMDK_GTES_PER_GT:(i + 1) * VMDK_GTES_PER_GT]))
+        directory.append(offset + 1)
+        offset += 1 + VMDK_GT_SECTORS
+
+    destfp.write(VMDK_METADATA_MARKER.pack(gd_sectors, 0, VMDK_MARKER_GD))
+    destfp.write(pad(pack_table(directory)))
+    gd_offset = offset + 1
+
+    destfp.write(VMDK_METADATA_MARKER.pack(1, 0, VMDK_MARKER_FOOTER))
+    destfp.write(vmdk_header(3, flags, capacity, 0, gd_offset, overhead, VMDK_COMPRESSION_DEFLATE))
+    destfp.write(VMDK_METADATA_MARKER.pack(0, 0, VMDK_MARKER_EOS))
+    return allocated
+
+def qcow2_compressor(compression):
+    """
+    @type  compression: string
+    @param compression: 'zlib' or 'zstd'
+    @rtype:  function
+    @return: What compresses a cluster the way qcow2 wants it
+    """
+    if compression == 'zlib':
+        def deflate(data):
+            # Raw deflate with a 4k window, as qemu reads it
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -12)
+            return compressor.compress(data) + compressor.flush()
+        return deflate
+    try:
+        import zstandard
+    except ImportError:
+        raise VMBuilderUserError('Compressing qcow2 images with zstd needs the zstandard Python module')
+    # Compressors can't be shared between threads
+    return lambda data: zstandard.ZstdCompressor().compress(data)
+
+def parse_cluster_size(value):
+    """
+    @type  value: string
+    @param value: A qcow2 cluster size, like qemu-img takes it: 65536,
+                  64K, 2M
+    @rtype:  number
+    @return: The cluster size, in bytes
+    """
+    match = re.match(r'^(\d+)([kKmM]?)$', str(value))
+    if not match:
+        raise VMBuilderUserError('Invalid cluster size: %s' % value)
+    size = int(match.group(1)) * { '' : 1, 'k' : 1024, 'm' : 1024 * 1024 }[match.group(2).lower()]
+    if size < 512 or size > 2 * 1024 * 1024 or size & (size - 1):
+        raise VMBuilderUserError('Cluster sizes must be powers of two from 512 to 2M, not %s' % value)
+    return size
+
+def write_qcow2(src, dest, compression='none', cluster_size=QCOW2_CLUSTER_SIZE, workers=None):
+    """
+    Write raw image src out as qcow2 (version 3) image dest, with only its
+    non-zero clusters allocated. Unless compression is 'none', clusters
+    are compressed (on workers threads), apart from those that don't get
+    any smaller.
+
+    Everything is written in one pass: the header's cluster, the
+    clusters' data, then the L2 tables, the L1 table, and the refcounts
+    of all of it.
+    """
+    cluster_bits = cluster_size.bit_length() - 1
+    # Compressed cluster descriptors: where the data is, then how many
+    # sectors after the first one it takes
+    csize_shift = 62 - (cluster_bits - 8)
+    l2_per_table = cluster_size / 8
+    refcounts_per_block = cluster_size * 8 >> QCOW2_REFCOUNT_ORDER
+
+    srcfp = open(src, 'rb')
+    destfp = open(dest, 'wb')
+    try:
+        size = os.fstat(srcfp.fileno()).st_size
+        guest_clusters = (size + cluster_size - 1) / cluster_size
+        # Guest cluster => L2 entry, for the allocated ones
+        l2_entries = {}
+        # Per host cluster, starting with the header's
+        refcounts = [1]
+
+        def take(offset, length):
+            """Count a reference to each host cluster in length bytes at offset"""
+            first = offset >> cluster_bits
+            last = (offset + length - 1) >> cluster_bits
+            if last >= len(refcounts):
+                refcounts.extend([0] * (last + 1 - len(refcounts)))
+            for i in xrange(first, last + 1):
+                refcounts[i] += 1
+
+        def align(offset):
+            return offset + (-offset % cluster_size)
+
+        blocks = allocated_blocks(srcfp, cluster_size)
+        if compression == 'none':
+            blocks = ((index, data, None) for (index, data) in blocks)
+        else:
+            blocks = compressed_blocks(blocks, workers, qcow2_compressor(compression))
+
+        offset = cluster_size
+        destfp.seek(offset)
+        for (index, data, compressed) in blocks:
+            if compressed is not None and len(compressed) < cluster_size:
+                # Compressed clusters are packed back to back, each
+                # referencing every host cluster it touches
+                more_sectors = ((offset + len(compressed) - 1) >> 9) - (offset >> 9)
+                l2_entries[index] = QCOW2_OFLAG_COMPRESSED | (more_sectors << csize_shift) | offset
+                take(offset & ~511, (more_sectors + 1) * 512)
+                destfp.write(compressed)
+                offset += len(compressed)
+            else:
+                offset = align(offset)
+                l2_entries[index] = QCOW2_OFLAG_COPIED | offset
+                take(offset, cluster_size)
+                destfp.seek(offset)
+                destfp.write(data)
+                offset += cluster_size
+        offset = align(offset)
+        destfp.seek(offset)
+
+        l1 = [0] * ((guest_clusters + l2_per_table - 1) / l2_per_table)
+        for l1_index in sorted(set([index / l2_per_table for index in l2_entries])):
+            first = l1_index * l2_per_table
+            destfp.write(struct.pack('>%dQ' % l2_per_table, *[l2_entries.get(first + i, 0) for i in xrange(l2_per_table)]))
+            l1[l1_index] = QCOW2_OFLAG_COPIED | offset
+            take(offset, cluster_size)
+            offset += cluster_size
+
+        l1_offset = offset
+        l1_table = pad(struct.pack('>%dQ' % len(l1), *l1), cluster_size)
+        if l1_table:
+            destfp.write(l1_table)
+            take(offset, len(l1_table))
+            offset += len(l1_table)
+
+        # The refcount table and blocks need refcounts of their own
+        used = offset >> cluster_bits
+        (table_clusters, refblocks) = (0, 0)
+        while True:
+            needed_blocks = (used + table_clusters + refblocks + refcounts_per_block - 1) / refcounts_per_block
+            needed_table = (needed_blocks * 8 + cluster_size - 1) / cluster_size
+            if (needed_table, needed_blocks) == (table_clusters, refblocks):
+                break
+            (table_clusters, refblocks) = (needed_table, needed_blocks)
+        refcount_table_offset = offset
+        take(offset, (table_clusters + refblocks) * cluster_size)
+        refblocks_offset = offset + table_clusters * cluster_size
+        destfp.write(pad(struct.pack('>%dQ' % refblocks, *[refblocks_offset + i * cluster_size for i in xrange(refblocks)]), cluster_size))
+        refcounts.extend([0] * (refblocks * refcounts_per_block - len(refcounts)))
+        for i in xrange(refblocks):
+            destfp.write(struct.pack('>%dH' % refcounts_per_block, *refcounts[i * refcounts_per_block:(i + 1) * refcounts_per_block]))
+
+        if compression == 'zstd':
+            (incompatible, header_length) = (QCOW2_INCOMPAT_COMPRESSION_TYPE, QCOW2_HEADER_LENGTH_COMPRESSION_TYPE)
+        else:
+            (incompatible, header_length) = (0, QCOW2_HEADER_LENGTH)
+        destfp.seek(0)
+        destfp.write(QCOW2_HEADER.pack(QCOW2_MAGIC, QCOW2_VERSION, 0, 0, cluster_bits, size, 0,
+                                       len(l1), l1_offset, refcount_table_offset, table_clusters, 0, 0,
+                                       incompatible, 0, 0, QCOW2_REFCOUNT_ORDER, header_length,
+                                       QCOW2_COMPRESSION_TYPES.get(compression, 0)))
+    finally:
+        destfp.close()
+        srcfp.close()
+    logging.debug('Wrote %s: %d of %d clusters allocated' % (dest, len(l2_entries), guest_clusters))
+
+def write_image(src, dest, format, options=None):
+    """
+    Write raw image src out as dest, in format (one of L{FORMATS}).
+
+    @type  options: dict
+    @param options: The same options L{VMBuilder.disk.qemu_img_convert_args}
+                    takes. Only compression ('none', or 'zlib' for
+                    streamOptimized VMDKs) applies.
+    """
+    options = options or {}
+    compression = options.get('compression') or 'none'
+    if format == 'vdi':
+        if compression != 'none':
+            raise VMBuilderUserError('%s images can not be compressed' % format)
+        write_vdi(src, dest)
+    elif format == 'vmdk':
+        if compression not in ['none', 'zlib']:
+            raise VMBuilderUserError('VMDK images can only be compressed with zlib')
+        write_vmdk(src, dest, stream_optimized=(compression == 'zlib'))
+    elif format == 'qcow2':
+        # write_qcow2 is kept out of builds until its output has passed
+        # qemu-img check and compare (test_qemu_img_check)
+        raise VMBuilderUserError('The native qcow2 writer is not ready for use yet. Leave out --convert-native for qcow2 images.')
+    else:
+        raise VMBuilderException('No native writer for %s images' % format)
@@ -0,0 +1,220 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Disk layouts: where partitions go, and the --part file describing them
+
+import bisect
+from   VMBuilder.exception      import VMBuilderUserError
+from   VMBuilder.partitiontable import align_up, ALIGNMENT, GPT_ENTRY_SECTORS
+
+# Sectors per MB (sizes are MiB throughout, like qemu-img's)
+MB = 2048
+
+def head_room(table):
+    """Sectors the partition table needs at the start of the disk"""
+    return table == 'gpt' and 2 + GPT_ENTRY_SECTORS or 1
+
+def tail_room(table):
+    """Sectors the partition table needs at the end of the disk"""
+    return table == 'gpt' and 1 + GPT_ENTRY_SECTORS or 0
+
+class Layout(object):
+    """
+    Keeps track of the space taken on a disk and finds room for new
+    partitions.
+
+    @type  sectors: number
+    @param sectors: Size of the disk
+    @type  alignment: number
+    @param alignment: Partitions start on multiples of this many sectors
+    @type  table: string
+    @param table: 'msdos' or 'gpt', which decides how much room the
+                  partition table needs
+    """
+    def __init__(self, sectors, alignment=ALIGNMENT, table='msdos'):
+        self.alignment = alignment
+        self.first = align_up(head_room(table), alignment)
+        self.last = sectors - 1 - tail_room(table)
+        # (start, end) of every partition, sorted
+        self.extents = []
+
+    def place(self, sectors, start=None):
+        """
+        Take sectors sectors, at start (rounded up to the alignment) or
+        else at the first aligned spot they fit.
+
+        @rtype:  number
+        @return: The first sector taken
+        """
+        if start is None:
+            start = self.first_fit(sectors)
+        else:
+            start = max(align_up(start, self.alignment), self.first)
+            self.check(start, sectors)
+        bisect.insort(self.extents, (start, start + sectors - 1))
+        return start
+
+    def first_fit(self, sectors):
+        candidate = self.first
+        for (start, end) in self.extents:
+            if candidate + sectors - 1 < start:
+                break
+            candidate = max(candidate, align_up(end + 1, self.alignment))
+        if candidate + sectors - 1 > self.last:
+            raise VMBuilderUserError('No room left on the disk for a partition of %dMB' % (sectors / MB))
+        return candidate
+
+    def check(self, start, sectors):
+        """Raise L{VMBuilderUserError} if sectors sectors at start aren't free"""
+        end = start + sectors - 1
+        if start < self.first or end > self.last:
+            raise VMBuilderUserError('Partition is out of bounds. start=%d, end=%d, disksize=%d' %
+                                     (start / MB, end / MB, (self.last + 1) / MB))
+        i = bisect.bisect_left(self.extents, (start, end))
+        if (i > 0 and self.extents[i-1][1] >= start) or \
+           (i < len(self.extents) and self.extents[i][0] <= end):
+            raise VMBuilderUserError('Partitions are overlapping')
+
+    def rest(self):
+        """Sectors left after the last partition, from the next aligned sector on"""
+        start = self.first
+        if self.extents:
+            start = align_up(self.extents[-1][1] + 1, self.alignment)
+        return max(self.last - start + 1, 0)
+
+def disk_size(sizes, alignment=ALIGNMENT, table='msdos'):
+    """
+    @type  sizes: list
+    @param sizes: Sizes (in MB) of the partitions that should fit
+    @rtype:  number
+    @return: Size (in MB) of a disk that fits them all
+    """
+    sectors = align_up(head_room(table), alignment)
+    for size in sizes:
+        sectors += align_up(size * MB, alignment)
+    sectors += tail_room(table)
+    return (sectors + MB - 1) / MB
+
+DISK_KEYS = ['size', 'file', 'table']
+PART_KEYS = ['mount', 'size', 'fs', 'start', 'file', 'device']
+
+def parse_part_file(lines):
+    """
+    Parse a --part file. Two formats are understood. The original one
+    has a mountpoint (or root, or swap) and a size in MB per line, and a
+    line with just '---' to start the next disk::
+
+        root 2000
+        swap 1000
+        ---
+        /var 8000
+
+    The declarative one has a 'disk' line to start every disk and a
+    'part' line of key=value pairs per partition::
+
+        disk table=gpt
+        part mount=/ size=8G fs=ext4
+        part mount=swap size=1G
+        part mount=/srv size=rest
+        disk file=/dev/sdb
+        part mount=/var size=20G start=1G
+
+    Partitions without a start go in the first place they fit. A size of
+    'rest' takes what's left of the disk.
+
+    @rtype:  list
+    @return: A dict per disk, with the disk's options, and under 'parts'
+             a dict per partition, with 'mntpnt' and 'size' (in MB, or
+             None for 'rest'), plus whatever else was given
+    """
+    lines = [(n + 1, line.split('#', 1)[0].split()) for (n, line) in enumerate(lines)]
+    lines = [(n, words) for (n, words) in lines if words]
+    if lines and lines[0][1][0] in ['disk', 'part']:
+        return _parse_declarative(lines)
+
+    disks = [{ 'parts' : [] }]
+    for (n, words) in lines:
+        if words[0] == '---':
+            disks.append({ 'parts' : [] })
+            continue
+        if len(words) < 2:
+            raise VMBuilderUserError('Line %d of the partition file has no size' % n)
+        part = { 'mntpnt' : words[0] == 'root' and '/' or words[0],
+                 'size'   : _size(words[1], n) }
+        # For filesystem images: a device to put in fstab on three field
+        # lines (other than root and swap), an image file on four field
+        # ones. Any other device field is ignored, as it always has been.
+        if len(words) == 3 and words[0] not in ['root', 'swap']:
+            part['device'] = words[2]
+        if len(words) > 3:
+            part['file'] = words[3]
+        disks[-1]['parts'].append(part)
+    return disks
+
+def _size(value, n):
+    from VMBuilder.disk import parse_size
+    try:
+        size = parse_size(value)
+    except VMBuilderUserError, e:
+        raise VMBuilderUserError('Line %d of the partition file: %s' % (n, e))
+    if size is None:
+        raise VMBuilderUserError('Line %d of the partition file: Invalid size: %s' % (n, value))
+    return size
+
+def _parse_declarative(lines):
+    disks = []
+    for (n, words) in lines:
+        options = {}
+        for word in words[1:]:
+            if '=' not in word:
+                raise VMBuilderUserError('Line %d of the partition file: expected key=value, got %s' % (n, word))
+            (key, value) = word.split('=', 1)
+            options[key] = value
+
+        if words[0] == 'disk':
+            unknown = set(options) - set(DISK_KEYS)
+            if unknown:
+                raise VMBuilderUserError('Line %d of the partition file: unknown disk option %s' % (n, ', '.join(sorted(unknown))))
+            if 'size' in options:
+                options['size'] = _size(options['size'], n)
+            if options.get('table', 'msdos') not in ['msdos', 'gpt']:
+                raise VMBuilderUserError('Line %d of the partition file: table must be msdos or gpt' % n)
+            options['parts'] = []
+            disks.append(options)
+        elif words[0] == 'part':
+            unknown = set(options) - set(PART_KEYS)
+            if unknown:
+                raise VMBuilderUserError('Line %d of the partition file: unknown partition option %s' % (n, ', '.join(sorted(unknown))))
+            if 'mount' not in options or 'size' not in options:
+                raise VMBuilderUserError('Line %d of the partition file: partitions need a mount and a size' % n)
+            if not disks:
+                disks.append({ 'parts' : [] })
+            if disks[-1]['parts'] and disks[-1]['parts'][-1]['size'] is None:
+                raise VMBuilderUserError('Line %d of the partition file: only the last partition on a disk can take the rest of it' % n)
+            part = dict(options)
+            part['mntpnt'] = part.pop('mount')
+            if options['size'] == 'rest':
+                part['size'] = None
+            else:
+                part['size'] = _size(options['size'], n)
+            if 'start' in part:
+                part['start'] = _size(part['start'], n)
+            disks[-1]['parts'].append(part)
+        else:
+            raise VMBuilderUserError('Line %d of the partition file: expected disk or part, got %s' % (n, words[0]))
+    return disks
@@ -0,0 +1,132 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Loop devices, set up through the kernel's ioctls where possible
+
+import errno
+import fcntl
+import logging
+import os
+import struct
+from   VMBuilder.exception import VMBuilderException
+from   VMBuilder.util      import run_cmd
+
+# From linux/loop.h
+LOOP_SET_FD       = 0x4C00
+LOOP_CLR_FD       = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CONFIGURE    = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+LO_NAME_SIZE      = 64
+
+# How often to go back for another free device when someone else grabs
+# the one we were given first
+MAX_ATTEMPTS = 10
+
+def loop_info64(filename, offset, size):
+    """Pack a struct loop_info64"""
+    return struct.pack('=QQQQQIIII64s64s32sQQ',
+                       0, 0, 0,       # lo_device, lo_inode, lo_rdevice
+                       offset, size,  # lo_offset, lo_sizelimit
+                       0, 0, 0, 0,    # lo_number, lo_encrypt_type, lo_encrypt_key_size, lo_flags
+                       filename[-(LO_NAME_SIZE-1):], '', '', 0, 0)
+
+def loop_config(fd, filename, offset, size):
+    """Pack a struct loop_config"""
+    return struct.pack('=II', fd, 0) + loop_info64(filename, offset, size) + '\0' * 64
+
+def _configure(dev_fd, backing_fd, filename, offset, size):
+    try:
+        fcntl.ioctl(dev_fd, LOOP_CONFIGURE, loop_config(backing_fd, filename, offset, size))
+        return
+    except IOError, e:
+        if e.errno not in [errno.EINVAL, errno.ENOTTY]:
+            raise
+    # Kernels before 5.8 need two steps
+    fcntl.ioctl(dev_fd, LOOP_SET_FD, backing_fd)
+    try:
+        fcntl.ioctl(dev_fd, LOOP_SET_STATUS64, loop_info64(filename, offset, size))
+    except:
+        fcntl.ioctl(dev_fd, LOOP_CLR_FD, 0)
+        raise
+
+def attach(filename, offset=0, size=0):
+    """
+    Set up a loop device for filename.
+
+    @type  offset: number
+    @param offset: Where in filename the loop device starts (in bytes)
+    @type  size: number
+    @param size: Size of the loop device (in bytes). 0 means up to the
+                 end of filename.
+    @rtype:  string
+    @return: The loop device
+    """
+    filename = os.path.abspath(filename)
+    if not os.path.exists('/dev/loop-control'):
+        return losetup_attach(filename, offset, size)
+
+    backing_fd = os.open(filename, os.O_RDWR)
+    try:
+        ctl_fd = os.open('/dev/loop-control', os.O_RDWR)
+        try:
+            for attempt in range(MAX_ATTEMPTS):
+                device = '/dev/loop%d' % fcntl.ioctl(ctl_fd, LOOP_CTL_GET_FREE)
+                dev_fd = os.open(device, os.O_RDWR)
+                try:
+                    _configure(dev_fd, backing_fd, filename, offset, size)
+                    logging.debug('Attached %s (offset %d, size %d) to %s' % (filename, offset, size, device))
+                    return device
+                except IOError, e:
+                    if e.errno != errno.EBUSY:
+                        raise
+                    logging.debug('%s got taken before we could use it, trying another one' % device)
+                finally:
+                    os.close(dev_fd)
+        finally:
+            os.close(ctl_fd)
+    finally:
+        os.close(backing_fd)
+    raise VMBuilderException('Could not find a free loop device for %s' % filename)
+
+def losetup_attach(filename, offset=0, size=0):
+    """Like L{attach}, for systems without /dev/loop-control"""
+    cmd = ['losetup', '--find', '--show', '--offset', str(offset)]
+    if size:
+        cmd += ['--sizelimit', str(size)]
+    return run_cmd(*(cmd + [filename])).strip()
+
+def detach(device, ignore_fail=False):
+    """
+    Detach a loop device. If it's still in use, the kernel detaches it
+    once it no longer is.
+    """
+    try:
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, LOOP_CLR_FD, 0)
+        finally:
+            os.close(fd)
+    except (IOError, OSError), e:
+        if e.errno == errno.ENXIO:
+            # Not attached to anything (anymore)
+            return
+        if ignore_fail:
+            logging.debug('Could not detach %s: %s' % (device, e))
+            return
+        raise VMBuilderException('Could not detach %s: %s' % (device, e))
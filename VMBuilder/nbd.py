@@ -0,0 +1,108 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Disk images in formats other than raw, exposed as block devices
+#    through qemu-nbd
+
+import glob
+import logging
+import os
+import re
+import threading
+from   VMBuilder.exception import VMBuilderException
+from   VMBuilder.util      import run_cmd, wait_for
+
+# Only one connect at a time picks a device, so that concurrent disks
+# don't go for the same one
+_connect_lock = threading.Lock()
+
+# How many devices to try when others keep getting taken first
+MAX_ATTEMPTS = 4
+
+def qemu_nbd_path():
+    for dir in os.environ['PATH'].split(os.path.pathsep):
+        path = os.path.join(dir, 'qemu-nbd')
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+def available():
+    """
+    Whether disk images can be exposed through qemu-nbd: qemu-nbd is
+    installed and the nbd module is (or can be) loaded.
+    """
+    if not qemu_nbd_path():
+        return False
+    if not os.path.exists('/sys/block/nbd0'):
+        run_cmd('modprobe', 'nbd', ignore_fail=True)
+    return os.path.exists('/sys/block/nbd0')
+
+def is_connected(device):
+    """Whether a qemu-nbd (or any other nbd client) is serving device"""
+    return os.path.exists('/sys/block/%s/pid' % os.path.basename(device))
+
+def free_devices():
+    devices = [os.path.basename(path) for path in glob.glob('/sys/block/nbd*')]
+    devices.sort(key=lambda name: int(re.search('(\d+)$', name).group(1)))
+    return ['/dev/%s' % name for name in devices if not is_connected(name)]
+
+def connect(filename, format):
+    """
+    Expose filename through a free nbd device.
+
+    Only the options every packaged qemu-nbd has are used: --connect
+    and --format.
+
+    @type  format: string
+    @param format: The image's format, so that qemu-nbd doesn't have to
+                   guess it
+    @rtype:  string
+    @return: The nbd device
+    """
+    filename = os.path.abspath(filename)
+    error = 'no free nbd devices'
+    with _connect_lock:
+        for device in free_devices()[:MAX_ATTEMPTS]:
+            # Someone else (another build) may still grab it first, in
+            # which case qemu-nbd fails and we move on to the next one
+            try:
+                run_cmd(qemu_nbd_path(), '--connect=%s' % device, '--format=%s' % format, filename)
+                # Older qemu-nbds return before the device is up
+                wait_for(lambda: is_connected(device), '%s to be connected' % device, timeout=5)
+            except VMBuilderException, e:
+                error = e
+                logging.debug('Could not connect %s to %s: %s' % (filename, device, e))
+                continue
+            logging.debug('Connected %s to %s' % (filename, device))
+            return device
+    raise VMBuilderException('Could not connect %s to an nbd device: %s' % (filename, error))
+
+def disconnect(device, ignore_fail=False):
+    """
+    Disconnect device, once qemu-nbd has flushed everything written to
+    it to the image.
+    """
+    try:
+        if is_connected(device):
+            run_cmd(qemu_nbd_path(), '--disconnect', device)
+        # qemu-nbd only exits (and closes the image) once the kernel let go
+        wait_for(lambda: not is_connected(device), '%s to be disconnected' % device)
+    except VMBuilderException, e:
+        if not ignore_fail:
+            raise
+        logging.debug('Could not disconnect %s: %s' % (device, e))
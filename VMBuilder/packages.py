@@ -0,0 +1,93 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Package plans: every package change a build wants, in as few apt runs
+#    as possible
+
+# Stages are run in ascending order, one apt transaction each. Anything
+# that doesn't care about ordering goes in STAGE_DEFAULT, so that it all
+# ends up in a single transaction.
+STAGE_EARLY = 10
+STAGE_DEFAULT = 50
+STAGE_LATE = 90
+
+class PackagePlan(object):
+    """
+    Collects the packages to install and remove in the guest, so that
+    they can be handled by one apt transaction instead of one per
+    plugin. Dependencies are then resolved once and triggers (initramfs,
+    man-db...) fire once.
+
+    Packages that really must go in before or after the rest can be put
+    in an earlier or later stage, which gets a transaction of its own.
+    """
+    def __init__(self):
+        # Maps stages to a (install, remove) pair of lists
+        self.stages = {}
+        # Whether to dist-upgrade along with the default stage
+        self.upgrade = False
+
+    def _stage(self, stage):
+        return self.stages.setdefault(stage, ([], []))
+
+    def install(self, packages, stage=STAGE_DEFAULT):
+        """Add packages to the list of packages to install in stage"""
+        (install, remove) = self._stage(stage)
+        for package in packages:
+            if package in remove:
+                remove.remove(package)
+            if package not in install:
+                install.append(package)
+
+    def remove(self, packages, stage=STAGE_DEFAULT):
+        """Add packages to the list of packages to remove in stage"""
+        (install, remove) = self._stage(stage)
+        for package in packages:
+            if package in install:
+                install.remove(package)
+            if package not in remove:
+                remove.append(package)
+
+    def installs(self, packages):
+        """Whether all of packages are to be installed, in any stage"""
+        planned = set()
+        for (install, remove) in self.stages.values():
+            planned.update(install)
+        return set(packages) <= planned
+
+    def transactions(self):
+        """
+        @rtype:  list
+        @return: (install, remove, upgrade) tuples, one per apt run, in
+                 the order they need to be run in
+        """
+        stages = self.stages.keys()
+        if self.upgrade and STAGE_DEFAULT not in stages:
+            stages.append(STAGE_DEFAULT)
+        transactions = []
+        for stage in sorted(stages):
+            (install, remove) = self.stages.get(stage, ([], []))
+            upgrade = self.upgrade and stage == STAGE_DEFAULT
+            if install or remove or upgrade:
+                transactions.append((list(install), list(remove), upgrade))
+        return transactions
+
+def apt_args(install, remove):
+    """Turn lists of packages to install and remove into apt-get arguments"""
+    # apt-get takes a trailing + or - to override the command per package
+    return ['%s+' % package for package in install] + ['%s-' % package for package in remove]
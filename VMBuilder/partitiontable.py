@@ -0,0 +1,178 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    MBR and GPT partition tables, built in memory
+
+import os
+import struct
+import uuid
+import zlib
+from   VMBuilder.exception import VMBuilderUserError
+
+SECTOR_SIZE = 512
+
+# 1 MiB, in sectors
+ALIGNMENT = 2048
+
+MBR_TYPES = { 'linux'    : 0x83,
+              'swap'     : 0x82,
+              'extended' : 0x05,
+              'gpt'      : 0xee }
+
+GPT_TYPES = { 'linux'    : '0fc63daf-8483-4772-8e79-3d69d8477de4',
+              'swap'     : '0657fd6d-a4ab-43c4-84e5-0933c84b4f4f' }
+
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+# Sectors taken by the partition entries
+GPT_ENTRY_SECTORS = GPT_ENTRIES * GPT_ENTRY_SIZE / SECTOR_SIZE
+
+def align_up(sector, alignment=ALIGNMENT):
+    return (sector + alignment - 1) / alignment * alignment
+
+def chs(lba):
+    """CHS address of lba (for a 255 heads, 63 sectors geometry), as stored in an MBR"""
+    if lba >= 1024 * 255 * 63:
+        return '\xfe\xff\xff'
+    (cylinder, rest) = divmod(lba, 255 * 63)
+    (head, sector) = divmod(rest, 63)
+    return struct.pack('BBB', head, (sector + 1) | ((cylinder >> 2) & 0xc0), cylinder & 0xff)
+
+def mbr_entry(type, start, sectors):
+    if start + sectors > 0xffffffff:
+        raise VMBuilderUserError('MBR partition tables can not address beyond 2 TiB, use GPT instead')
+    return ('\x00' + chs(start) + struct.pack('B', MBR_TYPES[type]) + chs(start + sectors - 1) +
+            struct.pack('<II', start, sectors))
+
+def mbr_sector(entries, bootcode='', signature=0):
+    """
+    Build one MBR (or EBR) sector.
+
+    @type  entries: list
+    @param entries: Up to four (type, start, sectors) tuples
+    @type  bootcode: string
+    @param bootcode: Boot code to keep in the first 440 bytes
+    """
+    sector = bootcode[:440].ljust(440, '\0') + struct.pack('<IH', signature, 0)
+    for (type, start, sectors) in entries:
+        sector += mbr_entry(type, start, sectors)
+    return sector.ljust(510, '\0') + '\x55\xaa'
+
+def mbr(total_sectors, partitions, bootcode='', alignment=ALIGNMENT, signature=None):
+    """
+    Build an MBR partition table.
+
+    With more than four partitions, the fourth and later ones are made
+    logical partitions inside an extended one. Each of them needs an EBR
+    alignment sectors before it, so they must start at least that far
+    after the end of the previous partition.
+
+    @type  total_sectors: number
+    @param total_sectors: Size of the disk
+    @type  partitions: list
+    @param partitions: (type, start, sectors) tuples, in disk order
+    @rtype:  list
+    @return: (offset, data) pairs to write to the disk
+    """
+    if signature is None:
+        signature = struct.unpack('<I', os.urandom(4))[0]
+    for (type, start, sectors) in partitions:
+        if start + sectors > total_sectors:
+            raise VMBuilderUserError('Partition ends beyond the end of the disk')
+    if len(partitions) <= 4:
+        return [(0, mbr_sector(partitions, bootcode, signature))]
+
+    primary = partitions[:3]
+    logical = partitions[3:]
+    ext_start = logical[0][1] - alignment
+    ext_end = logical[-1][1] + logical[-1][2]
+    if ext_start <= primary[-1][1] + primary[-1][2] - 1:
+        raise VMBuilderUserError('No room for the extended partition table before partition 4')
+    writes = [(0, mbr_sector(primary + [('extended', ext_start, ext_end - ext_start)], bootcode, signature))]
+    for (i, (type, start, sectors)) in enumerate(logical):
+        ebr = start - alignment
+        if i > 0 and ebr <= logical[i-1][1] + logical[i-1][2] - 1:
+            raise VMBuilderUserError('No room for the extended partition table before partition %d' % (i + 5))
+        entries = [(type, alignment, sectors)]
+        if i + 1 < len(logical):
+            next_ebr = logical[i+1][1] - alignment
+            entries.append(('extended', next_ebr - ext_start, logical[i+1][1] + logical[i+1][2] - next_ebr))
+        writes.append((ebr * SECTOR_SIZE, mbr_sector(entries)))
+    return writes
+
+def gpt_header(current, backup, first_usable, last_usable, disk_guid, entries_lba, entries_crc):
+    fields = ['EFI PART', 0x00010000, 92, 0, 0, current, backup, first_usable, last_usable,
+              disk_guid, entries_lba, GPT_ENTRIES, GPT_ENTRY_SIZE, entries_crc]
+    fmt = '<8sIIIIQQQQ16sQIII'
+    crc = zlib.crc32(struct.pack(fmt, *fields)) & 0xffffffff
+    fields[3] = crc
+    return struct.pack(fmt, *fields).ljust(SECTOR_SIZE, '\0')
+
+def gpt(total_sectors, partitions, bootcode='', disk_guid=None):
+    """
+    Build a GPT partition table, with a protective MBR.
+
+    @type  total_sectors: number
+    @param total_sectors: Size of the disk
+    @type  partitions: list
+    @param partitions: (type, start, sectors) tuples, in disk order
+    @rtype:  list
+    @return: (offset, data) pairs to write to the disk: everything up to
+             the first usable sector and the backup table at the end
+    """
+    if len(partitions) > GPT_ENTRIES:
+        raise VMBuilderUserError('GPT partition tables hold at most %d partitions' % GPT_ENTRIES)
+    first_usable = 2 + GPT_ENTRY_SECTORS
+    last_usable = total_sectors - GPT_ENTRY_SECTORS - 2
+    for (type, start, sectors) in partitions:
+        if start < first_usable or start + sectors - 1 > last_usable:
+            raise VMBuilderUserError('Partition does not fit between the GPT headers')
+    disk_guid = uuid.UUID(disk_guid or str(uuid.uuid4())).bytes_le
+
+    entries = ''
+    for (type, start, sectors) in partitions:
+        entries += struct.pack('<16s16sQQQ72s', uuid.UUID(GPT_TYPES[type]).bytes_le, uuid.uuid4().bytes_le,
+                               start, start + sectors - 1, 0, ''.encode('utf-16-le'))
+    entries = entries.ljust(GPT_ENTRIES * GPT_ENTRY_SIZE, '\0')
+    entries_crc = zlib.crc32(entries) & 0xffffffff
+
+    protective = mbr_sector([('gpt', 1, min(total_sectors - 1, 0xffffffff))], bootcode)
+    backup_lba = total_sectors - 1
+    primary = gpt_header(1, backup_lba, first_usable, last_usable, disk_guid, 2, entries_crc)
+    backup = gpt_header(backup_lba, 1, first_usable, last_usable, disk_guid,
+                        backup_lba - GPT_ENTRY_SECTORS, entries_crc)
+    return [(0, protective + primary + entries),
+            ((backup_lba - GPT_ENTRY_SECTORS) * SECTOR_SIZE, entries + backup)]
+
+def write(filename, writes):
+    """Write what L{mbr} or L{gpt} returned to filename"""
+    fp = open(filename, 'r+b')
+    try:
+        for (offset, data) in writes:
+            fp.seek(offset)
+            fp.write(data)
+    finally:
+        fp.close()
+
+def read_bootcode(filename):
+    """The boot code in the MBR of filename, so that it survives a new table"""
+    fp = open(filename, 'rb')
+    try:
+        return fp.read(440)
+    finally:
+        fp.close()
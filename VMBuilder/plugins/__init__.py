@@ -83,7 +83,7 @@ class Plugin(object):
         return self.install_file(path, VMBuilder.util.render_template(self.__module__.split('.')[2], self.context, tmplname, context), mode=mode)
 
     def run_in_target(self, *args, **kwargs):
-        return util.run_cmd('chroot', self.chroot_dir, *args, **kwargs)
+        return util.run_cmd('chroot', self.chroot_dir, *(self.target_wrapper + list(args)), **kwargs)
 
     def call_hooks(self, *args, **kwargs):
         return util.call_hooks(self.context, *args, **kwargs)
@@ -20,4 +20,4 @@ import time
 from VMBuilder.plugins.debian.jessie import Jessie
 
 class Stretch(Jessie):
-    pass
+    apt_upgrade_takes_packages = True
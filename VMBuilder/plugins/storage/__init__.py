@@ -0,0 +1,64 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Settings for getting the guest's tree onto its disks
+
+from   VMBuilder           import register_hypervisor_plugin
+from   VMBuilder.plugins   import Plugin
+from   VMBuilder.exception import VMBuilderUserError
+
+class StorageHypervisorPlugin(Plugin):
+    def register_options(self):
+        group = self.setting_group('Storage')
+        group.add_setting('copy-workers', type='int', metavar='NUM', default=4, help='Number of copy processes to run at a time when populating the disk images [default: %default].')
+        group.add_setting('create-workers', type='int', metavar='NUM', default=4, help='Number of disks, filesystems and partitions to create and format at a time [default: %default].')
+        group.add_setting('partition-table', metavar='TYPE', default='parted', valid_options=['parted', 'msdos', 'gpt'], help='Partition table to put on the disk images: msdos made by parted, or msdos or gpt written directly, with partitions aligned to 1 MiB and more than four of them allowed. [default: %default]')
+        group.add_setting('partition-alignment', type='int', metavar='KB', default=1024, help='Start partitions on multiples of KB kilobytes. [default: %default]')
+        group.add_setting('partition-mapper', metavar='MAPPER', default='kpartx', valid_options=['kpartx', 'loop'], help='How to get at the partitions of the disk images: through device-mapper with kpartx or with a loop device per partition. [default: %default]')
+        group.add_setting('disk-backend', metavar='BACKEND', default='raw', valid_options=['raw', 'nbd'], help='Build disk images raw and convert them to the hypervisor\'s format at the end, or build them in that format right away through qemu-nbd. [default: %default]')
+        group.add_setting('reproducible-uuids', type='bool', default=False, help='Derive the filesystems\' UUIDs from the build\'s settings instead of picking random ones, so that rebuilding with the same settings gives the same UUIDs. [default: %default]')
+        group.add_setting('convert-workers', type='int', metavar='NUM', default=4, help='Number of disk images to convert at a time [default: %default].')
+        group.add_setting('convert-coroutines', type='int', metavar='NUM', help='Number of coroutines qemu-img runs in parallel when converting disk images. [default: depends on the hypervisor]')
+        group.add_setting('convert-out-of-order', type='bool', help='Let qemu-img write converted disk images out of order. Faster, but leaves qcow2 and vmdk images fragmented. [default: off]')
+        group.add_setting('convert-compression', metavar='ALGORITHM', valid_options=['none', 'zlib', 'zstd'], help='Compress converted qcow2 (zlib or zstd) or vmdk (zlib) disk images. [default: depends on the hypervisor]')
+        group.add_setting('convert-cluster-size', metavar='SIZE', help='Cluster size of converted qcow2 disk images. [default: depends on the hypervisor]')
+        group.add_setting('convert-preallocation', metavar='MODE', valid_options=['off', 'metadata'], help='Preallocation of converted qcow2 disk images. [default: depends on the hypervisor]')
+        group.add_setting('convert-lazy-refcounts', type='bool', help='Turn on lazy refcounts in converted qcow2 disk images. [default: depends on the hypervisor]')
+        group.add_setting('convert-native', type='bool', help='Write VDI and VMDK disk images with VMBuilder\'s own writers rather than VBoxManage or qemu-img. [default: off]')
+        group.add_setting('populate-at-mkfs', type='bool', default=False, help='Fill ext2/3/4 filesystems with the guest\'s files while creating them (mke2fs -d) instead of mounting and copying onto them afterwards. Other filesystems still get copied onto. [default: %default]')
+
+    def preflight_check(self):
+        if self.context.get_setting('copy-workers') < 1:
+            raise VMBuilderUserError('--copy-workers must be at least 1')
+        if self.context.get_setting('create-workers') < 1:
+            raise VMBuilderUserError('--create-workers must be at least 1')
+        if self.context.get_setting('convert-workers') < 1:
+            raise VMBuilderUserError('--convert-workers must be at least 1')
+        coroutines = self.context.get_setting('convert-coroutines')
+        if coroutines is not None and coroutines < 1:
+            raise VMBuilderUserError('--convert-coroutines must be at least 1')
+        if self.context.get_setting('partition-alignment') < 1:
+            raise VMBuilderUserError('--partition-alignment must be at least 1')
+        if self.context.get_setting('partition-table') == 'gpt' and getattr(self.context, 'needs_bootloader', False):
+            raise VMBuilderUserError('The guest\'s bootloader (grub legacy) can not boot from GPT partition tables')
+        if self.context.get_setting('partition-table') == 'parted':
+            for disk in self.context.disks:
+                if len(disk.partitions) > 4:
+                    raise VMBuilderUserError('%s has %d partitions, but parted only makes four primary partitions. Use --partition-table=msdos or --partition-table=gpt for more.' % (disk.filename, len(disk.partitions)))
+
+register_hypervisor_plugin(StorageHypervisorPlugin)
@@ -22,8 +22,11 @@ import os
 import suite
 import shutil
 import tempfile
+import VMBuilder.bootstrap
 import VMBuilder.disk as disk
-from   VMBuilder.util import run_cmd
+import VMBuilder.packages as packages
+from   VMBuilder.util import run_cmd, unmount
+from   VMBuilder.cache import file_fingerprint
 from   VMBuilder.exception import VMBuilderException
 
 class Dapper(suite.Suite):
@@ -37,6 +40,15 @@ class Dapper(suite.Suite):
     virtio_net = False
     chpasswd_cmd = [ 'chpasswd', '--md5' ]
     preferred_filesystem = 'ext3'
+    # Whether apt-get dist-upgrade accepts packages to install and remove
+    # in the same run (apt >= 1.1)
+    apt_upgrade_takes_packages = False
+    bootloader_packages = ['grub']
+    # Whether this run's package plan installed the kernel and bootloader,
+    # or the chroot came from elsewhere (--existing-chroot)
+    packages_planned = False
+    unsafe_io_dropin = '/etc/dpkg/dpkg.cfg.d/vmbuilder-unsafe-io'
+    deferred_triggers_dir = '/var/lib/vmbuilder/deferred-triggers'
 
     def pre_install(self):
         pass
@@ -90,11 +102,6 @@ class Dapper(suite.Suite):
             os.chmod('%s/home/%s/.ssh/authorized_keys' % (self.context.chroot_dir, user), 0644)
             self.run_in_target('chown', '-R', '%s:%s' % ((user,)*2), '/home/%s/.ssh/' % (user)) 
 
-        if ssh_user_key or ssh_key:
-            addpkg = self.context.get_setting('addpkg')
-            addpkg += ['openssh-server']
-            self.context.set_setting('addpkg', addpkg)
-
     def mount_dev_proc(self):
         run_cmd('mount', '--bind', '/dev', '%s/dev' % self.context.chroot_dir)
         self.context.add_clean_cb(self.unmount_dev)
@@ -105,17 +112,35 @@ class Dapper(suite.Suite):
         self.run_in_target('mount', '-t', 'proc', 'proc', '/proc')
         self.context.add_clean_cb(self.unmount_proc)
 
+    def mount_sys(self):
+        self.run_in_target('mount', '-t', 'sysfs', 'sysfs', '/sys')
+        self.context.add_clean_cb(self.unmount_sys)
+
+    def unmount_sys(self):
+        self.context.cancel_cleanup(self.unmount_sys)
+        unmount('%s/sys' % self.context.chroot_dir)
+
     def unmount_proc(self):
         self.context.cancel_cleanup(self.unmount_proc)
-        run_cmd('umount', '%s/proc' % self.context.chroot_dir)
+        unmount('%s/proc' % self.context.chroot_dir)
 
     def unmount_dev_pts(self):
         self.context.cancel_cleanup(self.unmount_dev_pts)
-        run_cmd('umount', '%s/dev/pts' % self.context.chroot_dir)
+        unmount('%s/dev/pts' % self.context.chroot_dir)
 
     def unmount_dev(self):
         self.context.cancel_cleanup(self.unmount_dev)
-        run_cmd('umount', '%s/dev' % self.context.chroot_dir)
+        unmount('%s/dev' % self.context.chroot_dir)
+
+    def mount_apt_archives(self):
+        if self.context.apt_cache:
+            self.context.apt_cache.mount(self.context.chroot_dir)
+            self.context.add_clean_cb(self.unmount_apt_archives)
+
+    def unmount_apt_archives(self):
+        if self.context.apt_cache:
+            self.context.cancel_cleanup(self.unmount_apt_archives)
+            self.context.apt_cache.umount(self.context.chroot_dir)
 
     def update_passwords(self):
         # Set the user password, using md5
@@ -200,9 +225,89 @@ class Dapper(suite.Suite):
 
     def unprevent_daemons_starting(self):
         os.unlink('%s/usr/sbin/policy-rc.d' % self.context.chroot_dir)
+        self.disable_unsafe_io()
+        self.undefer_triggers()
 
     def prevent_daemons_starting(self):
         os.chmod(self.install_from_template('/usr/sbin/policy-rc.d', 'nostart-policy-rc.d'), 0755)
+        self.enable_unsafe_io()
+        self.defer_triggers()
+
+    def enable_unsafe_io(self):
+        """Stop dpkg (and, with eatmydata, everything else) from fsyncing in the chroot"""
+        if not self.context.get_setting('unsafe-io'):
+            return
+        self.context.install_file(self.unsafe_io_dropin, 'force-unsafe-io\n')
+        if os.path.exists('%s/usr/bin/eatmydata' % self.context.chroot_dir):
+            self.context.target_wrapper = ['eatmydata']
+
+    def disable_unsafe_io(self):
+        self.context.target_wrapper = []
+        dropin = '%s%s' % (self.context.chroot_dir, self.unsafe_io_dropin)
+        if os.path.exists(dropin):
+            os.unlink(dropin)
+
+    def deferred_commands(self):
+        return ['/usr/sbin/update-initramfs', self.updategrub]
+
+    def note_deferred(self, name):
+        """Remember that the deferred trigger name needs to run"""
+        self.context.install_file('%s/%s' % (self.deferred_triggers_dir, name), '')
+
+    def has_deferred(self, name):
+        return os.path.exists('%s%s/%s' % (self.context.chroot_dir, self.deferred_triggers_dir, name))
+
+    def defer_triggers(self):
+        """
+        Divert commands that packages keep triggering (update-initramfs,
+        update-grub) to stubs that only note they were called, and stop
+        man-db from rebuilding its database, until L{undefer_triggers}.
+        L{run_deferred_triggers} then runs each of them once.
+        """
+        if not self.context.get_setting('defer-triggers'):
+            return
+        for path in self.deferred_commands():
+            self.run_in_target('dpkg-divert', '--local', '--rename', '--divert', '%s.vmbuilder' % path, '--add', path)
+            self.context.install_file(path, '#!/bin/sh\n# vmbuilder runs the real thing once at the end of the build\nmkdir -p %s\ntouch %s/%s\n'
+                                            % (self.deferred_triggers_dir, self.deferred_triggers_dir, os.path.basename(path)),
+                                      mode=0755)
+        auto_update = '%s/var/lib/man-db/auto-update' % self.context.chroot_dir
+        if os.path.exists(auto_update):
+            os.unlink(auto_update)
+            self.note_deferred('man-db')
+
+    def undefer_triggers(self):
+        if not self.context.get_setting('defer-triggers'):
+            return
+        for path in self.deferred_commands():
+            os.unlink('%s%s' % (self.context.chroot_dir, path))
+            self.run_in_target('dpkg-divert', '--local', '--rename', '--divert', '%s.vmbuilder' % path, '--remove', path)
+        if self.has_deferred('man-db') and os.path.isdir('%s/var/lib/man-db' % self.context.chroot_dir):
+            self.context.install_file('/var/lib/man-db/auto-update', '')
+
+    def run_deferred_triggers(self):
+        chroot_dir = self.context.chroot_dir
+        if self.has_deferred('update-initramfs'):
+            for version in os.listdir('%s/lib/modules' % chroot_dir):
+                if not os.path.exists('%s/boot/vmlinuz-%s' % (chroot_dir, version)):
+                    continue
+                if os.path.exists('%s/boot/initrd.img-%s' % (chroot_dir, version)):
+                    self.run_in_target('update-initramfs', '-u', '-k', version)
+                else:
+                    self.run_in_target('update-initramfs', '-c', '-k', version)
+            # The boot menu needs to know about the new initrds
+            self.note_deferred(os.path.basename(self.updategrub))
+        if (self.has_deferred(os.path.basename(self.updategrub)) and
+            os.path.exists('%s/boot/grub/menu.lst' % chroot_dir)):
+            self.run_in_target(self.updategrub)
+        if self.has_deferred('man-db') and os.path.exists('%s/usr/bin/mandb' % chroot_dir):
+            self.run_in_target('mandb', '--quiet')
+        shutil.rmtree('%s%s' % (chroot_dir, self.deferred_triggers_dir), ignore_errors=True)
+        try:
+            os.rmdir('%s%s' % (chroot_dir, os.path.dirname(self.deferred_triggers_dir)))
+        except OSError:
+            # Not empty, so something else keeps its state there
+            pass
 
     def seed(self, seedfile):
         """Seed debconf with the contents of a seedfile"""
@@ -210,35 +315,54 @@ class Dapper(suite.Suite):
 
         self.run_in_target('debconf-set-selections', stdin=open(seedfile, 'r').read())
 
-    def install_extras(self):
+    def plan_packages(self, plan):
+        plan.install(self.context.get_setting('addpkg') or [])
+        plan.remove(self.context.get_setting('removepkg') or [])
+        if self.context.get_setting('ssh-key') or self.context.get_setting('ssh-user-key'):
+            plan.install(['openssh-server'])
+        plan.install([self.kernel_name()])
+        plan.upgrade = True
+        self.packages_planned = True
+
+    def install_extras(self, plan):
         seedfile = self.context.get_setting('seedfile')
         if seedfile:
             self.seed(seedfile)
 
-        addpkg = self.context.get_setting('addpkg')
-        removepkg = self.context.get_setting('removepkg')
-        if not addpkg and not removepkg:
-            return
-
-        cmd = ['apt-get', 'install', '-y', '--force-yes']
-        cmd += addpkg or []
-        cmd += ['%s-' % pkg for pkg in removepkg or []]
-        self.run_in_target(env={ 'DEBIAN_FRONTEND' : 'noninteractive' }, *cmd)
+        if plan.installs(self.bootloader_packages):
+            # The kernel in the plan runs kernel-img.conf's hooks, but
+            # update-grub has no menu.lst to work on before
+            # install_menu_lst, so they do nothing until then
+            self.install_kernel_img_conf(hook='/bin/true')
+        env = { 'DEBIAN_FRONTEND' : 'noninteractive' }
+        for (install, remove, upgrade) in plan.transactions():
+            args = packages.apt_args(install, remove)
+            if upgrade and not self.apt_upgrade_takes_packages:
+                if args:
+                    self.run_in_target(env=env, *['apt-get', 'install', '-y', '--force-yes'] + args)
+                self.update()
+            else:
+                cmd = ['apt-get', upgrade and 'dist-upgrade' or 'install', '-y', '--force-yes']
+                self.run_in_target(env=env, *cmd + args)
 
     def unmount_volatile(self):
         for mntpnt in glob.glob('%s/lib/modules/*/volatile' % self.context.chroot_dir):
             logging.debug("Unmounting %s" % mntpnt)
-            run_cmd('umount', mntpnt)
+            unmount(mntpnt)
 
     def install_menu_lst(self, disks):
         self.run_in_target(self.updategrub, '-y')
         self.mangle_grub_menu_lst(disks)
-        self.run_in_target(self.updategrub)
+        if self.context.get_setting('defer-triggers'):
+            self.note_deferred(os.path.basename(self.updategrub))
+        else:
+            self.run_in_target(self.updategrub)
         self.run_in_target('grub-set-default', '0')
+        self.install_kernel_img_conf()
 
     def mangle_grub_menu_lst(self, disks):
         bootdev = disk.bootpart(disks)
-        run_cmd('sed', '-ie', 's/^# kopt=root=\([^ ]*\)\(.*\)/# kopt=root=\/dev\/hd%s%d\\2/g' % (bootdev.disk.devletters(), bootdev.get_index()+1), '%s/boot/grub/menu.lst' % self.context.chroot_dir)
+        run_cmd('sed', '-ie', 's/^# kopt=root=\([^ ]*\)\(.*\)/# kopt=root=\/dev\/hd%s%d\\2/g' % (bootdev.disk.devletters(), bootdev.get_number()), '%s/boot/grub/menu.lst' % self.context.chroot_dir)
         run_cmd('sed', '-ie', 's/^# groot.*/# groot %s/g' % bootdev.get_grub_id(), '%s/boot/grub/menu.lst' % self.context.chroot_dir)
         run_cmd('sed', '-ie', '/^# kopt_2_6/ d', '%s/boot/grub/menu.lst' % self.context.chroot_dir)
 
@@ -259,10 +383,31 @@ class Dapper(suite.Suite):
                                                                               'ppa' : ppa,
                                                                               'suite' : suite })
 
-        # If setting up the final mirror, allow apt-get update to fail
-        # (since we might be on a complete different network than the
-        # final vm is going to be on).
-        self.run_in_target('apt-get', 'update', ignore_fail=final)
+        if final and (mirror, updates_mirror, security_mirror) == self.install_mirrors():
+            logging.debug('Final sources.list matches the one used for installation, lists are up to date')
+            return
+
+        self.update_package_lists(final)
+
+    def update_package_lists(self, final=False):
+        lists_cache = self.context.lists_cache
+        if lists_cache:
+            inputs = { 'sources.list' : open('%s/etc/apt/sources.list' % self.context.chroot_dir).read(),
+                       'arch' : self.context.get_setting('arch') }
+            lists_cache.restore(self.context.chroot_dir, inputs)
+
+        try:
+            self.run_in_target('apt-get', 'update')
+        except VMBuilderException:
+            # If setting up the final mirror, allow apt-get update to fail
+            # (since we might be on a complete different network than the
+            # final vm is going to be on). Its lists are not worth caching.
+            if not final:
+                raise
+            return
+
+        if lists_cache:
+            lists_cache.store(self.context.chroot_dir, inputs)
 
     def install_apt_proxy(self):
         proxy = self.context.get_setting('proxy')
@@ -276,25 +421,78 @@ class Dapper(suite.Suite):
         self.install_from_template('/boot/grub/device.map', 'devicemap', { 'prefix' : self.disk_prefix })
 
     def debootstrap(self):
-        arch = self.context.get_setting('arch')
-        cmd = ['/usr/sbin/debootstrap', '--arch=%s' % arch]
-
-        variant = self.context.get_setting('variant')
-        if variant:
-            cmd += ['--variant=%s' % variant]
-
-        debootstrap_tarball = self.context.get_setting('debootstrap-tarball')
-        if debootstrap_tarball:
-            cmd += ['--unpack-tarball=%s' % debootstrap_tarball]
-
-        suite = self.context.get_setting('suite')
-        cmd += [suite, self.context.chroot_dir, self.debootstrap_mirror()]
-        kwargs = { 'env' : { 'DEBIAN_FRONTEND' : 'noninteractive' } }
-
-        proxy = self.context.get_setting('proxy')
-        if proxy:
-            kwargs['env']['http_proxy'] = proxy
-        run_cmd(*cmd, **kwargs)
+        apt_cache = self.context.apt_cache
+        archives = apt_cache and apt_cache.checkout()
+        try:
+            bootstrapper = VMBuilder.bootstrap.get_bootstrapper(self.context.get_setting('bootstrap-backend'),
+                                                                self.context.get_setting('arch'),
+                                                                variant=self.context.get_setting('variant'),
+                                                                debootstrap_tarball=self.context.get_setting('debootstrap-tarball'),
+                                                                proxy=self.context.get_setting('proxy'),
+                                                                archives=archives,
+                                                                tarball=self.context.get_setting('bootstrap-tarball'))
+            suite = self.context.get_setting('suite')
+            mirror = self.debootstrap_mirror()
+            tarball_cache = self.context.tarball_cache
+            if tarball_cache and bootstrapper.makes_tarballs and not bootstrapper.debootstrap_tarball:
+                inputs = { 'suite' : suite,
+                           'arch' : self.context.get_setting('arch'),
+                           'variant' : self.context.get_setting('variant'),
+                           'components' : self.context.get_setting('components'),
+                           'mirror' : mirror }
+                make = lambda tarball: bootstrapper.make_tarball(suite, tarball, mirror)
+                bootstrapper.debootstrap_tarball = tarball_cache.get(inputs, make)
+            bootstrapper.bootstrap(suite, self.context.chroot_dir, mirror)
+        finally:
+            if apt_cache:
+                apt_cache.checkin(archives)
+
+    def debootstrap_inputs(self):
+        """
+        The settings that determine the outcome of L{debootstrap}, used to
+        look up previously bootstrapped chroots in the cache.
+        """
+        tarballs = {}
+        for name in ['debootstrap-tarball', 'bootstrap-tarball']:
+            tarball = self.context.get_setting(name)
+            if tarball:
+                st = os.stat(tarball)
+                tarball = (os.path.abspath(tarball), st.st_size, int(st.st_mtime))
+            tarballs[name] = tarball
+        return { 'backend' : self.context.get_setting('bootstrap-backend'),
+                 'suite' : self.context.get_setting('suite'),
+                 'arch' : self.context.get_setting('arch'),
+                 'variant' : self.context.get_setting('variant'),
+                 'mirror' : self.install_mirrors()[0],
+                 'components' : self.context.get_setting('components'),
+                 'debootstrap-tarball' : tarballs['debootstrap-tarball'],
+                 'bootstrap-tarball' : tarballs['bootstrap-tarball'] }
+
+    def package_inputs(self):
+        """
+        The settings that determine the outcome of installing and upgrading
+        packages on top of the bootstrapped chroot.
+        """
+        return { 'addpkg' : self.context.get_setting('addpkg'),
+                 'removepkg' : self.context.get_setting('removepkg'),
+                 'seedfile' : file_fingerprint(self.context.get_setting('seedfile')),
+                 'mirrors' : self.install_mirrors(),
+                 'components' : self.context.get_setting('components'),
+                 'ppa' : self.context.get_setting('ppa'),
+                 'proxy' : self.context.get_setting('proxy') }
+
+    def config_inputs(self):
+        """
+        The settings that determine the outcome of the per-VM configuration
+        (initial user, ssh keys, timezone, locale, final sources.list).
+        """
+        inputs = dict([(name, self.context.get_setting(name))
+                       for name in ['user', 'name', 'pass', 'rootpass', 'uid', 'gid',
+                                    'lock-user', 'timezone', 'lang', 'mirror',
+                                    'security-mirror', 'components', 'ppa']])
+        for name in ['ssh-key', 'ssh-user-key']:
+            inputs[name] = file_fingerprint(self.context.get_setting(name))
+        return inputs
     
     def debootstrap_mirror(self):
         iso = self.context.get_setting('iso')
@@ -302,7 +500,7 @@ class Dapper(suite.Suite):
             isodir = tempfile.mkdtemp()
             self.context.add_clean_cb(lambda:os.rmdir(isodir))
             run_cmd('mount', '-o', 'loop', '-t', 'iso9660', iso, isodir)
-            self.context.add_clean_cmd('umount', isodir)
+            self.context.add_clean_cb(lambda: unmount(isodir, ignore_fail=True))
             self.iso_mounted = True
 
             return 'file://%s' % isodir
@@ -327,13 +525,16 @@ class Dapper(suite.Suite):
 
         return (mirror, updates_mirror, security_mirror)
 
+    def install_kernel_img_conf(self, hook=None):
+        self.install_from_template('/etc/kernel-img.conf', 'kernelimg', { 'updategrub' : hook or self.updategrub })
+
     def install_kernel(self, destdir):
         run_cmd('chroot', destdir, 'apt-get', '--force-yes', '-y', 'install', self.kernel_name(), env={ 'DEBIAN_FRONTEND' : 'noninteractive' })
 
     def install_grub(self, chroot_dir):
-        self.install_from_template('/etc/kernel-img.conf', 'kernelimg', { 'updategrub' : self.updategrub })
         arch = self.context.get_setting('arch')
-        self.run_in_target('apt-get', '--force-yes', '-y', 'install', 'grub', env={ 'DEBIAN_FRONTEND' : 'noninteractive' })
+        if not self.packages_planned:
+            self.run_in_target(env={ 'DEBIAN_FRONTEND' : 'noninteractive' }, *['apt-get', '--force-yes', '-y', 'install'] + self.bootloader_packages)
         run_cmd('rsync', '-a', '%s%s/%s/' % (chroot_dir, self.grubroot, arch == 'amd64' and 'x86_64-pc' or 'i386-pc'), '%s/boot/grub/' % chroot_dir) 
 
     def create_devices(self):
@@ -366,10 +567,11 @@ class Dapper(suite.Suite):
 
     def post_mount(self, fs):
         if fs.mntpnt == '/':
-            logging.debug("Creating /var/run in root filesystem")
-            os.makedirs('%s/var/run' % fs.mntpath)
-            logging.debug("Creating /var/lock in root filesystem")
-            os.makedirs('%s/var/lock' % fs.mntpath)
+            # A filesystem filled at mkfs time has them already
+            for dir in ['var/run', 'var/lock']:
+                if not os.path.isdir('%s/%s' % (fs.mntpath, dir)):
+                    logging.debug("Creating /%s in root filesystem" % dir)
+                    os.makedirs('%s/%s' % (fs.mntpath, dir))
 
     def set_locale(self):
         lang = self.context.get_setting('lang')
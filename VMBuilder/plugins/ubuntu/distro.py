@@ -21,8 +21,11 @@ import os
 import shutil
 import stat
 import VMBuilder
+import VMBuilder.bootstrap
+import VMBuilder.cache
+import VMBuilder.packages
 from   VMBuilder           import register_distro, Distro
-from   VMBuilder.util      import run_cmd
+from   VMBuilder.util      import run_cmd, unmount
 from   VMBuilder.exception import VMBuilderUserError, VMBuilderException
 
 class Ubuntu(Distro):
@@ -62,6 +65,10 @@ class Ubuntu(Distro):
         group.add_setting('flavour', extra_args=['--kernel-flavour'], help='Kernel flavour to use. Default and valid options depend on architecture and suite')
         group.add_setting('variant', metavar='VARIANT', help='Passed to debootstrap --variant flag; use minbase, buildd, or fakechroot.')
         group.add_setting('debootstrap-tarball', metavar='FILE', help='Passed to debootstrap --unpack-tarball flag.')
+        group.add_setting('bootstrap-backend', metavar='BACKEND', default='debootstrap', valid_options=sorted(VMBuilder.bootstrap.backends.keys()), help='Tool to create the initial chroot with: debootstrap, mmdebstrap (resolves dependencies with apt and downloads in parallel) or tarball (unpacks --bootstrap-tarball). [default: %default]')
+        group.add_setting('defer-triggers', type='bool', default=False, help='Run update-initramfs, update-grub and man-db\'s database update once at the end of the build instead of every time a package triggers them. [default: %default]')
+        group.add_setting('unsafe-io', type='bool', default=False, help='Don\'t let dpkg (or anything else, if eatmydata is installed in the guest) fsync while installing packages. Much faster, but a crash of the build host leaves a broken guest. [default: %default]')
+        group.add_setting('bootstrap-tarball', metavar='FILE', help='Root filesystem tarball to unpack with the tarball bootstrap backend.')
         group.add_setting('iso', metavar='PATH', help='Use an iso image as the source for installation of file. Full path to the iso must be provided. If --mirror is also provided, it will be used in the final sources.list of the vm.  This requires suite and kernel parameter to match what is available on the iso, obviously.')
         group.add_setting('mirror', metavar='URL', help='Use Ubuntu mirror at URL instead of the default, which is http://archive.ubuntu.com/ubuntu for official arches and http://ports.ubuntu.com/ubuntu-ports otherwise')
         group.add_setting('proxy', metavar='URL', help='Use proxy at URL for cached packages')
@@ -87,6 +94,12 @@ class Ubuntu(Distro):
         group.add_setting('ssh-user-key', help='Add PATH to the user\'s ~/.ssh/authorized_keys.')
         group.add_setting('manifest', metavar='PATH', help='If passed, a manifest will be written to PATH')
 
+        group = self.setting_group('Cache options')
+        group.add_setting('cache-dir', metavar='DIR', help='Keep the chroot in DIR after bootstrapping, after installing packages and after configuring it, and reuse these layers for later builds with the same settings.')
+        group.add_setting('apt-cache-size', type='int', metavar='SIZE', default=2048, help='Keep at most SIZE MB of downloaded packages in the cache dir, dropping the least recently used ones first. [default: %default]')
+        group.add_setting('debootstrap-tarball-ttl', type='int', metavar='DAYS', default=7, help='When bootstrapping with debootstrap and no --debootstrap-tarball, download the packages into a tarball in the cache dir first and reuse it for DAYS days. 0 disables this. [default: %default]')
+        group.add_setting('cache-backend', metavar='BACKEND', default='copy', valid_options=sorted(VMBuilder.cache.backends.keys()), help='How to store cached chroot layers: copy (full copies), overlayfs (layers share their lower dirs) or btrfs (subvolume snapshots; DIR and the chroot must be on the same btrfs filesystem). [default: %default]')
+
     def set_defaults(self):
         arch = self.get_setting('arch')
 
@@ -127,6 +140,20 @@ class Ubuntu(Distro):
 
         self.context.virtio_net = self.use_virtio_net()
 
+        cachedir = self.get_setting('cache-dir')
+        if cachedir:
+            self.apt_cache = VMBuilder.cache.AptArchiveCache(cachedir, self.get_setting('apt-cache-size'))
+            self.lists_cache = VMBuilder.cache.AptListsCache(cachedir)
+        else:
+            self.apt_cache = None
+            self.lists_cache = None
+        # An iso is mounted at a different temporary mirror path every time
+        ttl = self.get_setting('debootstrap-tarball-ttl')
+        if cachedir and ttl and not self.get_setting('iso'):
+            self.tarball_cache = VMBuilder.cache.TarballCache(cachedir, ttl)
+        else:
+            self.tarball_cache = None
+
         # check if the seedfile exists if one is to be used
         seedfile = self.context.get_setting('seedfile')
         if seedfile and not os.path.exists(seedfile):
@@ -141,21 +168,54 @@ class Ubuntu(Distro):
 #            self.apply_ec2_settings()
 
     def bootstrap(self):
-        self.suite.debootstrap()
+        cachedir = self.get_setting('cache-dir')
+        if cachedir and not self.get_setting('iso'):
+            self.chroot_cache = VMBuilder.cache.get_chroot_cache(cachedir, self.get_setting('cache-backend'))
+        self.build_layer(self.suite.debootstrap_inputs(), self.suite.debootstrap)
         self.suite.pre_install()
 
     def configure_os(self):
+        plan = VMBuilder.packages.PackagePlan()
+        self.call_hooks('plan_packages', plan)
+        self.build_layer(dict(self.suite.package_inputs(), plan=plan.transactions()),
+                         lambda: self.install_packages(plan))
+        self.build_layer(self.suite.config_inputs(), self.configure_guest)
+        self.suite.create_manifest()
+
+    def plan_packages(self, plan):
+        self.suite.plan_packages(plan)
+
+    def bootloader_packages(self):
+        return self.suite.bootloader_packages
+
+    def build_inputs(self):
+        return { 'debootstrap' : self.suite.debootstrap_inputs(),
+                 'packages' : self.suite.package_inputs(),
+                 'config' : self.suite.config_inputs() }
+
+    def install_packages(self, plan):
         self.suite.install_apt_proxy()
         self.suite.install_sources_list()
         self.suite.create_devices()
         self.suite.prevent_daemons_starting()
         self.suite.mount_dev_proc()
-        self.suite.install_extras()
+        self.suite.mount_apt_archives()
+        self.suite.install_extras(plan)
+        self.suite.unmount_apt_archives()
+        self.suite.run_in_target('apt-get', 'clean');
+        self.suite.unmount_volatile()
+        self.suite.unmount_proc()
+        self.suite.unmount_dev_pts()
+        self.suite.unmount_dev()
+        self.suite.unprevent_daemons_starting()
+
+    def configure_guest(self):
+        self.suite.prevent_daemons_starting()
+        self.suite.mount_dev_proc()
         self.suite.create_initial_user()
         self.suite.install_authorized_keys()
         self.suite.set_timezone()
         self.suite.set_locale()
-        self.suite.update()
         self.suite.install_sources_list(final=True)
         self.suite.run_in_target('apt-get', 'clean');
         self.suite.unmount_volatile()
@@ -163,7 +223,6 @@ class Ubuntu(Distro):
         self.suite.unmount_dev_pts()
         self.suite.unmount_dev()
         self.suite.unprevent_daemons_starting()
-        self.suite.create_manifest()
         self.suite.config_ssh()
 
     def configure_networking(self, nics):
@@ -191,11 +250,35 @@ class Ubuntu(Distro):
         tmpdir = '%s/tmp/vmbuilder-grub' % chroot_dir
         for disk in os.listdir(tmpdir):
             if disk != 'device.map':
-                run_cmd('umount', os.path.join(tmpdir, disk))
+                unmount(os.path.join(tmpdir, disk))
         shutil.rmtree(tmpdir)
 
     def install_kernel(self, destdir):
-        self.suite.install_kernel(destdir)
+        if self.suite.packages_planned:
+            # It went in with the rest of the package plan
+            return
+        self.suite.mount_apt_archives()
+        try:
+            self.suite.defer_triggers()
+            try:
+                self.suite.install_kernel(destdir)
+            finally:
+                self.suite.undefer_triggers()
+        finally:
+            self.suite.unmount_apt_archives()
+
+    def run_deferred_triggers(self):
+        # update-initramfs and friends look at /proc and /sys, which
+        # nothing else has mounted at this point (with --only-chroot in
+        # particular)
+        self.suite.mount_dev_proc()
+        self.suite.mount_sys()
+        self.suite.run_deferred_triggers()
+        self.suite.unmount_volatile()
+        self.suite.unmount_sys()
+        self.suite.unmount_proc()
+        self.suite.unmount_dev_pts()
+        self.suite.unmount_dev()
 
     def install_bootloader(self, chroot_dir, disks):
         root_dev = VMBuilder.disk.bootpart(disks).get_grub_id()
@@ -208,8 +291,8 @@ class Ubuntu(Distro):
         for (disk, id) in zip(disks, range(len(disks))):
             new_filename = os.path.join(tmpdir, os.path.basename(disk.filename))
             open('%s%s' % (chroot_dir, new_filename), 'w').close()
-            run_cmd('mount', '--bind', disk.filename, '%s%s' % (chroot_dir, new_filename))
-            st = os.stat(disk.filename)
+            run_cmd('mount', '--bind', disk.path(), '%s%s' % (chroot_dir, new_filename))
+            st = os.stat(disk.path())
             if stat.S_ISBLK(st.st_mode):
                 for (part, part_id) in zip(disk.partitions, range(len(disk.partitions))):
                     part_mountpnt = '%s%s%d' % (chroot_dir, new_filename, part_id+1)
@@ -218,7 +301,9 @@ class Ubuntu(Distro):
             devmap.write("(hd%d) %s\n" % (id, new_filename))
         devmap.close()
         run_cmd('cat', '%s%s' % (chroot_dir, devmapfile))
+        self.suite.mount_apt_archives()
         self.suite.install_grub(chroot_dir)
+        self.suite.unmount_apt_archives()
         self.run_in_target('grub', '--device-map=%s' % devmapfile, '--batch',  stdin='''root %s
 setup (hd0)
 EOT''' % root_dev) 
@@ -20,4 +20,4 @@ import time
 from VMBuilder.plugins.ubuntu.wily import Wily
 
 class Xenial(Wily):
-    pass
+    apt_upgrade_takes_packages = True
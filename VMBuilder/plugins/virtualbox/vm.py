@@ -37,11 +37,13 @@ class VirtualBox(Hypervisor):
         group.add_setting('cpus', type='int', default=1, help='Assign NUM cpus to the guest vm. [default: %default]')
         group.add_setting('vbox-disk-format', metavar='FORMAT', default='vdi', help='Desired disk format. Valid options are: vdi vmdk. [default: %default]')
 
+    def disk_format(self):
+        return self.context.get_setting('vbox-disk-format')
+
     def convert(self, disks, destdir):
-        self.imgs = []
-        for disk in disks:
-            img_path = disk.convert(destdir, self.context.get_setting('vbox-disk-format'))
-            self.imgs.append(img_path)
+        format = self.disk_format()
+        options = self.convert_options()
+        self.imgs = self.convert_each(lambda disk: disk.convert(destdir, format, options), disks)
 
     def deploy(self,destdir):
         hostname = self.context.distro.get_setting('hostname')
@@ -22,7 +22,7 @@ import VMBuilder.hypervisor
 import os
 import os.path
 import stat
-from shutil import move
+from VMBuilder.artifact import place_artifact
 from math import floor
 
 class VMWare(Hypervisor):
@@ -37,10 +37,9 @@ class VMWare(Hypervisor):
         group.add_setting('cpus', type='int', default=1, help='Assign NUM cpus to the guest vm. [default: %default]')
 
     def convert(self, disks, destdir):
-        self.imgs = []
-        for disk in self.get_disks():
-            img_path = disk.convert(destdir, self.filetype)
-            self.imgs.append(img_path)
+        options = self.convert_options()
+        self.imgs = self.convert_each(lambda disk: disk.convert(destdir, self.filetype, options), self.get_disks())
+        for img_path in self.imgs:
             self.call_hooks('fix_ownership', img_path)
 
     def get_disks(self):
@@ -90,35 +89,40 @@ class VMWareEsxi(VMWare):
 
     vmdks = [] # vmdk filenames used when deploying vmx file
 
+    def disk_format(self):
+        # The raw image becomes the -flat.vmdk
+        return 'raw'
+
     def convert(self, disks, destdir):
         self.imgs = []
-        for disk in disks:
+        self.vmdks = self.convert_each(lambda disk: self.convert_disk(disk, destdir), disks)
 
-            # Move raw image to <imagename>-flat.vmdk
-            diskfilename = os.path.basename(disk.filename)
-            if '.' in diskfilename:
-                diskfilename = diskfilename[:diskfilename.rindex('.')]
+    def convert_disk(self, disk, destdir):
+        # Move raw image to <imagename>-flat.vmdk
+        diskfilename = os.path.basename(disk.filename)
+        if '.' in diskfilename:
+            diskfilename = diskfilename[:diskfilename.rindex('.')]
 
-            flat = '%s/%s-flat.vmdk' % (destdir, diskfilename)
-            self.vmdks.append(diskfilename)
+        flat = '%s/%s-flat.vmdk' % (destdir, diskfilename)
 
-            move(disk.filename, flat)
+        place_artifact(disk.filename, flat)
 
-            self.call_hooks('fix_ownership', flat)
+        self.call_hooks('fix_ownership', flat)
 
-            # Create disk descriptor file
-            sectorTotal = disk.size * 2048
-            sector = int(floor(sectorTotal / 16065)) # pseudo geometry
+        # Create disk descriptor file
+        sectorTotal = disk.size * 2048
+        sector = int(floor(sectorTotal / 16065)) # pseudo geometry
 
-            diskdescriptor = VMBuilder.util.render_template('vmware', self.context, 'flat.vmdk',  { 'adaptertype' : self.adaptertype, 'sectors' : sector, 'diskname' : os.path.basename(flat), 'disksize' : sectorTotal })
-            vmdk = '%s/%s.vmdk' % (destdir, diskfilename)
+        diskdescriptor = VMBuilder.util.render_template('vmware', self.context, 'flat.vmdk',  { 'adaptertype' : self.adaptertype, 'sectors' : sector, 'diskname' : os.path.basename(flat), 'disksize' : sectorTotal })
+        vmdk = '%s/%s.vmdk' % (destdir, diskfilename)
 
-            fp = open(vmdk, 'w')
-            fp.write(diskdescriptor)
-            fp.close()
-            os.chmod(vmdk, stat.S_IRWXU | stat.S_IRWXU | stat.S_IROTH | stat.S_IXOTH)
+        fp = open(vmdk, 'w')
+        fp.write(diskdescriptor)
+        fp.close()
+        os.chmod(vmdk, stat.S_IRWXU | stat.S_IRWXU | stat.S_IROTH | stat.S_IXOTH)
 
-            self.call_hooks('fix_ownership', vmdk)
+        self.call_hooks('fix_ownership', vmdk)
+        return diskfilename
 
     def get_disks(self):
         return self.vmdks
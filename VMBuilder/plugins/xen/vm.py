@@ -17,7 +17,7 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 from   VMBuilder      import register_hypervisor, Hypervisor
-from   VMBuilder.util import run_cmd
+from   VMBuilder.artifact import place_artifact
 import VMBuilder
 import VMBuilder.hypervisor
 import logging
@@ -36,16 +36,8 @@ class Xen(Hypervisor):
         group.add_setting('mem', extra_args=['-m'], type='int', default=128, help='Assign MEM megabytes of memory to the guest vm. [default: %default]')
 
     def convert(self, filesystems, destdir):
-        destimages = []
-        for filesystem in filesystems:
-            if not filesystem.preallocated:
-                destfile = '%s/%s' % (destdir, os.path.basename(filesystem.filename))
-                logging.info('Moving %s to %s' % (filesystem.filename, destfile))
-                run_cmd('cp', '--sparse=always', filesystem.filename, destfile)
-                self.call_hooks('fix_ownership', destfile)
-                os.unlink(filesystem.filename)
-                filesystem.filename = os.path.abspath(destfile)
-                destimages.append(destfile)
+        destimages = self.convert_each(lambda filesystem: self.move_filesystem(filesystem, destdir),
+                                       [filesystem for filesystem in filesystems if not filesystem.preallocated])
 
         if not self.context.get_setting('xen-kernel'):
             self.context.xen_kernel = self.context.distro.xen_kernel_path()
@@ -86,4 +78,11 @@ extra = 'xencons=tty console=tty1 console=hvc0'
         fp.close()
         self.call_hooks('fix_ownership', xenconf)
 
+    def move_filesystem(self, filesystem, destdir):
+        destfile = '%s/%s' % (destdir, os.path.basename(filesystem.filename))
+        place_artifact(filesystem.filename, destfile)
+        self.call_hooks('fix_ownership', destfile)
+        filesystem.filename = os.path.abspath(destfile)
+        return destfile
+
 register_hypervisor(Xen)
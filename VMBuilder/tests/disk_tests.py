@@ -107,12 +107,12 @@ class TestDetectSize(TestCase):
         self.imgdev = None
 
     def test_detect_size_file(self):
-        self.assertTrue(detect_size(self.tmpfile), 5*1024)
+        self.assertEqual(detect_size(self.tmpfile), 5*1024)
 
     @testtools.skipIf(os.geteuid() != 0, 'Needs root to run')
     def test_detect_size_loopback_dev(self):
         self.imgdev = run_cmd('losetup', '-f', '--show', self.tmpfile).strip()
-        self.assertTrue(detect_size(self.imgdev), 5*1024)
+        self.assertEqual(detect_size(self.imgdev), 5*1024)
 
     def test_detect_size_fifo(self):
         os.unlink(self.tmpfile)
@@ -243,7 +243,7 @@ Sector size (logical/physical): 512B/512B
 Partition Table: msdos
 
 Number  Start   End     Size    Type     File system  Flags
- 1      1049kB  1023MB  1022MB  primary''' % self.tmpfile, file_output.strip())
+ 1      1049kB  1074MB  1073MB  primary''' % self.tmpfile, file_output.strip())
 
     @testtools.skipIf(os.geteuid() != 0, 'Needs root to run')
     def test_map_partitions(self):
@@ -251,8 +251,8 @@ Number  Start   End     Size    Type     File system  Flags
         self.disk.partition()
         self.disk.map_partitions()
         try:
-            from VMBuilder.disk import detect_size
-            self.assertEqual(detect_size(self.disk.partitions[0].filename), 1023000576)
+            from VMBuilder.imageinfo import image_size
+            self.assertEqual(image_size(self.disk.partitions[0].filename), 1072693248)
         except:
             raise
         finally:
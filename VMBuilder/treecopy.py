@@ -0,0 +1,275 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Copying a tree onto the guest's filesystems with several rsyncs at once
+
+import logging
+import os
+import stat
+import time
+from   multiprocessing.pool import ThreadPool
+from   VMBuilder.util       import run_cmd, tmp_filename
+
+RSYNC_FLAGS = ['-aHAX', '--sparse', '--numeric-ids']
+
+# How many bytes cost as much to copy as creating one file. Used to weigh
+# subtrees of small files against subtrees of a few big ones.
+BYTES_PER_ENTRY = 64 * 1024
+
+class Subtree(object):
+    """
+    What L{scan} found in one directory of the source tree.
+
+    @type  rel: string
+    @param rel: Path relative to the top of the tree ('' for the top)
+    """
+    def __init__(self, rel):
+        self.rel = rel
+        # Directories right below this one
+        self.subdirs = []
+        # Relative paths of everything else right below this one
+        self.others = []
+        # Entries and bytes in the whole subtree, this directory included
+        self.entries = 1
+        self.bytes = 0
+
+    def weight(self):
+        return self.entries + self.bytes / BYTES_PER_ENTRY
+
+def join_rel(rel, name):
+    return rel and '%s/%s' % (rel, name) or name
+
+def scan(src, links=None):
+    """
+    Walk the tree below src.
+
+    @type  links: dict
+    @param links: If given, filled with (dev, ino) => relative paths for
+                  every file with more than one link
+    @rtype:  L{Subtree}
+    @return: The top of the tree
+    """
+    def _scan(rel):
+        tree = Subtree(rel)
+        path = os.path.join(src, rel)
+        for name in sorted(os.listdir(path)):
+            child = join_rel(rel, name)
+            st = os.lstat(os.path.join(path, name))
+            if stat.S_ISDIR(st.st_mode):
+                sub = _scan(child)
+                tree.subdirs.append(sub)
+                tree.entries += sub.entries
+                tree.bytes += sub.bytes
+                continue
+            tree.others.append(child)
+            tree.entries += 1
+            if stat.S_ISREG(st.st_mode):
+                if st.st_nlink > 1 and links is not None:
+                    inode = (st.st_dev, st.st_ino)
+                    if inode in links:
+                        # Only count the data once
+                        links[inode].append(child)
+                        continue
+                    links[inode] = [child]
+                tree.bytes += st.st_size
+        return tree
+    return _scan('')
+
+def mountpoint_of(rel, mountpoints):
+    """Return the deepest of mountpoints (relative paths) that rel is on"""
+    best = ''
+    for mntpnt in mountpoints:
+        if (rel == mntpnt or rel.startswith(mntpnt + '/') or not mntpnt) and len(mntpnt) >= len(best):
+            best = mntpnt
+    return best
+
+def plan(tree, mountpoints, workers, filled=[]):
+    """
+    Divide a scanned tree into a skeleton and a set of jobs.
+
+    The skeleton holds every directory that gets split up, the files right
+    inside them and the (empty) directories the jobs fill. It is copied
+    first, by a single rsync. Each job then copies one or more whole
+    subtrees.
+
+    Directories are split when they hold more than their fair share of
+    the tree, so that no job ends up much bigger than the rest. Mountpoints
+    and the directories leading to them are always split, so that no job
+    spans two filesystems and different filesystems can be filled at the
+    same time.
+
+    @type  tree: L{Subtree}
+    @param tree: The top of the tree, as returned by L{scan}
+    @type  mountpoints: list
+    @param mountpoints: Mountpoints relative to the top of the tree
+    @type  workers: int
+    @param workers: Number of rsyncs that will run at a time
+    @type  filled: list
+    @param filled: Those of mountpoints that are left out of the skeleton
+                   and the jobs altogether
+    @rtype:  tuple
+    @return: The skeleton (a list of relative paths) and the jobs (lists
+             of relative paths), the jobs interleaved across mountpoints,
+             biggest first
+    """
+    mountpoints = [mntpnt.strip('/') for mntpnt in mountpoints]
+    always_split = set([''])
+    for mntpnt in mountpoints:
+        parts = mntpnt.split('/')
+        for i in range(len(parts)):
+            always_split.add('/'.join(parts[:i+1]))
+
+    # A handful of jobs per worker keeps them all busy until the end
+    chunk = max(tree.weight() / (workers * 4), 1)
+
+    skeleton = []
+    subtrees = {}
+    def visit(subtree):
+        if subtree.rel:
+            skeleton.append(subtree.rel)
+        if subtree.rel in always_split or subtree.weight() > chunk:
+            skeleton.extend(subtree.others)
+            for sub in subtree.subdirs:
+                visit(sub)
+        else:
+            subtrees.setdefault(mountpoint_of(subtree.rel, mountpoints), []).append(subtree)
+    visit(tree)
+
+    filled = set([mntpnt.strip('/') for mntpnt in filled])
+    skeleton = [rel for rel in skeleton if mountpoint_of(rel, mountpoints) not in filled]
+
+    # Pack the subtrees into jobs of about chunk in size, per mountpoint
+    queues = []
+    for mntpnt in sorted(subtrees):
+        if mntpnt in filled:
+            continue
+        jobs = []
+        job, size = [], 0
+        for subtree in sorted(subtrees[mntpnt], key=lambda x: -x.weight()):
+            job.append(subtree.rel)
+            size += subtree.weight()
+            if size >= chunk:
+                jobs.append((size, job))
+                job, size = [], 0
+        if job:
+            jobs.append((size, job))
+        jobs.sort(key=lambda x: -x[0])
+        queues.append([job for (size, job) in jobs])
+
+    # Round robin across mountpoints
+    jobs = []
+    while queues:
+        for queue in list(queues):
+            jobs.append(queue.pop(0))
+            if not queue:
+                queues.remove(queue)
+    return skeleton, jobs
+
+def rsync_list(src, dest, paths, recursive):
+    """Copy paths (relative to src) from src to dest with a single rsync"""
+    listfile = tmp_filename()
+    try:
+        fp = open(listfile, 'w')
+        fp.write(''.join(['%s\0' % path for path in paths]))
+        fp.close()
+        cmd = ['rsync'] + RSYNC_FLAGS + ['--from0', '--files-from=%s' % listfile]
+        if recursive:
+            cmd += ['--recursive']
+        run_cmd(*(cmd + ['%s/' % src, '%s/' % dest]))
+    finally:
+        os.unlink(listfile)
+
+def fix_hardlinks(dest, links):
+    """
+    Files linked to each other from different jobs end up as separate
+    copies. Link them back together, on each filesystem they span.
+
+    @rtype:  list
+    @return: The paths (relative to dest) that got linked back
+    """
+    relinked = []
+    for paths in links.values():
+        if len(paths) < 2:
+            continue
+        # Links can't span filesystems, so there's one master per device
+        masters = {}
+        for rel in paths:
+            path = os.path.join(dest, rel)
+            st = os.lstat(path)
+            if st.st_dev not in masters:
+                masters[st.st_dev] = (path, st.st_ino)
+                continue
+            (master, ino) = masters[st.st_dev]
+            if st.st_ino == ino:
+                continue
+            tmp = '%s.vmbuilder-link' % path
+            os.link(master, tmp)
+            os.rename(tmp, path)
+            relinked.append(rel)
+    return relinked
+
+def copy_tree(src, dest, mountpoints=['/'], workers=4, filled=[]):
+    """
+    Copy the tree below src onto dest, the guest's filesystems mounted
+    below it, using a pool of rsyncs. Hardlinks, ACLs, xattrs and sparse
+    files are preserved.
+
+    @type  mountpoints: list
+    @param mountpoints: Mountpoints of the guest's filesystems
+    @type  workers: int
+    @param workers: Number of rsyncs to run at a time
+    @type  filled: list
+    @param filled: Those of mountpoints whose filesystems hold their part
+                   of the tree already. Nothing gets copied onto them.
+    """
+    start = time.time()
+    links = {}
+    tree = scan(src, links)
+    (skeleton, jobs) = plan(tree, mountpoints, workers, filled)
+    logging.info('Copying %d files (%d MB) in %d jobs with %d workers' %
+                 (tree.entries, tree.bytes / 1024 / 1024, len(jobs), workers))
+
+    rsync_list(src, dest, skeleton, recursive=False)
+    def _job(paths):
+        job_start = time.time()
+        rsync_list(src, dest, paths, recursive=True)
+        logging.debug('Copied %s in %.1fs' % (', '.join(paths[:3]) + (len(paths) > 3 and ', ...' or ''),
+                                              time.time() - job_start))
+    if jobs:
+        pool = ThreadPool(min(workers, len(jobs)))
+        try:
+            pool.map(_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    relinked = fix_hardlinks(dest, links)
+    if relinked:
+        logging.debug('Relinked %d hardlinks spanning jobs' % len(relinked))
+
+    # Filling the skeleton's directories (and relinking) bumped their
+    # mtimes, so copy their metadata over once more
+    dirs = set([rel for rel in skeleton if stat.S_ISDIR(os.lstat(os.path.join(src, rel)).st_mode)])
+    dirs.update([os.path.dirname(rel) or '.' for rel in relinked])
+    dirs.add('.')
+    rsync_list(src, dest, sorted(dirs), recursive=False)
+
+    elapsed = max(time.time() - start, 0.001)
+    logging.info('Copied %d MB in %.1fs (%.1f MB/s, %d files/s)' %
+                 (tree.bytes / 1024 / 1024, elapsed,
+                  tree.bytes / 1024.0 / 1024 / elapsed, tree.entries / elapsed))
@@ -22,9 +22,13 @@ import errno
 import fcntl
 import logging
 import os.path
+import re
 import select
 import subprocess
 import tempfile
+import threading
+import time
+from   multiprocessing.pool import ThreadPool
 from   exception        import VMBuilderException, VMBuilderUserError
 
 class NonBlockingFile(object):
@@ -94,7 +98,9 @@ def run_cmd(*argv, **kwargs):
     proc_env.update(env)
 
     try:
-        proc = subprocess.Popen(args, stdin=stdin_arg, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=proc_env)
+        # Without close_fds, commands run from other threads would hold on to
+        # this one's pipes and keep us from seeing it exit
+        proc = subprocess.Popen(args, stdin=stdin_arg, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=proc_env, close_fds=True)
     except OSError, error:
         if error.errno == errno.ENOENT:
             raise VMBuilderUserError, "Couldn't find the program '%s' on your system" % (argv[0])
@@ -172,6 +178,172 @@ def call_hooks(context, func, *args, **kwargs):
         logging.debug('No such method ({}) in context plugin ({})'.format(
             func, plugin.__module__))
 
+# How long to wait for devices and mounts to come and go, in seconds
+WAIT_TIMEOUT = 30
+
+def backoff(timeout=WAIT_TIMEOUT, delay=0.05, max_delay=2):
+    """
+    Yield attempt numbers (starting at 1) until timeout seconds have
+    passed, sleeping twice as long between each (up to max_delay).
+    """
+    deadline = time.time() + timeout
+    attempt = 1
+    while True:
+        yield attempt
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+        attempt += 1
+
+def wait_for(condition, description, timeout=WAIT_TIMEOUT):
+    """
+    Wait for condition() to return something true.
+
+    @type  description: string
+    @param description: What is being waited for, for the log
+    @return: What condition() returned
+    @raise VMBuilderException: condition() was still false after timeout
+                               seconds
+    """
+    for attempt in backoff(timeout):
+        result = condition()
+        if result:
+            return result
+        logging.debug('Waiting for %s (attempt %d)' % (description, attempt))
+    raise VMBuilderException('Gave up waiting for %s after %d seconds' % (description, timeout))
+
+def retry(func, description, timeout=WAIT_TIMEOUT, exceptions=(VMBuilderException,)):
+    """
+    Call func until it stops raising any of exceptions.
+
+    @return: What func() returned
+    @raise Exception: The last exception func() raised, if it still
+                      failed after timeout seconds
+    """
+    for attempt in backoff(timeout):
+        try:
+            return func()
+        except exceptions, e:
+            logging.debug('%s failed (attempt %d): %s' % (description, attempt, e))
+            failure = e
+    raise failure
+
+def is_mounted(path):
+    """Whether something is mounted on path, according to /proc/self/mountinfo"""
+    path = os.path.realpath(path)
+    fp = open('/proc/self/mountinfo', 'r')
+    try:
+        for line in fp:
+            mntpnt = line.split(' ')[4]
+            # Spaces and such are escaped as octal
+            mntpnt = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), mntpnt)
+            if mntpnt == path:
+                return True
+    finally:
+        fp.close()
+    return False
+
+def has_holders(device):
+    """Whether anything (device-mapper, md, ...) is built on top of a block device"""
+    holders = '/sys/class/block/%s/holders' % os.path.basename(os.path.realpath(device))
+    return os.path.isdir(holders) and bool(os.listdir(holders))
+
+def unmount(path, timeout=WAIT_TIMEOUT, ignore_fail=False):
+    """
+    Unmount path, trying again for as long as it's busy, and wait for it
+    to be gone from the mount table.
+    """
+    def _unmount():
+        if is_mounted(path):
+            run_cmd('umount', path)
+    try:
+        retry(_unmount, 'Unmounting %s' % path, timeout)
+        wait_for(lambda: not is_mounted(path), '%s to be unmounted' % path, timeout)
+    except VMBuilderException, e:
+        if not ignore_fail:
+            raise
+        logging.debug('Leaving %s mounted: %s' % (path, e))
+
+def parallel_map(func, items, workers):
+    """
+    Like map(func, items), with up to workers calls running at a time.
+
+    @rtype:  list
+    @return: The results, in the order of items
+    """
+    if not items:
+        return []
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        result = pool.map_async(func, items)
+        # A timeout keeps the wait interruptible
+        while not result.ready():
+            result.wait(1)
+        return result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+class JobPool(object):
+    """
+    Runs jobs on a pool of threads. Jobs can add further jobs, which is
+    how one piece of work gets to start as soon as the one it depends on
+    is done, without holding up anything else.
+
+    Once a job fails, jobs that haven't started yet are skipped.
+
+    @type  workers: int
+    @param workers: Number of jobs to run at a time
+    """
+    def __init__(self, workers):
+        self.pool = ThreadPool(workers)
+        self.lock = threading.Lock()
+        self.results = []
+        self.failed = False
+        self.closed = False
+        self.timings = []
+        "(description, seconds) for every job that finished, in the order they did."
+
+    def add(self, description, func, *args):
+        """Queue up func(*args)"""
+        def _job():
+            if self.failed:
+                return
+            start = time.time()
+            try:
+                func(*args)
+            except:
+                self.failed = True
+                raise
+            with self.lock:
+                self.timings.append((description, time.time() - start))
+        with self.lock:
+            if self.closed:
+                return
+            self.results.append(self.pool.apply_async(_job))
+
+    def wait(self):
+        """
+        Wait for all the jobs (including the ones added along the way) to
+        finish, and raise the first exception any of them raised.
+        """
+        try:
+            i = 0
+            while i < len(self.results):
+                result = self.results[i]
+                # A timeout keeps the wait interruptible
+                while not result.ready():
+                    result.wait(1)
+                result.get()
+                i += 1
+        finally:
+            with self.lock:
+                self.closed = True
+            self.pool.close()
+            self.pool.join()
+
 def tmp_filename(suffix='', tmp_root=None):
     # There is a risk in using tempfile.mktemp(): it's not recommended
     # to run vmbuilder on machines with untrusted users.
@@ -0,0 +1,68 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import tempfile
+import unittest
+
+from VMBuilder.artifact import place_artifact, sparse_copy
+
+MiB = 1024 * 1024
+
+class TestPlaceArtifact(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src.img')
+        # Data at the start and in the middle, holes everywhere else
+        fp = open(self.src, 'wb')
+        fp.write('a' * MiB)
+        fp.seek(16 * MiB)
+        fp.write('b' * MiB)
+        fp.truncate(32 * MiB)
+        fp.close()
+        self.contents = open(self.src, 'rb').read()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_rename(self):
+        dest = os.path.join(self.dir, 'dest.img')
+        self.assertEqual(place_artifact(self.src, dest), 'rename')
+        self.assertFalse(os.path.exists(self.src))
+        self.assertEqual(open(dest, 'rb').read(), self.contents)
+
+    def test_sparse_copy(self):
+        dest = os.path.join(self.dir, 'dest.img')
+        srcfp = open(self.src, 'rb')
+        destfp = open(dest, 'wb')
+        sparse_copy(srcfp.fileno(), destfp.fileno())
+        destfp.close()
+        srcfp.close()
+        self.assertEqual(open(dest, 'rb').read(), self.contents)
+        self.assertTrue(os.stat(dest).st_blocks <= os.stat(self.src).st_blocks)
+
+    def test_empty_file(self):
+        empty = os.path.join(self.dir, 'empty.img')
+        dest = os.path.join(self.dir, 'dest.img')
+        open(empty, 'wb').truncate(MiB)
+        srcfp = open(empty, 'rb')
+        destfp = open(dest, 'wb')
+        sparse_copy(srcfp.fileno(), destfp.fileno())
+        destfp.close()
+        srcfp.close()
+        self.assertEqual(os.path.getsize(dest), MiB)
@@ -0,0 +1,125 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import distutils.spawn
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import VMBuilder.bootstrap
+from VMBuilder.bootstrap import get_bootstrapper, Debootstrap, Mmdebstrap
+from VMBuilder.exception import VMBuilderUserError
+
+class TestBootstrapBackends(unittest.TestCase):
+    def test_get_bootstrapper(self):
+        self.assertTrue(isinstance(get_bootstrapper('debootstrap', 'amd64'), Debootstrap))
+        self.assertTrue(isinstance(get_bootstrapper('mmdebstrap', 'amd64', variant='minbase'), Mmdebstrap))
+
+    def test_unknown_backend(self):
+        self.assertRaises(VMBuilderUserError, get_bootstrapper, 'cdebootstrap', 'amd64')
+
+    def test_tarball_backend_needs_a_tarball(self):
+        bootstrapper = get_bootstrapper('tarball', 'amd64')
+        self.assertRaises(VMBuilderUserError, bootstrapper.bootstrap, 'lucid', '/nonexistent', 'http://archive.ubuntu.com/ubuntu')
+
+    def test_proxy_is_passed_in_environment(self):
+        self.assertEqual(get_bootstrapper('debootstrap', 'amd64', proxy='http://proxy:3128').env()['http_proxy'],
+                         'http://proxy:3128')
+
+class TestMmdebstrap(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.calls = []
+        self.run_cmd = VMBuilder.bootstrap.run_cmd
+        VMBuilder.bootstrap.run_cmd = lambda *argv, **kwargs: self.calls.append((list(argv), kwargs))
+
+    def tearDown(self):
+        VMBuilder.bootstrap.run_cmd = self.run_cmd
+        shutil.rmtree(self.dir)
+
+    def bootstrap(self, **kwargs):
+        get_bootstrapper('mmdebstrap', 'amd64', **kwargs).bootstrap('lucid', '/target', 'http://archive.ubuntu.com/ubuntu')
+        self.assertEqual(len(self.calls), 1)
+        (argv, kwargs) = self.calls.pop()
+        self.assertEqual(argv[:2], ['mmdebstrap', '--architectures=amd64'])
+        self.assertEqual(argv[-3:], ['lucid', '/target', 'http://archive.ubuntu.com/ubuntu'])
+        return (argv[2:-3], kwargs['env'])
+
+    def hooks(self, args, kind):
+        prefix = '--%s-hook=' % kind
+        return [arg[len(prefix):] for arg in args if arg.startswith(prefix)]
+
+    def run_hook(self, hook, root):
+        """Run hook the way mmdebstrap does: through sh, with the chroot as $1"""
+        subprocess.check_call(['sh', '-c', hook, 'sh', root])
+
+    def test_plain(self):
+        (args, env) = self.bootstrap()
+        self.assertEqual(args, [])
+        self.assertFalse('http_proxy' in env)
+
+    def test_variants(self):
+        self.assertEqual(self.bootstrap(variant='minbase')[0], ['--variant=minbase'])
+        self.assertEqual(self.bootstrap(variant='fakechroot')[0], ['--mode=fakechroot'])
+
+    def test_proxy(self):
+        (args, env) = self.bootstrap(proxy='http://proxy:3128')
+        self.assertEqual(args, ['--aptopt=Acquire::http::Proxy "http://proxy:3128"'])
+        self.assertEqual(env['http_proxy'], 'http://proxy:3128')
+
+    def test_debootstrap_tarball(self):
+        debs = os.path.join(self.dir, 'debs src')
+        os.makedirs(os.path.join(debs, 'var/cache/apt/archives'))
+        open(os.path.join(debs, 'var/cache/apt/archives/base-files.deb'), 'w').close()
+        open(os.path.join(debs, 'var/cache/apt/archives/partial'), 'w').close()
+        tarball = os.path.join(self.dir, 'debs with spaces.tgz')
+        tar = tarfile.open(tarball, 'w:gz')
+        tar.add(os.path.join(debs, 'var'), 'var')
+        tar.close()
+
+        (args, env) = self.bootstrap(debootstrap_tarball=tarball)
+        self.assertFalse('--skip=download/empty' in args)
+        root = os.path.join(self.dir, 'root')
+        os.mkdir(root)
+        for hook in self.hooks(args, 'setup'):
+            self.run_hook(hook, root)
+        self.assertEqual(os.listdir(os.path.join(root, 'var/cache/apt/archives')), ['base-files.deb'])
+
+    def test_shared_archives(self):
+        archives = os.path.join(self.dir, 'apt archives')
+        os.mkdir(archives)
+        open(os.path.join(archives, 'old.deb'), 'w').close()
+        (args, env) = self.bootstrap(archives=archives)
+        self.assertTrue('--skip=download/empty' in args)
+
+        root = os.path.join(self.dir, 'root')
+        os.mkdir(root)
+        for hook in self.hooks(args, 'setup'):
+            self.run_hook(hook, root)
+        cache = os.path.join(root, 'var/cache/apt/archives')
+        self.assertEqual(os.listdir(cache), ['old.deb'])
+
+        # What apt downloaded goes back to the shared archives, and
+        # nothing is left behind in the chroot
+        open(os.path.join(cache, 'new.deb'), 'w').close()
+        for hook in self.hooks(args, 'customize'):
+            self.run_hook(hook, root)
+        self.assertEqual(sorted(os.listdir(archives)), ['new.deb', 'old.deb'])
+        self.assertEqual(os.listdir(cache), [])
@@ -0,0 +1,261 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import distutils.spawn
+import os
+import shutil
+import tempfile
+import unittest
+
+from VMBuilder.cache import fingerprint, ChrootCache, OverlayChrootCache, AptArchiveCache, AptListsCache, TarballCache
+
+class TestFingerprint(unittest.TestCase):
+    def test_key_order_does_not_matter(self):
+        a = { 'suite' : 'lucid', 'arch' : 'amd64', 'components' : ['main', 'universe'] }
+        b = { 'components' : ['main', 'universe'], 'arch' : 'amd64', 'suite' : 'lucid' }
+        self.assertEqual(fingerprint(a), fingerprint(b))
+
+    def test_values_matter(self):
+        a = { 'suite' : 'lucid', 'arch' : 'amd64', 'variant' : None }
+        b = { 'suite' : 'lucid', 'arch' : 'amd64', 'variant' : 'minbase' }
+        self.assertNotEqual(fingerprint(a), fingerprint(b))
+
+    def test_list_order_matters(self):
+        self.assertNotEqual(fingerprint({ 'components' : ['main', 'universe'] }),
+                            fingerprint({ 'components' : ['universe', 'main'] }))
+
+class TestChrootCache(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.chroots = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+        for chroot in self.chroots:
+            shutil.rmtree(chroot)
+
+    def new_chroot(self):
+        chroot = tempfile.mkdtemp()
+        self.chroots.append(chroot)
+        return chroot
+
+    @unittest.skipIf(not distutils.spawn.find_executable('rsync'), 'Needs rsync')
+    def test_second_build_comes_from_cache(self):
+        builds = []
+        inputs = { 'suite' : 'lucid', 'arch' : 'amd64' }
+        cache = ChrootCache(self.cachedir)
+
+        chroot = self.new_chroot()
+        def build():
+            builds.append(chroot)
+            fp = open('%s/canary' % chroot, 'w')
+            fp.write('tweet')
+            fp.close()
+        key = cache.populate(chroot, inputs, build)
+        self.assertEqual(len(builds), 1)
+
+        chroot2 = self.new_chroot()
+        self.assertEqual(cache.populate(chroot2, inputs, lambda: builds.append(chroot2)), key)
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(open('%s/canary' % chroot2).read(), 'tweet')
+
+    @unittest.skipIf(not distutils.spawn.find_executable('rsync'), 'Needs rsync')
+    def test_only_changed_layer_is_rebuilt(self):
+        cache = ChrootCache(self.cachedir)
+        builds = []
+        def build(chroot, name):
+            def _build():
+                builds.append(name)
+                open('%s/%s' % (chroot, name), 'w').close()
+            return _build
+
+        chroot = self.new_chroot()
+        base = cache.populate(chroot, { 'suite' : 'lucid' }, build(chroot, 'base'))
+        cache.populate(chroot, { 'user' : 'foo', 'parent' : base }, build(chroot, 'foo'))
+
+        chroot2 = self.new_chroot()
+        self.assertEqual(cache.populate(chroot2, { 'suite' : 'lucid' }, build(chroot2, 'base')), base)
+        cache.populate(chroot2, { 'user' : 'bar', 'parent' : base }, build(chroot2, 'bar'))
+
+        self.assertEqual(builds, ['base', 'foo', 'bar'])
+        self.assertEqual(sorted(os.listdir(chroot2)), ['bar', 'base'])
+
+    @unittest.skipIf(not distutils.spawn.find_executable('rsync'), 'Needs rsync')
+    def test_checkout_keeps_lost_and_found(self):
+        cache = ChrootCache(self.cachedir)
+        inputs = { 'suite' : 'lucid' }
+        chroot = self.new_chroot()
+        os.makedirs('%s/var/lost+found' % chroot)
+        def build():
+            os.mkdir('%s/srv' % chroot)
+            open('%s/canary' % chroot, 'w').close()
+        key = cache.populate(chroot, inputs, build)
+        self.assertFalse(os.path.exists('%s/var/lost+found' % cache.entry_path(key)))
+
+        # Like the guest's filesystems, mounted for --in-place
+        chroot2 = self.new_chroot()
+        os.makedirs('%s/lost+found' % chroot2)
+        os.makedirs('%s/srv/lost+found' % chroot2)
+        open('%s/stale' % chroot2, 'w').close()
+        cache.populate(chroot2, inputs, lambda: None)
+        self.assertTrue(os.path.isdir('%s/lost+found' % chroot2))
+        self.assertTrue(os.path.isdir('%s/srv/lost+found' % chroot2))
+        self.assertTrue(os.path.exists('%s/canary' % chroot2))
+        self.assertFalse(os.path.exists('%s/stale' % chroot2))
+
+    def test_failed_build_is_not_cached(self):
+        cache = ChrootCache(self.cachedir)
+        inputs = { 'suite' : 'lucid' }
+        def build():
+            raise Exception('debootstrap failed')
+        self.assertRaises(Exception, cache.populate, self.new_chroot(), inputs, build)
+        self.assertFalse(cache.has_entry(fingerprint(inputs)))
+
+class TestOverlayChrootCache(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def add_layer(self, cache, key, parent=None):
+        os.makedirs(os.path.join(cache.entry_path(key), 'tree'))
+        if parent:
+            fp = open(os.path.join(cache.entry_path(key), 'parent'), 'w')
+            fp.write(parent)
+            fp.close()
+
+    def test_lower_dirs_topmost_first(self):
+        cache = OverlayChrootCache(self.cachedir)
+        self.add_layer(cache, 'aaa')
+        self.add_layer(cache, 'bbb', 'aaa')
+        self.add_layer(cache, 'ccc', 'bbb')
+        self.assertEqual(cache.lower_dirs('ccc'),
+                         ['%s/%s/tree' % (cache.cachedir, key) for key in ['ccc', 'bbb', 'aaa']])
+
+    def test_no_lower_dirs_for_empty_layer(self):
+        self.assertEqual(OverlayChrootCache(self.cachedir).lower_dirs(None), [])
+
+class TestAptArchiveCache(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def download(self, archives, name, size):
+        fp = open(os.path.join(archives, name), 'w')
+        fp.write('x' * size)
+        fp.close()
+
+    def test_downloads_end_up_in_later_checkouts(self):
+        cache = AptArchiveCache(self.cachedir)
+        archives = cache.checkout()
+        self.download(archives, 'foo_1.0_all.deb', 10)
+        self.download(os.path.join(archives, 'partial'), 'bar_1.0_all.deb', 10)
+        cache.checkin(archives)
+        self.assertFalse(os.path.exists(archives))
+
+        archives = cache.checkout()
+        self.assertEqual(sorted(os.listdir(archives)), ['foo_1.0_all.deb', 'partial'])
+        self.assertEqual(os.listdir(os.path.join(archives, 'partial')), [])
+        cache.checkin(archives)
+
+    def test_clean_does_not_empty_the_pool(self):
+        cache = AptArchiveCache(self.cachedir)
+        archives = cache.checkout()
+        self.download(archives, 'foo_1.0_all.deb', 10)
+        cache.checkin(archives)
+
+        archives = cache.checkout()
+        os.unlink(os.path.join(archives, 'foo_1.0_all.deb'))
+        cache.checkin(archives)
+        self.assertEqual(os.listdir(cache.pooldir), ['foo_1.0_all.deb'])
+
+    def test_least_recently_used_is_evicted(self):
+        cache = AptArchiveCache(self.cachedir, max_size=1)
+        archives = cache.checkout()
+        self.download(archives, 'old_1.0_all.deb', 600*1024)
+        cache.checkin(archives)
+        os.utime(os.path.join(cache.pooldir, 'old_1.0_all.deb'), (1000, 1000))
+
+        archives = cache.checkout()
+        self.download(archives, 'new_1.0_all.deb', 600*1024)
+        cache.checkin(archives)
+        self.assertEqual(os.listdir(cache.pooldir), ['new_1.0_all.deb'])
+
+class TestAptListsCache(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.chroots = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+        for chroot in self.chroots:
+            shutil.rmtree(chroot)
+
+    def new_chroot(self):
+        chroot = tempfile.mkdtemp()
+        self.chroots.append(chroot)
+        os.makedirs('%s/var/lib/apt/lists/partial' % chroot)
+        return chroot
+
+    def test_nothing_to_restore(self):
+        cache = AptListsCache(self.cachedir)
+        self.assertFalse(cache.restore(self.new_chroot(), { 'sources.list' : 'deb foo bar' }))
+
+    @unittest.skipIf(not distutils.spawn.find_executable('rsync'), 'Needs rsync')
+    def test_lists_follow_sources_list(self):
+        cache = AptListsCache(self.cachedir)
+        inputs = { 'sources.list' : 'deb http://archive.ubuntu.com/ubuntu lucid main' }
+        chroot = self.new_chroot()
+        open('%s/var/lib/apt/lists/lucid_Packages' % chroot, 'w').close()
+        cache.store(chroot, inputs)
+
+        chroot2 = self.new_chroot()
+        self.assertTrue(cache.restore(chroot2, inputs))
+        self.assertTrue(os.path.exists('%s/var/lib/apt/lists/lucid_Packages' % chroot2))
+        self.assertFalse(cache.restore(self.new_chroot(), dict(inputs, arch='i386')))
+
+class TestTarballCache(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.made = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def make(self, tarball):
+        self.made.append(tarball)
+        open(tarball, 'w').close()
+
+    def test_tarball_is_reused(self):
+        cache = TarballCache(self.cachedir, 7)
+        inputs = { 'suite' : 'lucid', 'arch' : 'amd64' }
+        tarball = cache.get(inputs, self.make)
+        self.assertTrue(tarball.endswith('.tgz'))
+        self.assertTrue(os.path.exists(tarball))
+        self.assertEqual(cache.get(inputs, self.make), tarball)
+        self.assertEqual(len(self.made), 1)
+
+    def test_stale_tarball_is_remade(self):
+        cache = TarballCache(self.cachedir, 7)
+        inputs = { 'suite' : 'lucid', 'arch' : 'amd64' }
+        tarball = cache.get(inputs, self.make)
+        os.utime(tarball, (0, 0))
+        cache.get(inputs, self.make)
+        self.assertEqual(len(self.made), 2)
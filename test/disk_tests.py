@@ -22,8 +22,10 @@ import unittest
 import testtools
 
 import VMBuilder
-from VMBuilder.disk import detect_size, parse_size, index_to_devname, devname_to_index, Disk
+import VMBuilder.disk
+from VMBuilder.disk import detect_size, parse_size, index_to_devname, devname_to_index, qemu_img_convert_args, qemu_img_create_opts, Disk, Filesystem
 from VMBuilder.exception import VMBuilderException, VMBuilderUserError
+from VMBuilder.hypervisor import Hypervisor
 from VMBuilder.util import run_cmd
 
 TestSkipped = testtools.testcase.TestSkipped
@@ -107,12 +109,12 @@ class TestDetectSize(TestCase):
         self.imgdev = None
 
     def test_detect_size_file(self):
-        self.assertTrue(detect_size(self.tmpfile), 5*1024)
+        self.assertEqual(detect_size(self.tmpfile), 5*1024)
 
     @testtools.skipIf(os.geteuid() != 0, 'Needs root to run')
     def test_detect_size_loopback_dev(self):
         self.imgdev = run_cmd('losetup', '-f', '--show', self.tmpfile).strip()
-        self.assertTrue(detect_size(self.imgdev), 5*1024)
+        self.assertEqual(detect_size(self.imgdev), 5*1024)
 
     def test_detect_size_fifo(self):
         os.unlink(self.tmpfile)
@@ -243,7 +245,7 @@ Sector size (logical/physical): 512B/512B
 Partition Table: msdos
 
 Number  Start   End     Size    Type     File system  Flags
- 1      16.4kB  1023MB  1023MB  primary''' % self.tmpfile, file_output.strip())
+ 1      1049kB  1074MB  1073MB  primary''' % self.tmpfile, file_output.strip())
 
     @testtools.skipIf(os.geteuid() != 0, 'Needs root to run')
     def test_map_partitions(self):
@@ -251,8 +253,8 @@ Number  Start   End     Size    Type     File system  Flags
         self.disk.partition()
         self.disk.map_partitions()
         try:
-            from VMBuilder.disk import detect_size
-            self.assertEqual(detect_size(self.disk.partitions[0].filename), 1023000576)
+            from VMBuilder.imageinfo import image_size
+            self.assertEqual(image_size(self.disk.partitions[0].filename), 1072693248)
         except:
             raise
         finally:
@@ -287,3 +289,100 @@ Number  Start   End     Size    Type     File system  Flags
         disk2 = self.vm.add_disk(tmpfile2, '1G')
         self.assertEqual(self.disk.get_index(), 0)
         self.assertEqual(disk2.get_index(), 1)
+
+class TestFilesystemUUID(TestCase):
+    def test_mkfs_uuid_args(self):
+        fs_uuid = '0f1e6fd0-4ee1-4b9e-8d8e-4dbd9b8e6a3c'
+        for (type, args) in [('ext4', ['-U', fs_uuid]),
+                             ('swap', ['-U', fs_uuid]),
+                             ('xfs', ['-m', 'uuid=%s' % fs_uuid])]:
+            fs = Filesystem(vm=MockHypervisor(), type=type, mntpnt='/')
+            self.assertEqual(fs.mkfs_uuid_args(), [])
+            fs.uuid = fs_uuid
+            self.assertEqual(fs.mkfs_uuid_args(), args)
+
+class TestReproducibleUUIDs(TestCase):
+    class Distro(MockDistro):
+        def __init__(self, suite):
+            self.suite = suite
+
+        def build_inputs(self):
+            return { 'debootstrap' : { 'suite' : self.suite } }
+
+    class VM(MockHypervisor):
+        assign_uuids = Hypervisor.assign_uuids.im_func
+        build_fingerprint = Hypervisor.build_fingerprint.im_func
+
+        def __init__(self, suite='lucid', swap='512M', reproducible=True):
+            MockHypervisor.__init__(self)
+            self.distro = TestReproducibleUUIDs.Distro(suite)
+            self.reproducible = reproducible
+            self.filesystems = [Filesystem(self, '2G', 'ext3', '/'),
+                                Filesystem(self, swap, 'swap', 'swap'),
+                                Filesystem(self, '1G', 'ext3', '/var')]
+
+        def get_setting(self, name):
+            return { 'reproducible-uuids' : self.reproducible }[name]
+
+    def uuids(self, *args, **kwargs):
+        vm = self.VM(*args, **kwargs)
+        vm.assign_uuids()
+        return [fs.uuid for fs in vm.filesystems]
+
+    def test_same_settings_same_uuids(self):
+        uuids = self.uuids()
+        self.assertEqual(len(set(uuids)), 3)
+        self.assertEqual(uuids, self.uuids())
+
+    def test_changed_settings_change_uuids(self):
+        uuids = self.uuids()
+        for kwargs in [{ 'suite' : 'maverick' }, { 'swap' : '1G' }]:
+            self.assertTrue(set(uuids).isdisjoint(self.uuids(**kwargs)))
+
+    def test_random_uuids(self):
+        self.assertNotEqual(self.uuids(reproducible=False), self.uuids(reproducible=False))
+
+    def test_given_uuids_are_kept(self):
+        vm = self.VM()
+        vm.filesystems[0].uuid = '0f1e6fd0-4ee1-4b9e-8d8e-4dbd9b8e6a3c'
+        vm.assign_uuids()
+        self.assertEqual(vm.filesystems[0].uuid, '0f1e6fd0-4ee1-4b9e-8d8e-4dbd9b8e6a3c')
+
+class TestConvertArgs(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.saved_version = VMBuilder.disk._qemu_img_version
+        VMBuilder.disk._qemu_img_version = (6, 2)
+
+    def tearDown(self):
+        VMBuilder.disk._qemu_img_version = self.saved_version
+        TestCase.tearDown(self)
+
+    def test_defaults(self):
+        self.assertEqual(qemu_img_convert_args('qcow2', {}), ['-O', 'qcow2'])
+
+    def test_qcow2(self):
+        self.assertEqual(qemu_img_convert_args('qcow2', { 'coroutines' : 32, 'out-of-order' : True,
+                                                          'cluster-size' : '2M', 'preallocation' : 'metadata',
+                                                          'lazy-refcounts' : True }),
+                         ['-O', 'qcow2', '-m', '16', '-W', '-o', 'cluster_size=2M,preallocation=metadata,lazy_refcounts=on'])
+
+    def test_compression_writes_in_order(self):
+        self.assertEqual(qemu_img_convert_args('qcow2', { 'out-of-order' : True, 'compression' : 'zstd',
+                                                          'preallocation' : 'metadata' }),
+                         ['-O', 'qcow2', '-c', '-o', 'compression_type=zstd'])
+
+    def test_vmdk(self):
+        self.assertEqual(qemu_img_convert_args('vmdk', { 'compression' : 'zlib', 'cluster-size' : '2M' }),
+                         ['-O', 'vmdk', '-c', '-o', 'subformat=streamOptimized'])
+        self.assertRaises(VMBuilderUserError, qemu_img_convert_args, 'vmdk', { 'compression' : 'zstd' })
+
+    def test_old_qemu_img(self):
+        VMBuilder.disk._qemu_img_version = (1, 0)
+        self.assertEqual(qemu_img_convert_args('qcow2', { 'coroutines' : 8, 'out-of-order' : True, 'compression' : 'zlib' }),
+                         ['-O', 'qcow2', '-c'])
+
+    def test_create_opts(self):
+        options = { 'coroutines' : 8, 'cluster-size' : '2M', 'preallocation' : 'metadata' }
+        self.assertEqual(qemu_img_create_opts('qcow2', options), ['cluster_size=2M', 'preallocation=metadata'])
+        self.assertEqual(qemu_img_create_opts('vdi', options), [])
@@ -0,0 +1,99 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import struct
+import tempfile
+import unittest
+import uuid
+
+from VMBuilder.exception import VMBuilderException
+from VMBuilder.imageinfo import image_size, partitions, filesystem_info
+from VMBuilder.partitiontable import mbr, gpt, write, GPT_TYPES
+from VMBuilder.util import run_cmd
+
+MiB = 2048
+FS_UUID = '0f1e6fd0-4ee1-4b9e-8d8e-4dbd9b8e6a3c'
+
+class ImageTestCase(unittest.TestCase):
+    def setUp(self):
+        (fd, self.tmpfile) = tempfile.mkstemp()
+        os.ftruncate(fd, 64 * 1024 * 1024)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.tmpfile)
+
+    def write_at(self, offset, data):
+        fp = open(self.tmpfile, 'r+b')
+        fp.seek(offset)
+        fp.write(data)
+        fp.close()
+
+class TestPartitions(ImageTestCase):
+    def test_image_size(self):
+        self.assertEqual(image_size(self.tmpfile), 64 * 1024 * 1024)
+
+    def test_no_partition_table(self):
+        self.assertRaises(VMBuilderException, partitions, self.tmpfile)
+
+    def test_mbr(self):
+        write(self.tmpfile, mbr(64 * MiB, [('linux', MiB, 10 * MiB), ('swap', 11 * MiB, 5 * MiB)]))
+        self.assertEqual([(p.number, p.type, p.start, p.sectors) for p in partitions(self.tmpfile)],
+                         [(1, 0x83, MiB, 10 * MiB), (2, 0x82, 11 * MiB, 5 * MiB)])
+
+    def test_logical_partitions(self):
+        parts = [('linux', (1 + i * 10) * MiB, 8 * MiB) for i in range(6)]
+        write(self.tmpfile, mbr(64 * MiB, parts))
+        found = partitions(self.tmpfile)
+        self.assertEqual([p.number for p in found], [1, 2, 3, 5, 6, 7])
+        self.assertEqual([(p.start, p.sectors) for p in found], [(start, sectors) for (type, start, sectors) in parts])
+
+    def test_gpt(self):
+        write(self.tmpfile, gpt(64 * MiB, [('linux', MiB, 10 * MiB), ('swap', 11 * MiB, 5 * MiB)]))
+        self.assertEqual([(p.number, p.type, p.start, p.sectors) for p in partitions(self.tmpfile)],
+                         [(1, GPT_TYPES['linux'], MiB, 10 * MiB), (2, GPT_TYPES['swap'], 11 * MiB, 5 * MiB)])
+
+class TestFilesystems(ImageTestCase):
+    def test_unknown(self):
+        self.assertEqual(filesystem_info(self.tmpfile), None)
+
+    def test_ext(self):
+        for type in ['ext2', 'ext3', 'ext4']:
+            run_cmd('mke2fs', '-q', '-F', '-t', type, '-b', '4096', '-U', FS_UUID, '-L', 'root', self.tmpfile)
+            info = filesystem_info(self.tmpfile)
+            self.assertEqual((info.type, info.uuid, info.label, info.size), (type, FS_UUID, 'root', 64 * 1024 * 1024))
+
+    def test_xfs(self):
+        sb = 'XFSB' + struct.pack('>IQ', 4096, 16384) + '\0' * 16 + uuid.UUID(FS_UUID).bytes
+        sb = sb.ljust(108, '\0') + 'data'.ljust(12, '\0')
+        self.write_at(0, sb)
+        info = filesystem_info(self.tmpfile)
+        self.assertEqual((info.type, info.uuid, info.label, info.size), ('xfs', FS_UUID, 'data', 64 * 1024 * 1024))
+
+    def test_swap(self):
+        header = struct.pack('<III', 1, 4095, 0) + uuid.UUID(FS_UUID).bytes + 'swap'.ljust(16, '\0')
+        self.write_at(1024, header)
+        self.write_at(4096 - 10, 'SWAPSPACE2')
+        info = filesystem_info(self.tmpfile)
+        self.assertEqual((info.type, info.uuid, info.label, info.size), ('swap', FS_UUID, 'swap', 16 * 1024 * 1024))
+
+    def test_offset(self):
+        run_cmd('mke2fs', '-q', '-F', '-t', 'ext2', '-U', FS_UUID, self.tmpfile, '8M')
+        data = open(self.tmpfile, 'rb').read(8 * 1024 * 1024)
+        self.write_at(MiB * 512, data)
+        self.assertEqual(filesystem_info(self.tmpfile, MiB * 512).uuid, FS_UUID)
@@ -0,0 +1,247 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import distutils.spawn
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from VMBuilder.exception import VMBuilderUserError
+from VMBuilder.imagewriter import write_image, write_qcow2, allocated_blocks, parse_cluster_size, VDI_HEADER, VMDK_HEADER, VMDK_GRAIN_SECTORS, VMDK_GD_AT_END
+from VMBuilder.imagewriter import QCOW2_HEADER, QCOW2_OFLAG_COPIED, QCOW2_OFLAG_COMPRESSED
+from VMBuilder.util import run_cmd
+
+MiB = 1024 * 1024
+GRAIN = VMDK_GRAIN_SECTORS * 512
+
+def read_at(fp, offset, length):
+    fp.seek(offset)
+    return fp.read(length)
+
+def table(data):
+    return struct.unpack('<%dI' % (len(data) / 4), data)
+
+needs_qemu_img = unittest.skipIf(not distutils.spawn.find_executable('qemu-img'), 'Needs qemu-img')
+
+class ImageWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.raw = os.path.join(self.dir, 'disk.raw')
+        fp = open(self.raw, 'wb')
+        fp.write('boot' * 128)
+        fp.seek(5 * MiB + 1000)
+        fp.write(os.urandom(3 * GRAIN))
+        # Written, but zeros all the same
+        fp.seek(20 * MiB)
+        fp.write('\0' * MiB)
+        fp.seek(63 * MiB)
+        fp.write('end')
+        fp.truncate(64 * MiB)
+        fp.close()
+        self.contents = open(self.raw, 'rb').read()
+        self.dest = os.path.join(self.dir, 'disk.out')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def qemu_img_check(self, format):
+        """Have qemu-img check the image written and compare it with the raw one"""
+        run_cmd('qemu-img', 'check', '-f', format, self.dest)
+        run_cmd('qemu-img', 'compare', '-f', 'raw', '-F', format, self.raw, self.dest)
+        converted = os.path.join(self.dir, 'converted.raw')
+        run_cmd('qemu-img', 'convert', '-f', format, '-O', 'raw', self.dest, converted)
+        self.assertEqual(open(converted, 'rb').read(), self.contents)
+
+class TestAllocatedBlocks(ImageWriterTestCase):
+    def test_blocks(self):
+        fp = open(self.raw, 'rb')
+        blocks = list(allocated_blocks(fp, MiB))
+        fp.close()
+        self.assertEqual([index for (index, data) in blocks], [0, 5, 63])
+        for (index, data) in blocks:
+            self.assertEqual(data, self.contents[index * MiB:(index + 1) * MiB])
+
+class TestVDI(ImageWriterTestCase):
+    def test_vdi(self):
+        write_image(self.raw, self.dest, 'vdi')
+        fp = open(self.dest, 'rb')
+        header = VDI_HEADER.unpack(fp.read(VDI_HEADER.size))
+        (bmap_offset, data_offset) = header[7:9]
+        (size, block_size, extra, blocks, allocated) = header[14:19]
+        self.assertEqual(header[1:5], (0xbeda107f, 0x00010001, 0x180, 1))
+        self.assertEqual((size, block_size, blocks, allocated), (64 * MiB, MiB, 64, 3))
+
+        bmap = table(read_at(fp, bmap_offset, blocks * 4))
+        image = ''
+        for entry in bmap:
+            if entry == 0xffffffff:
+                image += '\0' * block_size
+            else:
+                image += read_at(fp, data_offset + entry * block_size, block_size)
+        fp.close()
+        self.assertEqual(image, self.contents)
+
+    @needs_qemu_img
+    def test_qemu_img_check(self):
+        write_image(self.raw, self.dest, 'vdi')
+        self.qemu_img_check('vdi')
+
+    def test_no_compression(self):
+        self.assertRaises(VMBuilderUserError, write_image, self.raw, self.dest, 'vdi', { 'compression' : 'zlib' })
+
+class TestVMDK(ImageWriterTestCase):
+    def read_grains(self, fp, header, read_grain):
+        gd_offset = header[9]
+        capacity = header[3]
+        grains = capacity / VMDK_GRAIN_SECTORS
+        directory = table(read_at(fp, gd_offset * 512, (grains / 512) * 4))
+        image = ''
+        for gt_offset in directory:
+            for entry in table(read_at(fp, gt_offset * 512, 2048)):
+                if entry:
+                    image += read_grain(fp, entry)
+                else:
+                    image += '\0' * GRAIN
+        return image
+
+    def test_monolithic_sparse(self):
+        write_image(self.raw, self.dest, 'vmdk')
+        fp = open(self.dest, 'rb')
+        header = VMDK_HEADER.unpack(fp.read(VMDK_HEADER.size))
+        self.assertEqual(header[:4], (0x564d444b, 1, 3, 64 * 2048))
+        self.assertTrue('createType="monolithicSparse"' in read_at(fp, 512, 1024))
+        image = self.read_grains(fp, header, lambda fp, entry: read_at(fp, entry * 512, GRAIN))
+        fp.close()
+        self.assertEqual(image, self.contents)
+        # A grain of data at the start, four in the middle and one at the end
+        self.assertEqual(os.path.getsize(self.dest), header[10] * 512 + 6 * GRAIN)
+
+    def test_stream_optimized(self):
+        write_image(self.raw, self.dest, 'vmdk', { 'compression' : 'zlib' })
+        fp = open(self.dest, 'rb')
+        header = VMDK_HEADER.unpack(fp.read(VMDK_HEADER.size))
+        self.assertEqual(header[:3], (0x564d444b, 3, 0x30001))
+        self.assertEqual(header[9], VMDK_GD_AT_END)
+        self.assertTrue('createType="streamOptimized"' in read_at(fp, 512, 1024))
+
+        # Footer, then end-of-stream marker
+        fp.seek(-1024, os.SEEK_END)
+        footer = VMDK_HEADER.unpack(fp.read(VMDK_HEADER.size))
+        self.assertEqual(fp.read(), '\0' * 512)
+
+        def read_grain(fp, entry):
+            (lba, length) = struct.unpack('<QI', read_at(fp, entry * 512, 12))
+            return zlib.decompress(fp.read(length))
+        image = self.read_grains(fp, footer, read_grain)
+        fp.close()
+        self.assertEqual(image, self.contents)
+
+    @needs_qemu_img
+    def test_qemu_img_check_monolithic_sparse(self):
+        write_image(self.raw, self.dest, 'vmdk')
+        self.qemu_img_check('vmdk')
+
+    @needs_qemu_img
+    def test_qemu_img_check_stream_optimized(self):
+        write_image(self.raw, self.dest, 'vmdk', { 'compression' : 'zlib' })
+        self.qemu_img_check('vmdk')
+
+    def test_zstd(self):
+        self.assertRaises(VMBuilderUserError, write_image, self.raw, self.dest, 'vmdk', { 'compression' : 'zstd' })
+
+class TestQcow2(ImageWriterTestCase):
+    def read_qcow2(self, decompress):
+        fp = open(self.dest, 'rb')
+        header = QCOW2_HEADER.unpack(read_at(fp, 0, QCOW2_HEADER.size))
+        (magic, version, backing, backing_size, cluster_bits, size) = header[:6]
+        (l1_size, l1_offset, refcount_table_offset, refcount_table_clusters) = header[7:11]
+        self.assertEqual((magic, version, cluster_bits, size), (0x514649fb, 3, 16, 64 * MiB))
+        cluster_size = 1 << cluster_bits
+        csize_shift = 62 - (cluster_bits - 8)
+
+        image = ''
+        for l2_offset in struct.unpack('>%dQ' % l1_size, read_at(fp, l1_offset, l1_size * 8)):
+            l2_offset &= ~QCOW2_OFLAG_COPIED
+            if not l2_offset:
+                image += '\0' * cluster_size * (cluster_size / 8)
+                continue
+            for entry in struct.unpack('>%dQ' % (cluster_size / 8), read_at(fp, l2_offset, cluster_size)):
+                if not entry:
+                    image += '\0' * cluster_size
+                elif entry & QCOW2_OFLAG_COMPRESSED:
+                    offset = entry & ((1 << csize_shift) - 1)
+                    sectors = ((entry >> csize_shift) & ((1 << (cluster_bits - 8)) - 1)) + 1
+                    image += decompress(read_at(fp, offset, sectors * 512 - (offset & 511)))[:cluster_size]
+                else:
+                    image += read_at(fp, entry & ~QCOW2_OFLAG_COPIED, cluster_size)
+
+        # Every cluster in the file is referenced, and nothing beyond it
+        table = struct.unpack('>%dQ' % (refcount_table_clusters * cluster_size / 8),
+                              read_at(fp, refcount_table_offset, refcount_table_clusters * cluster_size))
+        refcounts = ()
+        for block in table:
+            if block:
+                refcounts += struct.unpack('>%dH' % (cluster_size / 2), read_at(fp, block, cluster_size))
+        clusters = (os.path.getsize(self.dest) + cluster_size - 1) / cluster_size
+        self.assertTrue(0 not in refcounts[:clusters])
+        self.assertEqual(set(refcounts[clusters:]), set([0]))
+        fp.close()
+        return image[:size]
+
+    def test_uncompressed(self):
+        write_qcow2(self.raw, self.dest)
+        self.assertEqual(self.read_qcow2(None), self.contents)
+
+    def test_zlib(self):
+        write_qcow2(self.raw, self.dest, 'zlib')
+        self.assertEqual(self.read_qcow2(lambda data: zlib.decompressobj(-12).decompress(data)), self.contents)
+        self.assertTrue(os.path.getsize(self.dest) < 1 * MiB)
+
+    def qemu_img_check_qcow2(self, compression):
+        for cluster_size in ['4K', '64K']:
+            write_qcow2(self.raw, self.dest, compression, parse_cluster_size(cluster_size))
+            self.qemu_img_check('qcow2')
+
+    @needs_qemu_img
+    def test_qemu_img_check(self):
+        self.qemu_img_check_qcow2('none')
+
+    @needs_qemu_img
+    def test_qemu_img_check_zlib(self):
+        self.qemu_img_check_qcow2('zlib')
+
+    @needs_qemu_img
+    @unittest.skipIf(not zstandard, 'Needs the zstandard module')
+    def test_qemu_img_check_zstd(self):
+        self.qemu_img_check_qcow2('zstd')
+
+    def test_not_used_for_builds(self):
+        self.assertRaises(VMBuilderUserError, write_image, self.raw, self.dest, 'qcow2')
+
+    def test_cluster_size(self):
+        self.assertEqual(parse_cluster_size('2M'), 2 * MiB)
+        self.assertEqual(parse_cluster_size(4096), 4096)
+        for size in ['lots', '256', '3K', '4M']:
+            self.assertRaises(VMBuilderUserError, parse_cluster_size, size)
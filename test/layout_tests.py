@@ -0,0 +1,105 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from VMBuilder.exception import VMBuilderUserError
+from VMBuilder.layout import Layout, disk_size, parse_part_file, MB
+from VMBuilder.partitiontable import GPT_ENTRY_SECTORS
+
+class TestLayout(unittest.TestCase):
+    def test_first_fit(self):
+        layout = Layout(1024 * MB)
+        self.assertEqual(layout.place(100 * MB), MB)
+        self.assertEqual(layout.place(100 * MB, 300 * MB), 300 * MB)
+        # Fits in the gap before the partition at 300 MB
+        self.assertEqual(layout.place(150 * MB), 101 * MB)
+        self.assertEqual(layout.place(100 * MB), 400 * MB)
+
+    def test_start_is_aligned(self):
+        layout = Layout(1024 * MB)
+        self.assertEqual(layout.place(MB, 63), MB)
+        self.assertEqual(layout.place(MB, 2 * MB + 1), 3 * MB)
+
+    def test_alignment(self):
+        layout = Layout(1024 * MB, alignment=8)
+        self.assertEqual(layout.place(100), 8)
+        self.assertEqual(layout.place(100), 112)
+
+    def test_overlap(self):
+        layout = Layout(1024 * MB)
+        layout.place(100 * MB, 100 * MB)
+        self.assertRaises(VMBuilderUserError, layout.place, 100 * MB, 50 * MB)
+        self.assertRaises(VMBuilderUserError, layout.place, 100 * MB, 199 * MB)
+        layout.place(100 * MB, 200 * MB)
+
+    def test_out_of_bounds(self):
+        layout = Layout(1024 * MB)
+        self.assertRaises(VMBuilderUserError, layout.place, 100 * MB, 1000 * MB)
+        self.assertRaises(VMBuilderUserError, layout.place, 1024 * MB)
+
+    def test_gpt_reserves_the_end(self):
+        layout = Layout(1024 * MB, table='gpt')
+        self.assertEqual(layout.rest(), 1023 * MB - GPT_ENTRY_SECTORS - 1)
+        self.assertRaises(VMBuilderUserError, layout.place, 1023 * MB)
+
+    def test_rest(self):
+        layout = Layout(1024 * MB)
+        layout.place(100 * MB)
+        self.assertEqual(layout.rest(), 923 * MB)
+
+    def test_disk_size(self):
+        self.assertEqual(disk_size([100, 200]), 301)
+        self.assertEqual(disk_size([100, 200], table='gpt'), 302)
+        layout = Layout(disk_size([100, 200]) * MB)
+        layout.place(100 * MB)
+        layout.place(200 * MB)
+
+class TestPartFile(unittest.TestCase):
+    def test_old_format(self):
+        disks = parse_part_file(['root 2000', 'swap 1000 a2', '---', '/var 8000 b1 var.img', ''])
+        self.assertEqual(disks, [{ 'parts' : [{ 'mntpnt' : '/', 'size' : 2000 },
+                                              { 'mntpnt' : 'swap', 'size' : 1000 }] },
+                                 { 'parts' : [{ 'mntpnt' : '/var', 'size' : 8000, 'file' : 'var.img' }] }])
+
+    def test_old_format_devices(self):
+        disks = parse_part_file(['root 2000 a1', '/ 2000 a1', '/srv 0 /dev/sdb1'])
+        self.assertEqual(disks[0]['parts'], [{ 'mntpnt' : '/', 'size' : 2000 },
+                                             { 'mntpnt' : '/', 'size' : 2000, 'device' : 'a1' },
+                                             { 'mntpnt' : '/srv', 'size' : 0, 'device' : '/dev/sdb1' }])
+
+    def test_declarative_format(self):
+        disks = parse_part_file(['# The system disk',
+                                 'disk table=gpt',
+                                 'part mount=/ size=8G fs=ext4',
+                                 'part mount=/srv size=rest',
+                                 'disk file=/dev/sdb size=40G',
+                                 'part mount=/var size=20G start=1G'])
+        self.assertEqual(disks, [{ 'table' : 'gpt',
+                                   'parts' : [{ 'mntpnt' : '/', 'size' : 8192, 'fs' : 'ext4' },
+                                              { 'mntpnt' : '/srv', 'size' : None }] },
+                                 { 'file' : '/dev/sdb', 'size' : 40960,
+                                   'parts' : [{ 'mntpnt' : '/var', 'size' : 20480, 'start' : 1024 }] }])
+
+    def test_declarative_errors(self):
+        for lines in [['part mount=/'],
+                      ['part mount=/ size=1G colour=blue'],
+                      ['disk table=sun'],
+                      ['part mount=/ size=rest', 'part mount=/srv size=1G'],
+                      ['part mount=/ size=lots'],
+                      ['disk', 'partition mount=/ size=1G']]:
+            self.assertRaises(VMBuilderUserError, parse_part_file, lines)
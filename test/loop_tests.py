@@ -0,0 +1,31 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from VMBuilder.loop import loop_info64, loop_config
+
+class TestLoopStructs(unittest.TestCase):
+    def test_sizes(self):
+        self.assertEqual(len(loop_info64('/tmp/disk.img', 0, 0)), 232)
+        self.assertEqual(len(loop_config(3, '/tmp/disk.img', 0, 0)), 304)
+
+    def test_long_filenames_are_truncated(self):
+        info = loop_info64('/%s' % ('x' * 100), 512, 1024)
+        self.assertEqual(len(info), 232)
+        # Leaves room for the terminating NUL
+        self.assertEqual(info[56:120], 'x' * 63 + '\0')
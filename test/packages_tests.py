@@ -0,0 +1,67 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from VMBuilder.packages import PackagePlan, apt_args, STAGE_EARLY, STAGE_LATE
+
+class TestPackagePlan(unittest.TestCase):
+    def test_empty_plan(self):
+        self.assertEqual(PackagePlan().transactions(), [])
+
+    def test_one_transaction_by_default(self):
+        plan = PackagePlan()
+        plan.install(['openssh-server'])
+        plan.install(['linux-image-virtual', 'openssh-server'])
+        plan.remove(['nano'])
+        plan.upgrade = True
+        self.assertEqual(plan.transactions(),
+                         [(['openssh-server', 'linux-image-virtual'], ['nano'], True)])
+
+    def test_upgrade_only(self):
+        plan = PackagePlan()
+        plan.upgrade = True
+        self.assertEqual(plan.transactions(), [([], [], True)])
+
+    def test_last_request_wins(self):
+        plan = PackagePlan()
+        plan.install(['nano'])
+        plan.remove(['nano'])
+        self.assertEqual(plan.transactions(), [([], ['nano'], False)])
+
+    def test_stages_are_ordered(self):
+        plan = PackagePlan()
+        plan.install(['late'], stage=STAGE_LATE)
+        plan.install(['default'])
+        plan.install(['early'], stage=STAGE_EARLY)
+        plan.upgrade = True
+        self.assertEqual(plan.transactions(),
+                         [(['early'], [], False),
+                          (['default'], [], True),
+                          (['late'], [], False)])
+
+    def test_installs(self):
+        plan = PackagePlan()
+        plan.install(['grub'], stage=STAGE_LATE)
+        plan.install(['linux-image-virtual'])
+        self.assertTrue(plan.installs(['grub', 'linux-image-virtual']))
+        plan.remove(['grub'], stage=STAGE_LATE)
+        self.assertFalse(plan.installs(['grub']))
+        self.assertTrue(plan.installs([]))
+
+    def test_apt_args(self):
+        self.assertEqual(apt_args(['grub'], ['nano']), ['grub+', 'nano-'])
@@ -0,0 +1,161 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+
+import VMBuilder.plugins
+from VMBuilder.disk import Disk
+from VMBuilder.exception import VMBuilderUserError
+from VMBuilder.imageinfo import mbr_entries
+from VMBuilder.plugins.storage import StorageHypervisorPlugin
+from VMBuilder.partitiontable import mbr, gpt, write, SECTOR_SIZE, GPT_ENTRY_SECTORS
+
+MiB = 2048
+
+class MockHypervisor(object):
+    def __init__(self):
+        self.disks = []
+
+    def add_disk(self, *args, **kwargs):
+        disk = Disk(self, *args, **kwargs)
+        self.disks.append(disk)
+        return disk
+
+class TestPartitionTables(unittest.TestCase):
+    def setUp(self):
+        (fd, self.tmpfile) = tempfile.mkstemp()
+        os.ftruncate(fd, 100 * MiB * SECTOR_SIZE)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.tmpfile)
+
+    def sector(self, lba):
+        fp = open(self.tmpfile, 'rb')
+        fp.seek(lba * SECTOR_SIZE)
+        data = fp.read(SECTOR_SIZE)
+        fp.close()
+        return data
+
+    def primaries(self):
+        return [(start, length) for (type, start, length) in mbr_entries(self.sector(0))]
+
+    def test_mbr(self):
+        write(self.tmpfile, mbr(100 * MiB, [('linux', MiB, 50 * MiB), ('swap', 51 * MiB, 10 * MiB)]))
+        self.assertEqual(self.primaries(), [(MiB, 50 * MiB), (51 * MiB, 10 * MiB)])
+        self.assertEqual(ord(self.sector(0)[446 + 16 + 4]), 0x82)
+
+    def test_bootcode_is_kept(self):
+        write(self.tmpfile, mbr(100 * MiB, [('linux', MiB, 50 * MiB)], bootcode='\xeb\x63'))
+        self.assertEqual(self.sector(0)[:2], '\xeb\x63')
+
+    def test_logical_partitions(self):
+        parts = [('linux', (i * 10 + 1) * MiB, 9 * MiB) for i in range(6)]
+        write(self.tmpfile, mbr(100 * MiB, parts))
+        # Three primaries and an extended partition starting at the first EBR
+        self.assertEqual(self.primaries(), [(MiB, 9 * MiB), (11 * MiB, 9 * MiB),
+                                                       (21 * MiB, 9 * MiB), (30 * MiB, 30 * MiB)])
+        ext_start = 30 * MiB
+        ebr = ext_start
+        found = []
+        while True:
+            sector = self.sector(ebr)
+            self.assertEqual(sector[510:], '\x55\xaa')
+            (start, length) = struct.unpack('<II', sector[446+8:446+16])
+            found.append((ebr + start, length))
+            (next_start,) = struct.unpack('<I', sector[462+8:462+12])
+            if not next_start:
+                break
+            ebr = ext_start + next_start
+        self.assertEqual(found, [(31 * MiB, 9 * MiB), (41 * MiB, 9 * MiB), (51 * MiB, 9 * MiB)])
+
+    def test_no_room_for_ebr(self):
+        parts = [('linux', (i * 10 + 1) * MiB, 10 * MiB) for i in range(5)]
+        self.assertRaises(VMBuilderUserError, mbr, 100 * MiB, parts)
+
+    def test_gpt(self):
+        total = 100 * MiB
+        write(self.tmpfile, gpt(total, [('linux', MiB, 50 * MiB), ('swap', 51 * MiB, 10 * MiB)]))
+        self.assertEqual(self.primaries(), [(1, total - 1)])
+        for (lba, entries_lba) in [(1, 2), (total - 1, total - 1 - GPT_ENTRY_SECTORS)]:
+            header = self.sector(lba)
+            self.assertEqual(header[:8], 'EFI PART')
+            (crc,) = struct.unpack('<I', header[16:20])
+            self.assertEqual(zlib.crc32(header[:16] + '\0\0\0\0' + header[20:92]) & 0xffffffff, crc)
+            self.assertEqual(struct.unpack('<Q', header[72:80])[0], entries_lba)
+            entry = self.sector(entries_lba)[128:256]
+            self.assertEqual(struct.unpack('<QQ', entry[32:48]), (51 * MiB, 61 * MiB - 1))
+
+    def test_gpt_backup_is_left_alone(self):
+        self.assertRaises(VMBuilderUserError, gpt, 100 * MiB, [('linux', MiB, 99 * MiB)])
+
+class TestTableEntries(unittest.TestCase):
+    def setUp(self):
+        (fd, self.tmpfile) = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.tmpfile)
+        self.disk = MockHypervisor().add_disk(self.tmpfile, '1G')
+
+    def test_partitions_are_aligned(self):
+        self.disk.add_part(0, 100, 'ext3', '/')
+        self.disk.add_part(101, 100, 'swap', 'swap')
+        self.assertEqual(self.disk.table_entries(), [('linux', MiB, 100 * MiB), ('swap', 101 * MiB, 100 * MiB)])
+
+    def test_logical_partitions_are_numbered_from_five(self):
+        for i in range(5):
+            self.disk.add_part(None, 100, 'ext3', '/%d' % i)
+        self.assertEqual([part.get_number() for part in self.disk.partitions], [1, 2, 3, 5, 6])
+        self.assertEqual(self.disk.table_entries()[3], ('linux', 302 * MiB, 99 * MiB))
+
+    def test_gpt_leaves_room_for_backup(self):
+        self.disk = MockHypervisor().add_disk(self.tmpfile, '1G', table_type='gpt')
+        self.disk.add_part(None, None, 'ext3', '/')
+        (type, start, sectors) = self.disk.table_entries()[0]
+        self.assertEqual(start, MiB)
+        self.assertEqual(start + sectors, 1024 * MiB - GPT_ENTRY_SECTORS - 1)
+
+class TestPartedPreflight(unittest.TestCase):
+    class VM(VMBuilder.plugins.Plugin):
+        def __init__(self):
+            self._config = {}
+            self.context = self
+            self.disks = []
+
+    def setUp(self):
+        (fd, self.tmpfile) = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.tmpfile)
+        self.vm = self.VM()
+        self.plugin = StorageHypervisorPlugin(self.vm)
+        self.disk = Disk(self.vm, self.tmpfile, '1G')
+        self.vm.disks.append(self.disk)
+        for i in range(5):
+            self.disk.add_part(None, 100, 'ext3', '/%d' % i)
+
+    def test_parted_takes_four_partitions(self):
+        self.assertRaises(VMBuilderUserError, self.plugin.preflight_check)
+        self.disk.partitions.pop()
+        self.plugin.preflight_check()
+
+    def test_direct_tables_take_more(self):
+        for table in ['msdos', 'gpt']:
+            self.vm.set_setting('partition-table', table)
+            self.plugin.preflight_check()
@@ -0,0 +1,105 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import distutils.spawn
+import os
+import shutil
+import tempfile
+import unittest
+
+from VMBuilder.treecopy import Subtree, scan, plan, mountpoint_of, copy_tree
+
+class TestTreeCopy(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+        shutil.rmtree(self.dest)
+
+    def add_file(self, rel, size=0):
+        path = os.path.join(self.src, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fp = open(path, 'w')
+        fp.write('x' * size)
+        fp.close()
+
+    def test_mountpoint_of(self):
+        mountpoints = ['', 'var', 'var/lib']
+        self.assertEqual(mountpoint_of('usr/share', mountpoints), '')
+        self.assertEqual(mountpoint_of('var/cache', mountpoints), 'var')
+        self.assertEqual(mountpoint_of('var/lib/dpkg', mountpoints), 'var/lib')
+        self.assertEqual(mountpoint_of('variable', mountpoints), '')
+
+    def test_scan_counts_hardlinked_data_once(self):
+        self.add_file('a/foo', 100)
+        os.link(os.path.join(self.src, 'a/foo'), os.path.join(self.src, 'bar'))
+        links = {}
+        tree = scan(self.src, links)
+        self.assertEqual(tree.bytes, 100)
+        self.assertEqual(tree.entries, 4)
+        self.assertEqual(sorted(links.values()[0]), ['a/foo', 'bar'])
+
+    def test_jobs_do_not_span_mountpoints(self):
+        for d in ['usr/share/doc', 'usr/lib', 'var/lib', 'var/cache', 'opt/foo']:
+            self.add_file('%s/file' % d)
+        (skeleton, jobs) = plan(scan(self.src), ['/', '/var', '/opt'], workers=1)
+        self.assertTrue('var' in skeleton)
+        self.assertTrue('opt' in skeleton)
+        for job in jobs:
+            self.assertEqual(len(set([mountpoint_of(path, ['', 'var', 'opt']) for path in job])), 1)
+        copied = sum(jobs, [])
+        for path in ['opt/foo', 'var/cache', 'var/lib']:
+            self.assertTrue(path in copied)
+        # Different mountpoints come first
+        self.assertNotEqual(mountpoint_of(jobs[0][0], ['', 'var', 'opt']),
+                            mountpoint_of(jobs[1][0], ['', 'var', 'opt']))
+
+    def test_filled_mountpoints_are_left_alone(self):
+        for d in ['usr/share/doc', 'etc', 'var/lib', 'var/cache']:
+            self.add_file('%s/file' % d)
+        (skeleton, jobs) = plan(scan(self.src), ['/', '/var'], workers=1, filled=['/'])
+        self.assertEqual([rel for rel in skeleton + sum(jobs, []) if mountpoint_of(rel, ['', 'var']) != 'var'], [])
+        self.assertTrue('var/lib' in sum(jobs, []))
+        (skeleton, jobs) = plan(scan(self.src), ['/', '/var'], workers=1, filled=['/var'])
+        self.assertEqual([rel for rel in skeleton + sum(jobs, []) if mountpoint_of(rel, ['', 'var']) == 'var'], [])
+        self.assertTrue('etc' in skeleton + sum(jobs, []))
+
+    def test_big_subtrees_are_split(self):
+        for i in range(20):
+            self.add_file('usr/share/doc%d/copyright' % i)
+        self.add_file('etc/hostname')
+        (skeleton, jobs) = plan(scan(self.src), ['/'], workers=2)
+        self.assertTrue('usr/share' in skeleton)
+        self.assertTrue('usr/share/doc0' in skeleton)
+        self.assertTrue(len(jobs) > 1)
+
+    @unittest.skipIf(not distutils.spawn.find_executable('rsync'), 'Needs rsync')
+    def test_copy_tree(self):
+        for i in range(10):
+            self.add_file('usr/share/doc%d/copyright' % i, 10)
+        os.link(os.path.join(self.src, 'usr/share/doc0/copyright'), os.path.join(self.src, 'usr/share/doc9/link'))
+        os.symlink('doc0', os.path.join(self.src, 'usr/share/doc10'))
+        os.utime(os.path.join(self.src, 'usr/share'), (1000000000, 1000000000))
+        copy_tree(self.src, self.dest, workers=4)
+        self.assertEqual(os.stat(os.path.join(self.dest, 'usr/share')).st_mtime, 1000000000)
+        self.assertEqual(open(os.path.join(self.dest, 'usr/share/doc3/copyright')).read(), 'x' * 10)
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'usr/share/doc10')), 'doc0')
+        self.assertEqual(os.stat(os.path.join(self.dest, 'usr/share/doc0/copyright')).st_ino,
+                         os.stat(os.path.join(self.dest, 'usr/share/doc9/link')).st_ino)
@@ -1,10 +1,96 @@
+import os
+import tempfile
+import threading
+import time
 import unittest
 
 import VMBuilder
-from VMBuilder.util import run_cmd
+from VMBuilder.exception import VMBuilderException
+from VMBuilder.util import run_cmd, wait_for, retry, is_mounted, parallel_map, JobPool
 
 class TestUtils(unittest.TestCase):
     def test_run_cmd(self):
         self.assertTrue("foobarbaztest" in run_cmd("env", env={'foobarbaztest' : 'bar' }))
 
+class TestWaiting(unittest.TestCase):
+    def test_wait_for_returns_once_true(self):
+        calls = []
+        def ready():
+            calls.append(1)
+            return len(calls) == 3 and 'ready'
+        self.assertEqual(wait_for(ready, 'the third call'), 'ready')
+        self.assertEqual(len(calls), 3)
 
+    def test_wait_for_gives_up(self):
+        self.assertRaises(VMBuilderException, wait_for, lambda: False, 'nothing', timeout=0.2)
+
+    def test_retry_returns_once_it_works(self):
+        calls = []
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise VMBuilderException('target is busy')
+            return 'done'
+        self.assertEqual(retry(flaky, 'flaky'), 'done')
+
+    def test_retry_raises_last_failure(self):
+        def broken():
+            raise VMBuilderException('target is busy')
+        self.assertRaises(VMBuilderException, retry, broken, 'broken', timeout=0.2)
+
+    def test_retry_only_retries_given_exceptions(self):
+        calls = []
+        def broken():
+            calls.append(1)
+            raise KeyError('oops')
+        self.assertRaises(KeyError, retry, broken, 'broken')
+        self.assertEqual(len(calls), 1)
+
+    def test_is_mounted(self):
+        self.assertTrue(is_mounted('/proc'))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.assertFalse(is_mounted(tmpdir))
+        finally:
+            os.rmdir(tmpdir)
+
+class TestJobPool(unittest.TestCase):
+    def test_jobs_run_at_the_same_time(self):
+        jobs = JobPool(2)
+        barrier = threading.Event()
+        jobs.add('waits', barrier.wait, 5)
+        jobs.add('sets', barrier.set)
+        jobs.wait()
+        self.assertTrue(barrier.is_set())
+        self.assertEqual(sorted([description for (description, seconds) in jobs.timings]), ['sets', 'waits'])
+
+    def test_jobs_can_add_jobs(self):
+        jobs = JobPool(2)
+        done = []
+        def parent():
+            for i in range(3):
+                jobs.add('child %d' % i, done.append, i)
+        jobs.add('parent', parent)
+        jobs.wait()
+        self.assertEqual(sorted(done), [0, 1, 2])
+
+    def test_failures_are_raised(self):
+        jobs = JobPool(1)
+        done = []
+        def broken():
+            raise VMBuilderException('no space left')
+        jobs.add('broken', broken)
+        jobs.add('later', done.append, 1)
+        self.assertRaises(VMBuilderException, jobs.wait)
+        # Skipped, since something already failed
+        self.assertEqual(done, [])
+
+class TestParallelMap(unittest.TestCase):
+    def test_results_keep_their_order(self):
+        def slow_square(x):
+            time.sleep((5 - x) * 0.01)
+            return x * x
+        self.assertEqual(parallel_map(slow_square, range(5), 3), [0, 1, 4, 9, 16])
+
+    def test_nothing_to_do(self):
+        self.assertEqual(parallel_map(len, [], 4), [])